@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Controle de Admissão
+====================
+
+Limita a taxa de trabalho caro (chamadas ao modelo, mídia e tarefas Celery)
+antes que ele chegue ao executor, protegendo a cota do Gemini e o banco.
+
+Funcionalidades:
+- Token bucket por usuário e global, com custo por tipo de trabalho
+- Descarte de trabalho de baixa prioridade sob sobrecarga (profundidade da
+  fila do modelo ou p95 de latência das respostas de texto, nos últimos
+  latency_window_seconds, acima do SLO)
+- Faixa prioritária para administradores (sem limites nem descarte)
+
+Características:
+- Estado em memória, acessado apenas pelo event loop
+- Buckets por usuário limitados em quantidade (LRU)
+"""
+
+import time
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional
+
+from metrics import Metrics, get_metrics
+from model_executor import INTERACTIVE_LATENCY
+
+logger = logging.getLogger('gemini_bot')
+
+# Tipos de trabalho
+KIND_TEXT = "text"
+KIND_IMAGE = "image"
+KIND_AUDIO = "audio"
+KIND_VIDEO = "video"
+KIND_TASK = "task"
+
+# Motivos de recusa
+REASON_USER_LIMIT = "user_limit"
+REASON_GLOBAL_LIMIT = "global_limit"
+REASON_SHED = "shed"
+
+# Intervalo mínimo entre recálculos do p95 de latência
+_LATENCY_REFRESH_SECONDS = 1.0
+
+
+class TokenBucket:
+    """Token bucket com reposição contínua"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, cost: float = 1.0) -> bool:
+        """Consome tokens se houver saldo suficiente"""
+        self._refill(time.monotonic())
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def refund(self, cost: float = 1.0):
+        """Devolve tokens consumidos"""
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+    def retry_after(self, cost: float = 1.0) -> float:
+        """Segundos até haver saldo para o custo"""
+        self._refill(time.monotonic())
+        missing = min(cost, self.capacity) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+
+@dataclass
+class AdmissionDecision:
+    """Resultado da admissão de um trabalho"""
+    allowed: bool
+    reason: Optional[str] = None
+    retry_after: float = 0.0
+
+
+class AdmissionController:
+    """Decide se um trabalho pode ser executado agora"""
+
+    def __init__(self, settings: Dict[str, Any], admin_users: Iterable[int] = (),
+                 model_executor: Any = None, metrics: Optional[Metrics] = None):
+        user_settings = settings.get("user", {})
+        global_settings = settings.get("global", {})
+
+        self.enabled = settings.get("enabled", True)
+        self.user_rate = float(user_settings.get("rate_per_minute", 20)) / 60
+        self.user_burst = float(user_settings.get("burst", 10))
+        self.max_tracked_users = int(user_settings.get("max_tracked_users", 10000))
+        self.costs = {KIND_TEXT: 1, KIND_IMAGE: 3, KIND_AUDIO: 3, KIND_VIDEO: 5, KIND_TASK: 5}
+        self.costs.update(settings.get("costs", {}))
+        self.low_priority_kinds = set(settings.get("low_priority_kinds", [KIND_IMAGE, KIND_AUDIO, KIND_VIDEO, KIND_TASK]))
+        self.shed_queue_depth = int(settings.get("shed_queue_depth", 20))
+        self.latency_slo = settings.get("latency_slo_seconds")
+        self.latency_window = float(settings.get("latency_window_seconds", 60))
+
+        self.admin_users = set(admin_users)
+        self.model_executor = model_executor
+        self.metrics = metrics or get_metrics()
+
+        self._global = TokenBucket(
+            float(global_settings.get("rate_per_second", 10)),
+            float(global_settings.get("burst", 50)),
+        )
+        self._users: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._clamp_costs()
+        self._latency_p95: Optional[float] = None
+        self._latency_checked_at = 0.0
+
+    def admit(self, user_id: int, kind: str = KIND_TEXT) -> AdmissionDecision:
+        """Avalia e, se aprovado, consome a cota do trabalho"""
+        if not self.enabled:
+            return AdmissionDecision(True)
+
+        if user_id in self.admin_users:
+            # Faixa prioritária: administradores não são limitados nem descartados
+            self.metrics.increment("admission.priority")
+            return AdmissionDecision(True)
+
+        if kind in self.low_priority_kinds and self.is_overloaded():
+            self.metrics.increment("admission.shed")
+            return AdmissionDecision(False, REASON_SHED)
+
+        cost = float(self.costs.get(kind, 1))
+        bucket = self._user_bucket(user_id)
+        if not bucket.try_acquire(cost):
+            self.metrics.increment("admission.rate_limited_user")
+            return AdmissionDecision(False, REASON_USER_LIMIT, bucket.retry_after(cost))
+
+        if not self._global.try_acquire(cost):
+            bucket.refund(cost)
+            self.metrics.increment("admission.rate_limited_global")
+            return AdmissionDecision(False, REASON_GLOBAL_LIMIT, self._global.retry_after(cost))
+
+        self.metrics.increment("admission.admitted")
+        return AdmissionDecision(True)
+
+    def _clamp_costs(self):
+        """Limita os custos à menor capacidade: um custo acima do burst nunca seria admitido"""
+        max_cost = min(self.user_burst, self._global.capacity)
+        for kind, cost in list(self.costs.items()):
+            if float(cost) > max_cost:
+                logger.warning(f"Custo de admissão de '{kind}' ({cost}) acima do burst; usando {max_cost:g}")
+                self.costs[kind] = max_cost
+
+    def is_overloaded(self) -> bool:
+        """Sobrecarga pela fila do modelo ou pela latência observada"""
+        if self.model_executor is not None and self.model_executor.queue_depth >= self.shed_queue_depth:
+            return True
+
+        if self.latency_slo is None:
+            return False
+        now = time.monotonic()
+        if now - self._latency_checked_at >= _LATENCY_REFRESH_SECONDS:
+            self._latency_p95 = self.metrics.percentile(INTERACTIVE_LATENCY, 95, self.latency_window)
+            self._latency_checked_at = now
+        return self._latency_p95 is not None and self._latency_p95 > float(self.latency_slo)
+
+    def _user_bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self._users) > self.max_tracked_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return bucket
@@ -23,14 +23,26 @@ Características:
 """
 
 import os
+import sys
+import time
+import base64
+import struct
 import logging
 import json
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any, Tuple
-from dataclasses import dataclass, asdict
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, Iterator, List, Optional, Any, Set, Tuple
+from dataclasses import dataclass, field
 from enum import Enum
 
-from conversation_persistence import ConversationManager, ChatMessage
+import database
+from conversation_persistence import ConversationManager
+from config_loader import load_config
+from cache_invalidation import (
+    InvalidationBus, SCOPE_ALL, SCOPE_CONTEXT, SCOPE_PERSONALITY, SCOPE_STATE,
+    create_invalidation_bus
+)
+from cache_snapshot import CacheSnapshotter
 
 logger = logging.getLogger('gemini_bot')
 
@@ -45,28 +57,263 @@ class ConversationState(Enum):
     CONFIGURANDO = "configurando"
     AGUARDANDO_PERSONALIDADE = "aguardando_personalidade"
 
-@dataclass
+class ContextType(str, Enum):
+    """Tipos de contexto multimodal.
+
+    Os membros do Enum são singletons: todos os contextos em cache apontam
+    para o mesmo objeto em vez de guardar uma string por instância.
+    """
+    IMAGE = "image"
+    AUDIO = "audio"
+    VIDEO = "video"
+    RESEARCH = "research"
+    IMAGE_GENERATION = "image_generation"
+    OCR = "ocr"
+
+# Ordem estável usada na serialização binária (novos tipos sempre no final)
+_CONTEXT_TYPES: Tuple[ContextType, ...] = tuple(ContextType)
+_CONTEXT_TYPE_INDEX: Dict[ContextType, int] = {ctype: i for i, ctype in enumerate(_CONTEXT_TYPES)}
+_CONTEXT_TYPE_VALUES = frozenset(ctype.value for ctype in ContextType)
+
+# Rótulos usados ao montar o contexto para o modelo
+_CONTEXT_LABELS: Dict[ContextType, str] = {
+    ContextType.IMAGE: "Contexto de imagem recente",
+    ContextType.AUDIO: "Transcrição de áudio recente",
+    ContextType.VIDEO: "Análise de vídeo recente",
+    ContextType.RESEARCH: "Tópico de pesquisa recente",
+    ContextType.IMAGE_GENERATION: "Prompt de imagem recente",
+    ContextType.OCR: "Texto extraído de imagem recente",
+}
+
+# Campos do formato JSON legado (um campo por modalidade)
+_LEGACY_CONTEXT_FIELDS: Dict[str, ContextType] = {
+    "last_image_description": ContextType.IMAGE,
+    "last_audio_transcription": ContextType.AUDIO,
+    "last_video_analysis": ContextType.VIDEO,
+    "last_research_topic": ContextType.RESEARCH,
+    "last_generated_image_prompt": ContextType.IMAGE_GENERATION,
+}
+
+# Quantidade de itens mantidos por modalidade (ring buffer)
+CONTEXT_HISTORY_SIZE = 5
+# Janela em que o contexto ainda é considerado relevante
+CONTEXT_MAX_AGE_SECONDS = 10 * 60
+# Estado e personalidade são por usuário; conversation_id fixo em conversation_states
+USER_STATE_CONVERSATION_ID = 0
+
+# Formato binário: versão, conversation_id, timestamp, tipo, nº de modalidades
+_CONTEXT_HEADER = struct.Struct("<Bqdbb")
+_CONTEXT_ITEM = struct.Struct("<dI")
+_PERSONALITY_HEADER = struct.Struct("<Bdd")
+_STR_LEN = struct.Struct("<I")
+_NONE_LEN = 0xFFFFFFFF
+_BINARY_VERSION = 1
+
+
+def _pack_str(value: Optional[str]) -> bytes:
+    """Serializa string com prefixo de tamanho (None usa marcador próprio)"""
+    if value is None:
+        return _STR_LEN.pack(_NONE_LEN)
+    raw = value.encode("utf-8")
+    return _STR_LEN.pack(len(raw)) + raw
+
+
+def _unpack_str(buffer: memoryview, offset: int) -> Tuple[Optional[str], int]:
+    """Lê string serializada por _pack_str, retornando (valor, novo offset)"""
+    (length,) = _STR_LEN.unpack_from(buffer, offset)
+    offset += _STR_LEN.size
+    if length == _NONE_LEN:
+        return None, offset
+    end = offset + length
+    return bytes(buffer[offset:end]).decode("utf-8"), end
+
+
+def _iso_to_epoch(value: Any) -> float:
+    """Converte timestamp legado (ISO ou número) para epoch"""
+    if not value:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return 0.0
+
+
+@dataclass(slots=True)
 class MultimodalContext:
-    """Contexto multimodal de uma conversa"""
+    """Contexto multimodal de uma conversa
+
+    Guarda os últimos CONTEXT_HISTORY_SIZE itens de cada modalidade como
+    pares (timestamp epoch, conteúdo). As deques só são criadas para as
+    modalidades efetivamente usadas.
+    """
     user_id: str
     conversation_id: int
-    last_image_description: Optional[str] = None
-    last_audio_transcription: Optional[str] = None
-    last_video_analysis: Optional[str] = None
-    last_research_topic: Optional[str] = None
-    last_generated_image_prompt: Optional[str] = None
-    context_timestamp: Optional[str] = None
-    context_type: Optional[str] = None  # "image", "audio", "video", "research", "image_generation"
-
-@dataclass
+    history: Dict[ContextType, Deque[Tuple[float, str]]] = field(default_factory=dict)
+    context_timestamp: Optional[float] = None
+    context_type: Optional[ContextType] = None
+
+    def add_item(self, context_type: ContextType, content: str, timestamp: Optional[float] = None):
+        """Adiciona item ao ring buffer da modalidade"""
+        ts = time.time() if timestamp is None else timestamp
+        items = self.history.get(context_type)
+        if items is None:
+            items = self.history[context_type] = deque(maxlen=CONTEXT_HISTORY_SIZE)
+        items.append((ts, content))
+        self.context_timestamp = ts
+        self.context_type = context_type
+
+    def latest(self, context_type: ContextType) -> Optional[str]:
+        """Obtém o item mais recente da modalidade"""
+        items = self.history.get(context_type)
+        return items[-1][1] if items else None
+
+    def recent(self, context_type: ContextType, limit: Optional[int] = None) -> List[str]:
+        """Obtém os itens da modalidade, do mais antigo para o mais recente"""
+        items = self.history.get(context_type)
+        if not items:
+            return []
+        contents = [content for _, content in items]
+        return contents[-limit:] if limit else contents
+
+    @property
+    def last_image_description(self) -> Optional[str]:
+        return self.latest(ContextType.IMAGE)
+
+    @property
+    def last_audio_transcription(self) -> Optional[str]:
+        return self.latest(ContextType.AUDIO)
+
+    @property
+    def last_video_analysis(self) -> Optional[str]:
+        return self.latest(ContextType.VIDEO)
+
+    @property
+    def last_research_topic(self) -> Optional[str]:
+        return self.latest(ContextType.RESEARCH)
+
+    @property
+    def last_generated_image_prompt(self) -> Optional[str]:
+        return self.latest(ContextType.IMAGE_GENERATION)
+
+    @property
+    def last_ocr_text(self) -> Optional[str]:
+        return self.latest(ContextType.OCR)
+
+    def to_bytes(self) -> bytes:
+        """Serializa o contexto em formato binário compacto"""
+        ctype_index = _CONTEXT_TYPE_INDEX[self.context_type] if self.context_type else -1
+        timestamp = self.context_timestamp if self.context_timestamp is not None else -1.0
+        parts = [
+            _CONTEXT_HEADER.pack(_BINARY_VERSION, self.conversation_id, timestamp, ctype_index, len(self.history)),
+            _pack_str(self.user_id),
+        ]
+        for ctype, items in self.history.items():
+            parts.append(struct.pack("<BB", _CONTEXT_TYPE_INDEX[ctype], len(items)))
+            for ts, content in items:
+                raw = content.encode("utf-8")
+                parts.append(_CONTEXT_ITEM.pack(ts, len(raw)))
+                parts.append(raw)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MultimodalContext":
+        """Reconstrói contexto serializado por to_bytes"""
+        buffer = memoryview(data)
+        version, conversation_id, timestamp, ctype_index, modalities = _CONTEXT_HEADER.unpack_from(buffer, 0)
+        if version != _BINARY_VERSION:
+            raise ValueError(f"Versão de contexto não suportada: {version}")
+        user_id, offset = _unpack_str(buffer, _CONTEXT_HEADER.size)
+        context = cls(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            context_timestamp=timestamp if timestamp >= 0 else None,
+            context_type=_CONTEXT_TYPES[ctype_index] if ctype_index >= 0 else None,
+        )
+        for _ in range(modalities):
+            type_index, count = struct.unpack_from("<BB", buffer, offset)
+            offset += 2
+            items: Deque[Tuple[float, str]] = deque(maxlen=CONTEXT_HISTORY_SIZE)
+            for _ in range(count):
+                ts, length = _CONTEXT_ITEM.unpack_from(buffer, offset)
+                offset += _CONTEXT_ITEM.size
+                items.append((ts, bytes(buffer[offset:offset + length]).decode("utf-8")))
+                offset += length
+            context.history[_CONTEXT_TYPES[type_index]] = items
+        return context
+
+    @classmethod
+    def from_legacy_dict(cls, data: Dict[str, Any]) -> "MultimodalContext":
+        """Converte o formato JSON antigo (um campo por modalidade)"""
+        timestamp = _iso_to_epoch(data.get("context_timestamp"))
+        context = cls(user_id=data["user_id"], conversation_id=data.get("conversation_id") or 0)
+        for field_name, ctype in _LEGACY_CONTEXT_FIELDS.items():
+            if data.get(field_name):
+                context.add_item(ctype, data[field_name], timestamp)
+        context.context_timestamp = timestamp or None
+        legacy_type = data.get("context_type")
+        context.context_type = ContextType(legacy_type) if legacy_type in _CONTEXT_TYPE_VALUES else None
+        return context
+
+
+@dataclass(slots=True)
 class UserPersonality:
     """Personalidade configurada do usuário"""
     user_id: str
     personality_type: str = "assistente"
     personality_description: str = "Você é um assistente de IA prestativo e útil."
     custom_instructions: Optional[str] = None
-    created_at: str = ""
-    updated_at: str = ""
+    created_at: float = 0.0
+    updated_at: float = 0.0
+
+    def __post_init__(self):
+        # Tipos e descrições pré-definidas se repetem entre milhões de usuários
+        self.personality_type = sys.intern(self.personality_type)
+        self.personality_description = sys.intern(self.personality_description)
+
+    def to_bytes(self) -> bytes:
+        """Serializa a personalidade em formato binário compacto"""
+        return b"".join((
+            _PERSONALITY_HEADER.pack(_BINARY_VERSION, self.created_at, self.updated_at),
+            _pack_str(self.user_id),
+            _pack_str(self.personality_type),
+            _pack_str(self.personality_description),
+            _pack_str(self.custom_instructions),
+        ))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "UserPersonality":
+        """Reconstrói personalidade serializada por to_bytes"""
+        buffer = memoryview(data)
+        version, created_at, updated_at = _PERSONALITY_HEADER.unpack_from(buffer, 0)
+        if version != _BINARY_VERSION:
+            raise ValueError(f"Versão de personalidade não suportada: {version}")
+        offset = _PERSONALITY_HEADER.size
+        user_id, offset = _unpack_str(buffer, offset)
+        personality_type, offset = _unpack_str(buffer, offset)
+        description, offset = _unpack_str(buffer, offset)
+        custom_instructions, offset = _unpack_str(buffer, offset)
+        return cls(
+            user_id=user_id,
+            personality_type=personality_type,
+            personality_description=description,
+            custom_instructions=custom_instructions,
+            created_at=created_at,
+            updated_at=updated_at,
+        )
+
+    @classmethod
+    def from_legacy_dict(cls, data: Dict[str, Any]) -> "UserPersonality":
+        """Converte o formato JSON antigo (timestamps ISO)"""
+        return cls(
+            user_id=data["user_id"],
+            personality_type=data.get("personality_type") or "assistente",
+            personality_description=data.get("personality_description") or "Você é um assistente de IA prestativo e útil.",
+            custom_instructions=data.get("custom_instructions"),
+            created_at=_iso_to_epoch(data.get("created_at")),
+            updated_at=_iso_to_epoch(data.get("updated_at")),
+        )
 
 class MultimodalContextManager:
     """Gerenciador de contexto multimodal"""
@@ -75,93 +322,44 @@ class MultimodalContextManager:
         self.conversation_manager = conversation_manager
         self.context_cache: Dict[str, MultimodalContext] = {}
         self.personality_cache: Dict[str, UserPersonality] = {}
+        self.invalidation_bus: Optional[InvalidationBus] = None
+        # Contextos restaurados do snapshot, decodificados só no primeiro acesso
+        self._snapshot_blobs: Dict[str, bytes] = {}
+        # Usuários sem contexto binário no banco (confirmado pelo pré-carregamento)
+        self._known_without_blob: Set[str] = set()
+        # Usuários sem contexto algum (nem binário nem no formato antigo do histórico)
+        self._known_without_context: Set[str] = set()
         
         logger.info("Gerenciador de contexto multimodal inicializado")
     
     def save_image_context(self, user_id: str, description: str, conversation_id: int):
         """Salva contexto de análise de imagem"""
-        try:
-            context = self._get_or_create_context(user_id, conversation_id)
-            context.last_image_description = description
-            context.context_timestamp = datetime.now().isoformat()
-            context.context_type = "image"
-            
-            self._save_context_to_db(context)
-            self.context_cache[user_id] = context
-            
-            logger.info(f"Contexto de imagem salvo para usuário {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Erro ao salvar contexto de imagem: {e}")
+        self._save_item(user_id, ContextType.IMAGE, description, conversation_id, "imagem")
     
     def save_audio_context(self, user_id: str, transcription: str, conversation_id: int):
         """Salva contexto de transcrição de áudio"""
-        try:
-            context = self._get_or_create_context(user_id, conversation_id)
-            context.last_audio_transcription = transcription
-            context.context_timestamp = datetime.now().isoformat()
-            context.context_type = "audio"
-            
-            self._save_context_to_db(context)
-            self.context_cache[user_id] = context
-            
-            logger.info(f"Contexto de áudio salvo para usuário {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Erro ao salvar contexto de áudio: {e}")
+        self._save_item(user_id, ContextType.AUDIO, transcription, conversation_id, "áudio")
     
     def save_video_context(self, user_id: str, analysis: str, conversation_id: int):
         """Salva contexto de análise de vídeo"""
-        try:
-            context = self._get_or_create_context(user_id, conversation_id)
-            context.last_video_analysis = analysis
-            context.context_timestamp = datetime.now().isoformat()
-            context.context_type = "video"
-            
-            self._save_context_to_db(context)
-            self.context_cache[user_id] = context
-            
-            logger.info(f"Contexto de vídeo salvo para usuário {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Erro ao salvar contexto de vídeo: {e}")
+        self._save_item(user_id, ContextType.VIDEO, analysis, conversation_id, "vídeo")
     
     def save_research_context(self, user_id: str, topic: str, conversation_id: int):
         """Salva contexto de pesquisa"""
-        try:
-            context = self._get_or_create_context(user_id, conversation_id)
-            context.last_research_topic = topic
-            context.context_timestamp = datetime.now().isoformat()
-            context.context_type = "research"
-            
-            self._save_context_to_db(context)
-            self.context_cache[user_id] = context
-            
-            logger.info(f"Contexto de pesquisa salvo para usuário {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Erro ao salvar contexto de pesquisa: {e}")
+        self._save_item(user_id, ContextType.RESEARCH, topic, conversation_id, "pesquisa")
     
     def save_image_generation_context(self, user_id: str, prompt: str, conversation_id: int):
         """Salva contexto de geração de imagem"""
-        try:
-            context = self._get_or_create_context(user_id, conversation_id)
-            context.last_generated_image_prompt = prompt
-            context.context_timestamp = datetime.now().isoformat()
-            context.context_type = "image_generation"
-            
-            self._save_context_to_db(context)
-            self.context_cache[user_id] = context
-            
-            logger.info(f"Contexto de geração de imagem salvo para usuário {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Erro ao salvar contexto de geração de imagem: {e}")
+        self._save_item(user_id, ContextType.IMAGE_GENERATION, prompt, conversation_id, "geração de imagem")
+    
+    def save_ocr_context(self, user_id: str, text: str, conversation_id: int):
+        """Salva texto extraído de imagem por OCR"""
+        self._save_item(user_id, ContextType.OCR, text, conversation_id, "texto de imagem")
     
     def get_context_for_response(self, user_id: str) -> Optional[str]:
         """Obtém contexto relevante para enriquecer resposta"""
         try:
-            context = self.context_cache.get(user_id)
+            context = self._get_cached(user_id)
             if not context:
                 context = self._load_context_from_db(user_id)
                 if context:
@@ -170,78 +368,112 @@ class MultimodalContextManager:
             if not context:
                 return None
             
-            # Verificar se o contexto ainda é relevante (últimas 10 minutos)
+            # Verificar se o contexto ainda é relevante (últimos 10 minutos)
             if context.context_timestamp:
-                context_time = datetime.fromisoformat(context.context_timestamp)
-                if datetime.now() - context_time > timedelta(minutes=10):
+                if time.time() - context.context_timestamp > CONTEXT_MAX_AGE_SECONDS:
                     return None
             
-            # Construir contexto baseado no tipo
-            context_text = ""
-            
-            if context.last_image_description:
-                context_text += f"Contexto de imagem recente: {context.last_image_description}\n"
+            # Construir contexto com o item mais recente de cada modalidade
+            lines = []
+            for ctype in _CONTEXT_TYPES:
+                latest = context.latest(ctype)
+                if latest:
+                    lines.append(f"{_CONTEXT_LABELS[ctype]}: {latest}")
             
-            if context.last_audio_transcription:
-                context_text += f"Transcrição de áudio recente: {context.last_audio_transcription}\n"
-            
-            if context.last_video_analysis:
-                context_text += f"Análise de vídeo recente: {context.last_video_analysis}\n"
-            
-            if context.last_research_topic:
-                context_text += f"Tópico de pesquisa recente: {context.last_research_topic}\n"
-            
-            if context.last_generated_image_prompt:
-                context_text += f"Prompt de imagem recente: {context.last_generated_image_prompt}\n"
-            
-            return context_text.strip() if context_text else None
+            return "\n".join(lines) if lines else None
             
         except Exception as e:
             logger.error(f"Erro ao obter contexto: {e}")
             return None
     
+    def get_recent_items(self, user_id: str, context_type: ContextType, limit: Optional[int] = None) -> List[str]:
+        """Obtém o histórico recente de uma modalidade"""
+        context = self._get_cached(user_id) or self._load_context_from_db(user_id)
+        return context.recent(context_type, limit) if context else []
+    
     def clear_context(self, user_id: str):
         """Limpa contexto do usuário"""
         try:
-            if user_id in self.context_cache:
-                del self.context_cache[user_id]
+            self._snapshot_blobs.pop(user_id, None)
+            self._known_without_blob.discard(user_id)
             
             # Limpar do banco de dados
-            self._clear_context_from_db(user_id)
+            self.context_cache[user_id] = self._clear_context_from_db(user_id)
+            self._publish_change(user_id)
             
             logger.info(f"Contexto limpo para usuário {user_id}")
             
         except Exception as e:
             logger.error(f"Erro ao limpar contexto: {e}")
     
+    def _save_item(self, user_id: str, context_type: ContextType, content: str, conversation_id: int, label: str):
+        """Adiciona item ao ring buffer da modalidade e persiste o contexto"""
+        try:
+            context = self._get_or_create_context(user_id, conversation_id)
+            context.conversation_id = conversation_id
+            context.add_item(context_type, content)
+            
+            self._save_context_to_db(context)
+            self.context_cache[user_id] = context
+            self._known_without_blob.discard(user_id)
+            self._known_without_context.discard(user_id)
+            self._publish_change(user_id)
+            
+            logger.info(f"Contexto de {label} salvo para usuário {user_id}")
+            
+        except Exception as e:
+            logger.error(f"Erro ao salvar contexto de {label}: {e}")
+    
+    def evict(self, user_id: str):
+        """Descarta o contexto em cache (alterado por outro processo)"""
+        self.context_cache.pop(user_id, None)
+        self.personality_cache.pop(user_id, None)
+        self._snapshot_blobs.pop(user_id, None)
+        self._known_without_blob.discard(user_id)
+        self._known_without_context.discard(user_id)
+    
+    def _get_cached(self, user_id: str) -> Optional[MultimodalContext]:
+        """Obtém contexto em cache, decodificando o snapshot se necessário"""
+        context = self.context_cache.get(user_id)
+        if context is None:
+            context_blob = self._snapshot_blobs.pop(user_id, None)
+            if context_blob is not None:
+                context = self.context_cache.setdefault(user_id, MultimodalContext.from_bytes(context_blob))
+        return context
+    
+    def _publish_change(self, user_id: str):
+        """Avisa os demais processos que o contexto do usuário mudou (após o commit)"""
+        # Se a escrita for desfeita, o cache não pode manter o valor não persistido
+        database.on_rollback(lambda: self.evict(user_id))
+        if self.invalidation_bus:
+            bus = self.invalidation_bus
+            database.after_commit(lambda: bus.publish(user_id, SCOPE_CONTEXT))
+    
     def _get_or_create_context(self, user_id: str, conversation_id: int) -> MultimodalContext:
         """Obtém ou cria contexto para o usuário"""
-        if user_id in self.context_cache:
-            return self.context_cache[user_id]
+        context = self._get_cached(user_id)
+        if context:
+            return context
         
-        return MultimodalContext(
-            user_id=user_id,
-            conversation_id=conversation_id,
-            context_timestamp=datetime.now().isoformat()
-        )
+        # Preservar o histórico já persistido antes de adicionar novos itens
+        context = self._load_context_from_db(user_id)
+        if context:
+            return context
+        
+        return MultimodalContext(user_id=user_id, conversation_id=conversation_id)
     
     def _save_context_to_db(self, context: MultimodalContext):
         """Salva contexto no banco de dados"""
         try:
-            # Implementar salvamento no banco de dados
-            # Por enquanto, usar o sistema de persistência existente
-            context_data = asdict(context)
-            context_json = json.dumps(context_data, ensure_ascii=False)
-            
-            # Salvar como mensagem especial no histórico
-            context_message = ChatMessage(
-                timestamp=datetime.now().isoformat(),
-                role="system",
-                content=f"CONTEXT_DATA:{context_json}",
-                message_id=f"ctx_{int(datetime.now().timestamp())}"
-            )
+            context_data = {
+                field_name: context.latest(ctype)
+                for field_name, ctype in _LEGACY_CONTEXT_FIELDS.items()
+            }
+            context_data['context_timestamp'] = context.context_timestamp
+            context_data['context_type'] = context.context_type.value if context.context_type else None
+            context_data['history_blob'] = context.to_bytes()
             
-            self.conversation_manager.add_message(context.user_id, context_message)
+            database.save_multimodal_context(context.user_id, context.conversation_id, context_data)
             
         except Exception as e:
             logger.error(f"Erro ao salvar contexto no DB: {e}")
@@ -249,33 +481,90 @@ class MultimodalContextManager:
     def _load_context_from_db(self, user_id: str) -> Optional[MultimodalContext]:
         """Carrega contexto do banco de dados"""
         try:
-            # Carregar do histórico de mensagens
-            history = self.conversation_manager.get_conversation_history(user_id, limit=50)
-            
-            for message in reversed(history):  # Buscar do mais recente
-                if message.role == "system" and message.content.startswith("CONTEXT_DATA:"):
-                    context_json = message.content.replace("CONTEXT_DATA:", "")
-                    context_data = json.loads(context_json)
-                    
-                    context = MultimodalContext(**context_data)
-                    self.context_cache[user_id] = context
-                    return context
+            if user_id in self._known_without_context:
+                return None
+            if user_id in self._known_without_blob:
+                context_blob = None
+            else:
+                context_blob = database.get_latest_multimodal_context_blob(user_id)
+            if context_blob:
+                context = MultimodalContext.from_bytes(context_blob)
+            else:
+                context = self._load_legacy_context(user_id)
             
-            return None
+            if context:
+                self.context_cache[user_id] = context
+            else:
+                # Evita varrer o histórico de novo a cada consulta sem contexto
+                self._known_without_context.add(user_id)
+            return context
             
         except Exception as e:
             logger.error(f"Erro ao carregar contexto do DB: {e}")
             return None
     
-    def _clear_context_from_db(self, user_id: str):
-        """Limpa contexto do banco de dados"""
+    def _load_legacy_context(self, user_id: str) -> Optional[MultimodalContext]:
+        """Carrega contexto salvo como mensagem de sistema no histórico (formato antigo)"""
+        history = self.conversation_manager.get_conversation_history(user_id, limit=50)
+        
+        for message in reversed(history):  # Buscar do mais recente
+            if message.role != "system":
+                continue
+            if message.content.startswith("CONTEXT_BIN:"):
+                context_blob = message.content[len("CONTEXT_BIN:"):]
+                return MultimodalContext.from_bytes(base64.b64decode(context_blob))
+            if message.content.startswith("CONTEXT_DATA:"):
+                context_json = message.content[len("CONTEXT_DATA:"):]
+                return MultimodalContext.from_legacy_dict(json.loads(context_json))
+        
+        return None
+    
+    def preload(self, contexts: Dict[str, bytes]) -> int:
+        """Popula o cache com contextos carregados em lote (sem sobrescrever)"""
+        loaded = 0
+        for user_id, context_blob in contexts.items():
+            if user_id in self.context_cache:
+                continue
+            try:
+                self.context_cache[user_id] = MultimodalContext.from_bytes(context_blob)
+                loaded += 1
+            except (ValueError, struct.error) as e:
+                logger.warning(f"Contexto inválido ignorado no warm-up ({user_id}): {e}")
+        return loaded
+    
+    def dump_cache(self) -> Iterator[Tuple[str, bytes]]:
+        """Entradas do cache para o snapshot"""
+        for user_id, context in list(self.context_cache.items()):
+            yield user_id, context.to_bytes()
+        # Entradas ainda não acessadas voltam ao snapshot sem recodificação
+        for user_id, context_blob in list(self._snapshot_blobs.items()):
+            if user_id not in self.context_cache:
+                yield user_id, context_blob
+    
+    def load_cache(self, entries: Iterator[Tuple[str, bytes]]) -> int:
+        """Restaura entradas do snapshot (decodificadas sob demanda)"""
+        loaded = 0
+        for user_id, context_blob in entries:
+            if user_id not in self.context_cache:
+                self._snapshot_blobs[user_id] = context_blob
+                loaded += 1
+        return loaded
+    
+    def _clear_context_from_db(self, user_id: str) -> MultimodalContext:
+        """Limpa contexto do banco de dados, deixando um contexto vazio no lugar
+        
+        O contexto vazio serve de marcador: sem ele, a próxima leitura cairia
+        nas mensagens CONTEXT_DATA/CONTEXT_BIN do histórico (formato antigo)
+        e o contexto limpo voltaria.
+        """
+        empty = MultimodalContext(user_id=user_id, conversation_id=USER_STATE_CONVERSATION_ID)
         try:
-            # Implementar limpeza no banco de dados
-            # Por enquanto, apenas limpar cache
-            pass
+            database.clear_multimodal_context(user_id)
+            self._save_context_to_db(empty)
             
         except Exception as e:
             logger.error(f"Erro ao limpar contexto do DB: {e}")
+        return empty
 
 class ConversationStateManager:
     """Gerenciador de estados de conversa"""
@@ -283,6 +572,7 @@ class ConversationStateManager:
     def __init__(self, conversation_manager: ConversationManager):
         self.conversation_manager = conversation_manager
         self.state_cache: Dict[str, ConversationState] = {}
+        self.invalidation_bus: Optional[InvalidationBus] = None
         
         logger.info("Gerenciador de estados de conversa inicializado")
     
@@ -293,6 +583,10 @@ class ConversationStateManager:
             
             # Salvar estado no banco de dados
             self._save_state_to_db(user_id, state)
+            database.on_rollback(lambda: self.evict(user_id))
+            if self.invalidation_bus:
+                bus = self.invalidation_bus
+                database.after_commit(lambda: bus.publish(user_id, SCOPE_STATE))
             
             logger.info(f"Estado definido para usuário {user_id}: {state.value}")
             
@@ -333,18 +627,37 @@ class ConversationStateManager:
         """Verifica se usuário está em estado específico"""
         return self.get_state(user_id) == state
     
+    def evict(self, user_id: str):
+        """Descarta o estado em cache (alterado por outro processo)"""
+        self.state_cache.pop(user_id, None)
+    
+    def preload(self, user_ids: List[str], states: Dict[str, str]) -> int:
+        """Popula o cache com estados carregados em lote (sem sobrescrever)"""
+        loaded = 0
+        for user_id in user_ids:
+            if user_id in self.state_cache:
+                continue
+            try:
+                self.state_cache[user_id] = ConversationState(states.get(user_id, ConversationState.CHAT_GERAL.value))
+                loaded += 1
+            except ValueError:
+                self.state_cache[user_id] = ConversationState.CHAT_GERAL
+        return loaded
+    
+    def dump_cache(self) -> Iterator[Tuple[str, bytes]]:
+        """Entradas do cache para o snapshot"""
+        for user_id, state in list(self.state_cache.items()):
+            yield user_id, state.value.encode("ascii")
+    
+    def load_cache(self, entries: Iterator[Tuple[str, bytes]]) -> int:
+        """Restaura entradas do snapshot (sem sobrescrever)"""
+        states = {user_id: value.decode("ascii") for user_id, value in entries}
+        return self.preload(list(states), states)
+    
     def _save_state_to_db(self, user_id: str, state: ConversationState):
         """Salva estado no banco de dados"""
         try:
-            # Salvar como mensagem especial no histórico
-            state_message = ChatMessage(
-                timestamp=datetime.now().isoformat(),
-                role="system",
-                content=f"STATE_DATA:{state.value}",
-                message_id=f"state_{int(datetime.now().timestamp())}"
-            )
-            
-            self.conversation_manager.add_message(user_id, state_message)
+            database.save_conversation_state(user_id, USER_STATE_CONVERSATION_ID, state.value)
             
         except Exception as e:
             logger.error(f"Erro ao salvar estado no DB: {e}")
@@ -352,7 +665,11 @@ class ConversationStateManager:
     def _load_state_from_db(self, user_id: str) -> Optional[ConversationState]:
         """Carrega estado do banco de dados"""
         try:
-            # Carregar do histórico de mensagens
+            state_value = database.get_conversation_state(user_id, USER_STATE_CONVERSATION_ID)
+            if state_value:
+                return ConversationState(state_value)
+            
+            # Formato antigo: mensagem de sistema no histórico
             history = self.conversation_manager.get_conversation_history(user_id, limit=50)
             
             for message in reversed(history):  # Buscar do mais recente
@@ -372,6 +689,9 @@ class PersonalityManager:
     def __init__(self, conversation_manager: ConversationManager):
         self.conversation_manager = conversation_manager
         self.personality_cache: Dict[str, UserPersonality] = {}
+        self.invalidation_bus: Optional[InvalidationBus] = None
+        # Personalidades restauradas do snapshot, decodificadas só no primeiro acesso
+        self._snapshot_blobs: Dict[str, bytes] = {}
         
         # Personalidades pré-definidas
         self.predefined_personalities = {
@@ -399,16 +719,22 @@ class PersonalityManager:
             else:
                 description = self.predefined_personalities["assistente"]
             
+            now = time.time()
             personality = UserPersonality(
                 user_id=user_id,
                 personality_type=personality_type,
                 personality_description=description,
-                created_at=datetime.now().isoformat(),
-                updated_at=datetime.now().isoformat()
+                created_at=now,
+                updated_at=now
             )
             
             self.personality_cache[user_id] = personality
+            self._snapshot_blobs.pop(user_id, None)
             self._save_personality_to_db(personality)
+            database.on_rollback(lambda: self.evict(user_id))
+            if self.invalidation_bus:
+                bus = self.invalidation_bus
+                database.after_commit(lambda: bus.publish(user_id, SCOPE_PERSONALITY))
             
             logger.info(f"Personalidade definida para usuário {user_id}: {personality_type}")
             
@@ -421,6 +747,10 @@ class PersonalityManager:
             if user_id in self.personality_cache:
                 return self.personality_cache[user_id]
             
+            personality_blob = self._snapshot_blobs.pop(user_id, None)
+            if personality_blob is not None:
+                return self.personality_cache.setdefault(user_id, UserPersonality.from_bytes(personality_blob))
+            
             # Carregar do banco de dados
             personality = self._load_personality_from_db(user_id)
             if personality:
@@ -428,12 +758,13 @@ class PersonalityManager:
                 return personality
             
             # Personalidade padrão
+            now = time.time()
             default_personality = UserPersonality(
                 user_id=user_id,
                 personality_type="assistente",
                 personality_description=self.predefined_personalities["assistente"],
-                created_at=datetime.now().isoformat(),
-                updated_at=datetime.now().isoformat()
+                created_at=now,
+                updated_at=now
             )
             
             self.personality_cache[user_id] = default_personality
@@ -456,39 +787,78 @@ class PersonalityManager:
         """Obtém personalidades disponíveis"""
         return self.predefined_personalities.copy()
     
+    def evict(self, user_id: str):
+        """Descarta a personalidade em cache (alterada por outro processo)"""
+        self.personality_cache.pop(user_id, None)
+        self._snapshot_blobs.pop(user_id, None)
+    
+    def preload(self, personalities: Dict[str, Dict[str, Any]]) -> int:
+        """Popula o cache com personalidades carregadas em lote (sem sobrescrever)"""
+        loaded = 0
+        for user_id, row in personalities.items():
+            if user_id in self.personality_cache:
+                continue
+            self.personality_cache[user_id] = UserPersonality.from_legacy_dict({'user_id': user_id, **row})
+            loaded += 1
+        return loaded
+    
+    def dump_cache(self) -> Iterator[Tuple[str, bytes]]:
+        """Entradas do cache para o snapshot"""
+        for user_id, personality in list(self.personality_cache.items()):
+            yield user_id, personality.to_bytes()
+        # Entradas ainda não acessadas voltam ao snapshot sem recodificação
+        for user_id, personality_blob in list(self._snapshot_blobs.items()):
+            if user_id not in self.personality_cache:
+                yield user_id, personality_blob
+    
+    def load_cache(self, entries: Iterator[Tuple[str, bytes]]) -> int:
+        """Restaura entradas do snapshot (decodificadas sob demanda)"""
+        loaded = 0
+        for user_id, personality_blob in entries:
+            if user_id not in self.personality_cache:
+                self._snapshot_blobs[user_id] = personality_blob
+                loaded += 1
+        return loaded
+    
     def _save_personality_to_db(self, personality: UserPersonality):
         """Salva personalidade no banco de dados"""
         try:
-            # Salvar como mensagem especial no histórico
-            personality_data = asdict(personality)
-            personality_json = json.dumps(personality_data, ensure_ascii=False)
-            
-            personality_message = ChatMessage(
-                timestamp=datetime.now().isoformat(),
-                role="system",
-                content=f"PERSONALITY_DATA:{personality_json}",
-                message_id=f"personality_{int(datetime.now().timestamp())}"
+            database.save_user_personality(
+                personality.user_id,
+                personality.personality_type,
+                personality.personality_description,
+                personality.custom_instructions
             )
             
-            self.conversation_manager.add_message(personality.user_id, personality_message)
-            
         except Exception as e:
             logger.error(f"Erro ao salvar personalidade no DB: {e}")
     
     def _load_personality_from_db(self, user_id: str) -> Optional[UserPersonality]:
         """Carrega personalidade do banco de dados"""
         try:
-            # Carregar do histórico de mensagens
+            row = database.get_user_personality(user_id)
+            if row:
+                personality = UserPersonality.from_legacy_dict({'user_id': user_id, **row})
+                self.personality_cache[user_id] = personality
+                return personality
+            
+            # Formato antigo: mensagem de sistema no histórico
             history = self.conversation_manager.get_conversation_history(user_id, limit=100)
             
             for message in reversed(history):  # Buscar do mais recente
-                if message.role == "system" and message.content.startswith("PERSONALITY_DATA:"):
-                    personality_json = message.content.replace("PERSONALITY_DATA:", "")
-                    personality_data = json.loads(personality_json)
-                    
-                    personality = UserPersonality(**personality_data)
-                    self.personality_cache[user_id] = personality
-                    return personality
+                if message.role != "system":
+                    continue
+                if message.content.startswith("PERSONALITY_BIN:"):
+                    personality_blob = message.content[len("PERSONALITY_BIN:"):]
+                    personality = UserPersonality.from_bytes(base64.b64decode(personality_blob))
+                elif message.content.startswith("PERSONALITY_DATA:"):
+                    personality_json = message.content[len("PERSONALITY_DATA:"):]
+                    personality = UserPersonality.from_legacy_dict(json.loads(personality_json))
+                else:
+                    continue
+                
+                self.personality_cache[user_id] = personality
+                return personality
             
             return None
             
@@ -499,14 +869,109 @@ class PersonalityManager:
 class AdvancedContextSystem:
     """Sistema avançado de contexto integrado"""
     
-    def __init__(self, conversation_manager: ConversationManager):
+    def __init__(self, conversation_manager: ConversationManager, invalidation_bus: Optional[InvalidationBus] = None):
         self.conversation_manager = conversation_manager
         self.context_manager = MultimodalContextManager(conversation_manager)
         self.state_manager = ConversationStateManager(conversation_manager)
         self.personality_manager = PersonalityManager(conversation_manager)
         
+        # Tabelas de estado, personalidade e contexto
+        database.initialize_db()
+        
+        # Coerência de cache entre processos
+        self.invalidation_bus = invalidation_bus
+        if invalidation_bus:
+            self.context_manager.invalidation_bus = invalidation_bus
+            self.state_manager.invalidation_bus = invalidation_bus
+            self.personality_manager.invalidation_bus = invalidation_bus
+            invalidation_bus.subscribe(self.invalidate_user)
+        
         logger.info("Sistema avançado de contexto inicializado")
     
+    def invalidate_user(self, user_id: str, scope: str = SCOPE_ALL):
+        """Descarta entradas em cache do usuário após alteração externa"""
+        if scope in (SCOPE_CONTEXT, SCOPE_ALL):
+            self.context_manager.evict(user_id)
+        if scope in (SCOPE_STATE, SCOPE_ALL):
+            self.state_manager.evict(user_id)
+        if scope in (SCOPE_PERSONALITY, SCOPE_ALL):
+            self.personality_manager.evict(user_id)
+    
+    def register_snapshot_sections(self, snapshotter: CacheSnapshotter):
+        """Registra os caches do sistema no snapshot binário"""
+        snapshotter.register_section("state", self.state_manager.dump_cache, self.state_manager.load_cache)
+        snapshotter.register_section(
+            "personality", self.personality_manager.dump_cache, self.personality_manager.load_cache
+        )
+        snapshotter.register_section("context", self.context_manager.dump_cache, self.context_manager.load_cache)
+    
+    def warm_up(self, max_users: int = 1000, time_budget: float = 5.0, batch_size: int = 200) -> Dict[str, int]:
+        """Pré-carrega os caches dos usuários ativos mais recentes
+        
+        Usa três consultas por lote e interrompe ao estourar o orçamento de
+        tempo. Entradas já carregadas pelo tráfego ao vivo são preservadas.
+        """
+        deadline = time.monotonic() + time_budget
+        totals = {"users": 0, "states": 0, "personalities": 0, "contexts": 0}
+        
+        try:
+            user_ids = database.get_recently_active_users(max_users)
+            since = time.time() - CONTEXT_MAX_AGE_SECONDS
+            
+            for start in range(0, len(user_ids), batch_size):
+                if time.monotonic() > deadline:
+                    logger.warning(f"Warm-up interrompido pelo orçamento de tempo ({time_budget}s)")
+                    break
+                
+                batch = user_ids[start:start + batch_size]
+                states = database.get_conversation_states_bulk(batch, USER_STATE_CONVERSATION_ID)
+                personalities = database.get_user_personalities_bulk(batch)
+                contexts = database.get_multimodal_contexts_bulk(batch, since)
+                
+                totals["users"] += len(batch)
+                totals["states"] += self.state_manager.preload(batch, states)
+                totals["personalities"] += self.personality_manager.preload(personalities)
+                totals["contexts"] += self.context_manager.preload(contexts)
+            
+            logger.info(f"Warm-up de cache concluído: {totals}")
+            
+        except Exception as e:
+            logger.error(f"Erro no warm-up de cache: {e}")
+        
+        return totals
+    
+    def prefetch_user(self, user_id: str) -> bool:
+        """Carrega numa única consulta o que faltar no cache para o usuário
+        
+        Retorna True se foi ao banco. Usuários já em cache não geram leitura.
+        """
+        need_state = user_id not in self.state_manager.state_cache
+        need_personality = (user_id not in self.personality_manager.personality_cache
+                            and user_id not in self.personality_manager._snapshot_blobs)
+        need_context = (user_id not in self.context_manager.context_cache
+                        and user_id not in self.context_manager._snapshot_blobs)
+        if not (need_state or need_personality or need_context):
+            return False
+        
+        try:
+            bundle = database.get_user_bundle(user_id, USER_STATE_CONVERSATION_ID)
+            if need_state and bundle["state"] is not None:
+                self.state_manager.preload([user_id], {user_id: bundle["state"]})
+            if need_personality and bundle["personality"]:
+                self.personality_manager.preload({user_id: bundle["personality"]})
+            if need_context and bundle["context_blob"]:
+                self.context_manager.preload({user_id: bundle["context_blob"]})
+            elif need_context:
+                self.context_manager._known_without_blob.add(user_id)
+        except Exception as e:
+            logger.error(f"Erro ao pré-carregar usuário {user_id}: {e}")
+        return True
+    
+    def close(self):
+        """Encerra recursos em segundo plano"""
+        if self.invalidation_bus:
+            self.invalidation_bus.stop()
+    
     def enrich_message_with_context(self, user_id: str, message: str) -> str:
         """Enriquece mensagem com contexto multimodal"""
         try:
@@ -551,6 +1016,8 @@ class AdvancedContextSystem:
                 self.context_manager.save_research_context(user_id, content, conversation_id)
             elif interaction_type == "image_generation":
                 self.context_manager.save_image_generation_context(user_id, content, conversation_id)
+            elif interaction_type == "ocr":
+                self.context_manager.save_ocr_context(user_id, content, conversation_id)
             
             logger.info(f"Interação multimodal processada: {interaction_type} para usuário {user_id}")
             
@@ -585,11 +1052,18 @@ class AdvancedContextSystem:
 # Instância global do sistema
 advanced_context_system = None
 
-def get_advanced_context_system(conversation_manager: ConversationManager = None) -> AdvancedContextSystem:
-    """Obtém instância global do sistema de contexto avançado"""
+def get_advanced_context_system(conversation_manager: ConversationManager = None,
+                                invalidation_bus: Optional[InvalidationBus] = None) -> AdvancedContextSystem:
+    """Obtém instância global do sistema de contexto avançado
+    
+    Sem canal explícito, o canal de invalidação é criado a partir de
+    cache.invalidation na configuração.
+    """
     global advanced_context_system
     
     if advanced_context_system is None and conversation_manager:
-        advanced_context_system = AdvancedContextSystem(conversation_manager)
+        if invalidation_bus is None:
+            invalidation_bus = create_invalidation_bus(load_config())
+        advanced_context_system = AdvancedContextSystem(conversation_manager, invalidation_bus)
     
     return advanced_context_system
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline de Transcrição de Áudio
+================================
+
+Transcreve áudios do Telegram (OGG/Opus, MP3, M4A...) em trechos paralelos,
+para que a latência dependa pouco da duração do áudio.
+
+Funcionalidades:
+- Decodificação em streaming pelo ffmpeg para PCM mono 16 kHz (s16le)
+- Divisão em trechos nas pausas (energia abaixo do limiar), com tamanho
+  mínimo e máximo por trecho
+- Transcrição dos trechos em paralelo (concorrência limitada) à medida que
+  o ffmpeg decodifica, costurada na ordem original
+- Transcrição parcial entregue progressivamente ao chamador
+- Resultado em cache no api_cache pelo sha256 do arquivo
+
+Características:
+- Trechos que falham viram "[trecho inaudível]" e o resultado não é cacheado
+- Cancelar a transcrição encerra o ffmpeg e as chamadas pendentes
+"""
+
+import io
+import wave
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+
+import numpy as np
+
+import database
+from media_store import MediaRef
+from metrics import Metrics, get_metrics
+
+logger = logging.getLogger('gemini_bot')
+
+_KEY_PREFIX = "audio:"
+
+SAMPLE_RATE = 16000
+_BYTES_PER_SAMPLE = 2
+_FRAME_SAMPLES = SAMPLE_RATE * 30 // 1000  # quadros de 30 ms para medir energia
+_READ_BYTES = SAMPLE_RATE * _BYTES_PER_SAMPLE // 2  # meio segundo por leitura
+
+UNINTELLIGIBLE = "[trecho inaudível]"
+
+TRANSCRIBE_PROMPT = (
+    "Transcreva literalmente a fala deste trecho de áudio, no idioma original. "
+    "Responda apenas com a transcrição, sem comentários. Se não houver fala, responda vazio."
+)
+
+
+class AudioDecodeError(Exception):
+    """ffmpeg não conseguiu decodificar o áudio"""
+
+
+class SilenceChunker:
+    """Divide PCM contínuo em trechos, cortando no meio das pausas"""
+
+    def __init__(self, min_chunk_seconds: float = 8.0, max_chunk_seconds: float = 30.0,
+                 min_silence_ms: int = 400, silence_threshold_db: float = -40.0):
+        self.min_chunk = int(min_chunk_seconds * SAMPLE_RATE)
+        self.max_chunk = int(max_chunk_seconds * SAMPLE_RATE)
+        self.silence_frames = max(1, min_silence_ms * SAMPLE_RATE // 1000 // _FRAME_SAMPLES)
+        self.threshold = 32768 * 10 ** (silence_threshold_db / 20)
+        self._samples = np.zeros(0, dtype=np.int16)
+
+    def feed(self, samples: np.ndarray) -> List[np.ndarray]:
+        """Acrescenta amostras e retorna os trechos já fechados"""
+        self._samples = np.concatenate((self._samples, samples))
+        chunks = []
+        while len(self._samples) >= self.min_chunk:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            chunks.append(self._samples[:cut])
+            self._samples = self._samples[cut:]
+        return chunks
+
+    def flush(self) -> Optional[np.ndarray]:
+        """Trecho final (o que sobrou ao fim do áudio)"""
+        remaining, self._samples = self._samples, np.zeros(0, dtype=np.int16)
+        return remaining if len(remaining) else None
+
+    def _find_cut(self) -> Optional[int]:
+        # Energia (RMS) por quadro a partir do tamanho mínimo
+        start = self.min_chunk // _FRAME_SAMPLES
+        end = min(len(self._samples), self.max_chunk) // _FRAME_SAMPLES
+        if end > start:
+            frames = self._samples[start * _FRAME_SAMPLES:end * _FRAME_SAMPLES].astype(np.float32)
+            rms = np.sqrt(np.mean(frames.reshape(-1, _FRAME_SAMPLES) ** 2, axis=1))
+            silent = rms < self.threshold
+
+            # Primeira pausa longa o bastante: corta no meio dela
+            run = 0
+            for index, is_silent in enumerate(silent):
+                run = run + 1 if is_silent else 0
+                if run >= self.silence_frames:
+                    middle = start + index - run // 2
+                    return middle * _FRAME_SAMPLES
+
+        if len(self._samples) >= self.max_chunk:
+            return self.max_chunk
+        return None
+
+
+def pcm_to_wav(samples: np.ndarray) -> bytes:
+    """Empacota PCM mono 16 kHz em WAV (em memória)"""
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(_BYTES_PER_SAMPLE)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.astype("<i2").tobytes())
+    return output.getvalue()
+
+
+class AudioPipeline:
+    """Transcrição em trechos paralelos com cache por conteúdo"""
+
+    def __init__(self, model_executor: Any, max_parallel: int = 4, min_chunk_seconds: float = 8.0,
+                 max_chunk_seconds: float = 30.0, min_silence_ms: int = 400,
+                 silence_threshold_db: float = -40.0, max_duration_seconds: float = 1800,
+                 ttl_seconds: int = 30 * 24 * 3600, ffmpeg_path: str = "ffmpeg",
+                 metrics: Optional[Metrics] = None):
+        self.model_executor = model_executor
+        self.max_parallel = max_parallel
+        self.min_chunk_seconds = min_chunk_seconds
+        self.max_chunk_seconds = max_chunk_seconds
+        self.min_silence_ms = min_silence_ms
+        self.silence_threshold_db = silence_threshold_db
+        self.max_duration_seconds = max_duration_seconds
+        self.ttl_seconds = ttl_seconds
+        self.ffmpeg_path = ffmpeg_path
+        self.metrics = metrics or get_metrics()
+
+    async def transcribe(self, media: MediaRef,
+                         on_partial: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
+        """Transcrição completa; on_partial recebe cada trecho, na ordem, assim que disponível"""
+        cached = self._get_cached(media.sha256)
+        if cached is not None:
+            if on_partial:
+                await on_partial(cached)
+            return cached
+
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        pending: asyncio.Queue = asyncio.Queue()
+        producer = asyncio.create_task(self._decode_and_dispatch(media.path, semaphore, pending))
+
+        texts: List[str] = []
+        complete = True
+        try:
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                text = await task
+                if text is None:
+                    complete = False
+                    text = UNINTELLIGIBLE
+                if text:
+                    texts.append(text)
+                    if on_partial:
+                        await on_partial(text + " ")
+            # Propaga erro de decodificação, se houver
+            await producer
+        finally:
+            producer.cancel()
+            while not pending.empty():
+                task = pending.get_nowait()
+                if task is not None:
+                    task.cancel()
+
+        transcript = " ".join(texts).strip()
+        self.metrics.increment("audio.transcribed")
+        if complete:
+            self._put(media.sha256, transcript)
+        return transcript
+
+    async def _decode_and_dispatch(self, path: str, semaphore: asyncio.Semaphore, pending: asyncio.Queue):
+        """Lê o PCM do ffmpeg e agenda a transcrição de cada trecho fechado"""
+        chunker = SilenceChunker(self.min_chunk_seconds, self.max_chunk_seconds,
+                                 self.min_silence_ms, self.silence_threshold_db)
+        max_bytes = int(self.max_duration_seconds * SAMPLE_RATE) * _BYTES_PER_SAMPLE
+        process = await asyncio.create_subprocess_exec(
+            self.ffmpeg_path, "-nostdin", "-loglevel", "error", "-i", path,
+            "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        stderr_task = asyncio.create_task(process.stderr.read())
+
+        def dispatch(samples: np.ndarray):
+            self.metrics.increment("audio.chunks")
+            pending.put_nowait(asyncio.create_task(self._transcribe_chunk(samples, semaphore)))
+
+        try:
+            total = 0
+            leftover = b""
+            while total < max_bytes:
+                data = await process.stdout.read(_READ_BYTES)
+                if not data:
+                    break
+                total += len(data)
+                data = leftover + data
+                usable = len(data) - len(data) % _BYTES_PER_SAMPLE
+                leftover = data[usable:]
+                for chunk in chunker.feed(np.frombuffer(data[:usable], dtype="<i2")):
+                    dispatch(chunk)
+
+            if total >= max_bytes:
+                logger.warning(f"Áudio truncado em {self.max_duration_seconds:.0f}s")
+                process.kill()
+            returncode = await process.wait()
+            stderr = (await stderr_task).decode("utf-8", "replace").strip()
+            if returncode != 0 and total < max_bytes:
+                raise AudioDecodeError(stderr or f"ffmpeg terminou com código {returncode}")
+
+            last = chunker.flush()
+            if last is not None:
+                dispatch(last)
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr_task.cancel()
+            pending.put_nowait(None)
+
+    async def _transcribe_chunk(self, samples: np.ndarray, semaphore: asyncio.Semaphore) -> Optional[str]:
+        """Texto do trecho (None em caso de falha)"""
+        async with semaphore:
+            try:
+                wav = await asyncio.to_thread(pcm_to_wav, samples)
+                text = await self.model_executor.generate_content(
+                    [TRANSCRIBE_PROMPT, {"mime_type": "audio/wav", "data": wav}]
+                )
+                return (text or "").strip()
+            except Exception as e:
+                logger.error(f"Erro ao transcrever trecho de áudio: {e}")
+                self.metrics.increment("audio.chunk_failures")
+                return None
+
+    def _get_cached(self, sha256: str) -> Optional[str]:
+        try:
+            cached = database.cache_get(_KEY_PREFIX + sha256)
+            if cached is not None:
+                self.metrics.increment("audio.cache_hits")
+                return cached.get("transcript")
+        except Exception as e:
+            logger.error(f"Erro ao consultar cache de transcrições: {e}")
+        return None
+
+    def _put(self, sha256: str, transcript: str):
+        try:
+            database.cache_set(_KEY_PREFIX + sha256, {"transcript": transcript}, ttl_seconds=self.ttl_seconds)
+        except Exception as e:
+            logger.error(f"Erro ao salvar transcrição no cache: {e}")
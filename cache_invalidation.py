@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Invalidação de Cache entre Processos
+====================================
+
+Este módulo implementa um canal de invalidação que avisa todos os processos
+(réplicas do bot, workers Celery, scripts administrativos) quando os dados
+de um usuário mudam, para que os caches em memória do sistema de contexto
+sejam descartados.
+
+Backends:
+- local: barramento em memória (testes e processo único)
+- sqlite: tabela de notificações consultada via PRAGMA data_version
+- redis: pub/sub em um canal compartilhado
+
+Características:
+- Eventos por usuário com escopo (contexto, estado, personalidade)
+- Eventos do próprio processo são ignorados (o cache local já está correto)
+- Escuta em thread daemon, sem bloquear o event loop do bot
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger('gemini_bot')
+
+# Escopos de invalidação
+SCOPE_CONTEXT = "context"
+SCOPE_STATE = "state"
+SCOPE_PERSONALITY = "personality"
+SCOPE_ALL = "all"
+
+InvalidationCallback = Callable[[str, str], None]
+
+
+class InvalidationBus:
+    """Interface base dos canais de invalidação"""
+
+    def __init__(self):
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._subscribers: List[InvalidationCallback] = []
+
+    def subscribe(self, callback: InvalidationCallback):
+        """Registra callback chamado com (user_id, scope) a cada evento remoto"""
+        self._subscribers.append(callback)
+
+    def publish(self, user_id: str, scope: str = SCOPE_ALL):
+        """Publica evento de alteração para os demais processos"""
+        raise NotImplementedError
+
+    def start(self):
+        """Inicia a escuta de eventos"""
+
+    def stop(self):
+        """Encerra a escuta de eventos"""
+
+    def _dispatch(self, user_id: str, scope: str, origin: str):
+        """Entrega evento recebido aos callbacks registrados"""
+        if origin == self.origin:
+            return
+        for callback in self._subscribers:
+            try:
+                callback(user_id, scope)
+            except Exception as e:
+                logger.error(f"Erro ao aplicar invalidação de cache: {e}")
+
+
+class LocalInvalidationBus(InvalidationBus):
+    """Canal em memória; instâncias no mesmo hub simulam processos distintos"""
+
+    _default_hub: List["LocalInvalidationBus"] = []
+
+    def __init__(self, hub: Optional[List["LocalInvalidationBus"]] = None):
+        super().__init__()
+        self.hub = self._default_hub if hub is None else hub
+
+    def start(self):
+        if self not in self.hub:
+            self.hub.append(self)
+
+    def stop(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+    def publish(self, user_id: str, scope: str = SCOPE_ALL):
+        for bus in list(self.hub):
+            bus._dispatch(user_id, scope, self.origin)
+
+
+class SQLiteInvalidationBus(InvalidationBus):
+    """Canal baseado em tabela de notificações no SQLite
+
+    O listener só consulta a tabela quando PRAGMA data_version indica que
+    outra conexão gravou no banco, então o custo em repouso é mínimo.
+    """
+
+    def __init__(self, db_file: str, poll_interval: float = 0.5, retention_seconds: int = 3600):
+        super().__init__()
+        self.db_file = db_file
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_id = 0
+
+    def start(self):
+        if self._thread:
+            return
+        with sqlite3.connect(self.db_file) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS cache_invalidations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    origin TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations")
+            self._last_id = cursor.fetchone()[0]
+            conn.commit()
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._listen, name="cache-invalidation-sqlite", daemon=True)
+        self._thread.start()
+        logger.info("Invalidação de cache via SQLite iniciada")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.poll_interval * 4)
+            self._thread = None
+
+    def publish(self, user_id: str, scope: str = SCOPE_ALL):
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                conn.execute(
+                    "INSERT INTO cache_invalidations (user_id, scope, origin, created_at) VALUES (?, ?, ?, ?)",
+                    (user_id, scope, self.origin, time.time()),
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Erro ao publicar invalidação de cache: {e}")
+
+    def _listen(self):
+        """Loop do listener: verifica data_version e lê eventos novos"""
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        last_version = None
+        last_prune = time.time()
+        try:
+            while not self._stop_event.wait(self.poll_interval):
+                try:
+                    version = conn.execute("PRAGMA data_version").fetchone()[0]
+                    if version != last_version:
+                        last_version = version
+                        self._read_events(conn)
+
+                    if time.time() - last_prune > self.retention_seconds:
+                        last_prune = time.time()
+                        conn.execute(
+                            "DELETE FROM cache_invalidations WHERE created_at < ?",
+                            (time.time() - self.retention_seconds,),
+                        )
+                        conn.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Erro no listener de invalidação SQLite: {e}")
+        finally:
+            conn.close()
+
+    def _read_events(self, conn: sqlite3.Connection):
+        rows = conn.execute(
+            "SELECT id, user_id, scope, origin FROM cache_invalidations WHERE id > ? ORDER BY id",
+            (self._last_id,),
+        ).fetchall()
+        for event_id, user_id, scope, origin in rows:
+            self._last_id = event_id
+            self._dispatch(user_id, scope, origin)
+
+
+class RedisInvalidationBus(InvalidationBus):
+    """Canal baseado em pub/sub do Redis"""
+
+    def __init__(self, redis_url: str, channel: str = "gemini_bot:cache_invalidation"):
+        super().__init__()
+        import redis  # dependência opcional, só exigida com este backend
+
+        self.channel = channel
+        self._client = redis.Redis.from_url(redis_url)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._listen, name="cache-invalidation-redis", daemon=True)
+        self._thread.start()
+        logger.info(f"Invalidação de cache via Redis iniciada (canal {self.channel})")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def publish(self, user_id: str, scope: str = SCOPE_ALL):
+        try:
+            payload = json.dumps({"u": user_id, "s": scope, "o": self.origin})
+            self._client.publish(self.channel, payload)
+        except Exception as e:
+            logger.error(f"Erro ao publicar invalidação de cache: {e}")
+
+    def _listen(self):
+        """Loop do listener com reconexão em caso de falha"""
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                backoff = 1.0
+                while not self._stop_event.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message:
+                        continue
+                    event = json.loads(message["data"])
+                    self._dispatch(event["u"], event["s"], event["o"])
+            except Exception as e:
+                logger.error(f"Erro no listener de invalidação Redis: {e}")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+def create_invalidation_bus(config: Optional[Dict[str, Any]] = None) -> Optional[InvalidationBus]:
+    """Cria e inicia o canal configurado em cache.invalidation"""
+    settings = ((config or {}).get("cache") or {}).get("invalidation") or {}
+    backend = settings.get("backend", "none")
+
+    try:
+        if backend == "local":
+            bus = LocalInvalidationBus()
+        elif backend == "sqlite":
+            from database import DB_FILE
+            bus = SQLiteInvalidationBus(
+                settings.get("db_file", DB_FILE),
+                poll_interval=float(settings.get("poll_interval_seconds", 0.5)),
+                retention_seconds=int(settings.get("retention_seconds", 3600)),
+            )
+        elif backend == "redis":
+            redis_url = settings.get("redis_url") or os.getenv("REDIS_URL") or "redis://localhost:6379/0"
+            bus = RedisInvalidationBus(redis_url, settings.get("channel", "gemini_bot:cache_invalidation"))
+        else:
+            return None
+
+        bus.start()
+        return bus
+
+    except Exception as e:
+        logger.error(f"Erro ao iniciar invalidação de cache ({backend}): {e}")
+        return None
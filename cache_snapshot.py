@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot Binário dos Caches em Memória
+======================================
+
+Este módulo grava e carrega um snapshot versionado dos caches em memória
+(estado, personalidade, contexto e demais estruturas registradas), para que
+um reinício volte à velocidade normal sem reconstruir tudo a partir do banco.
+
+Formato do arquivo:
+- Cabeçalho fixo: magic, versão, nº de seções, tamanho do payload,
+  instante de criação, CRC32 do payload e flags (gravado no encerramento)
+- Payload: seções nomeadas com pares (chave, valor binário)
+
+Características:
+- Escrita atômica (arquivo temporário + os.replace)
+- Leitura via mmap, validando versão, tamanho e checksum
+- Qualquer inconsistência descarta o snapshot (o chamador volta ao banco)
+- Gravação periódica em thread daemon e ao encerrar o bot
+- Snapshot mais antigo que a última escrita no banco (de qualquer processo,
+  via is_current) é descartado
+- O snapshot periódico só é carregado quando is_current confirma que o
+  banco não mudou depois dele; sem is_current, apenas o do encerramento
+  gracioso é aceito
+"""
+
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger('gemini_bot')
+
+SNAPSHOT_MAGIC = b"GBCS"
+SNAPSHOT_VERSION = 2
+
+# Flags do cabeçalho
+FLAG_FINAL = 0x1
+
+_HEADER = struct.Struct("<4sHHQdIH")
+_SECTION = struct.Struct("<HI")
+_KEY_LEN = struct.Struct("<H")
+_VALUE_LEN = struct.Struct("<I")
+
+SnapshotEntries = Iterable[Tuple[str, bytes]]
+DumpFunction = Callable[[], SnapshotEntries]
+LoadFunction = Callable[[Iterator[Tuple[str, bytes]]], int]
+
+
+class SnapshotError(Exception):
+    """Snapshot ausente, incompatível ou corrompido"""
+
+
+class CacheSnapshotter:
+    """Grava e restaura seções de cache registradas"""
+
+    def __init__(self, path: str, max_age_seconds: Optional[float] = None,
+                 is_current: Optional[Callable[[float], bool]] = None):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        # is_current(created_at): False se o banco mudou depois do snapshot
+        self.is_current = is_current
+        self._sections: Dict[str, Tuple[DumpFunction, LoadFunction]] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register_section(self, name: str, dump: DumpFunction, load: LoadFunction):
+        """Registra uma seção: dump() gera (chave, bytes), load(entries) retorna o total carregado"""
+        self._sections[name] = (dump, load)
+
+    def save(self, final: bool = False) -> bool:
+        """Grava snapshot de todas as seções de forma atômica
+
+        final=True marca o snapshot do encerramento gracioso; os periódicos
+        só são aceitos por load() quando is_current está configurado.
+        """
+        with self._lock:
+            started = time.monotonic()
+            tmp_path = f"{self.path}.tmp"
+            try:
+                payload_parts = []
+                total_entries = 0
+                for name, (dump, _) in self._sections.items():
+                    name_raw = name.encode("utf-8")
+                    entries = []
+                    for key, value in dump():
+                        key_raw = key.encode("utf-8")
+                        entries.append(_KEY_LEN.pack(len(key_raw)))
+                        entries.append(key_raw)
+                        entries.append(_VALUE_LEN.pack(len(value)))
+                        entries.append(value)
+                    count = len(entries) // 4
+                    total_entries += count
+                    payload_parts.append(_SECTION.pack(len(name_raw), count))
+                    payload_parts.append(name_raw)
+                    payload_parts.extend(entries)
+
+                payload = b"".join(payload_parts)
+                header = _HEADER.pack(
+                    SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(self._sections),
+                    len(payload), time.time(), zlib.crc32(payload), FLAG_FINAL if final else 0
+                )
+
+                with open(tmp_path, "wb") as f:
+                    f.write(header)
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+
+                elapsed = time.monotonic() - started
+                logger.info(f"Snapshot de cache gravado: {total_entries} entradas em {elapsed:.2f}s")
+                return True
+
+            except Exception as e:
+                logger.error(f"Erro ao gravar snapshot de cache: {e}")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return False
+
+    def load(self) -> Dict[str, int]:
+        """Carrega o snapshot nas seções registradas
+
+        Retorna o total carregado por seção; dicionário vazio quando o
+        snapshot não existe ou é descartado.
+        """
+        started = time.monotonic()
+        try:
+            loaded = self._load()
+            elapsed = time.monotonic() - started
+            logger.info(f"Snapshot de cache carregado em {elapsed:.2f}s: {loaded}")
+            return loaded
+        except FileNotFoundError:
+            logger.info("Nenhum snapshot de cache encontrado")
+        except SnapshotError as e:
+            logger.warning(f"Snapshot de cache descartado: {e}")
+        except Exception as e:
+            logger.error(f"Erro ao carregar snapshot de cache: {e}")
+        return {}
+
+    def _load(self) -> Dict[str, int]:
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise SnapshotError("arquivo truncado")
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, version, sections, payload_len, created_at, checksum, flags = _HEADER.unpack_from(mm, 0)
+                if magic != SNAPSHOT_MAGIC:
+                    raise SnapshotError("magic inválido")
+                if version != SNAPSHOT_VERSION:
+                    raise SnapshotError(f"versão {version} incompatível (esperada {SNAPSHOT_VERSION})")
+                if _HEADER.size + payload_len != size:
+                    raise SnapshotError("tamanho do payload não confere")
+                if self.max_age_seconds and time.time() - created_at > self.max_age_seconds:
+                    raise SnapshotError("snapshot expirado")
+                if not flags & FLAG_FINAL and self.is_current is None:
+                    # Sem como conferir o banco, o periódico pode estar atrás de escritas anteriores à queda
+                    raise SnapshotError("snapshot periódico (encerramento não foi gracioso)")
+                if self.is_current and not self.is_current(created_at):
+                    raise SnapshotError("banco alterado depois do snapshot")
+
+                with memoryview(mm) as view, view[_HEADER.size:] as payload:
+                    if zlib.crc32(payload) != checksum:
+                        raise SnapshotError("checksum inválido")
+
+                loaded: Dict[str, int] = {}
+                offset = _HEADER.size
+                for _ in range(sections):
+                    name_len, count = _SECTION.unpack_from(mm, offset)
+                    offset += _SECTION.size
+                    name = mm[offset:offset + name_len].decode("utf-8")
+                    offset += name_len
+
+                    entries, offset = self._read_entries(mm, offset, count)
+                    section = self._sections.get(name)
+                    if section is None:
+                        logger.warning(f"Seção de snapshot desconhecida ignorada: {name}")
+                        continue
+                    loaded[name] = section[1](iter(entries))
+                return loaded
+
+    @staticmethod
+    def _read_entries(mm: mmap.mmap, offset: int, count: int) -> Tuple[list, int]:
+        """Lê `count` pares (chave, valor) a partir de offset"""
+        entries = []
+        key_unpack = _KEY_LEN.unpack_from
+        value_unpack = _VALUE_LEN.unpack_from
+        for _ in range(count):
+            (key_len,) = key_unpack(mm, offset)
+            offset += _KEY_LEN.size
+            key = mm[offset:offset + key_len].decode("utf-8")
+            offset += key_len
+            (value_len,) = value_unpack(mm, offset)
+            offset += _VALUE_LEN.size
+            entries.append((key, mm[offset:offset + value_len]))
+            offset += value_len
+        return entries, offset
+
+    def start_periodic(self, interval_seconds: float):
+        """Grava snapshots periodicamente em thread daemon"""
+        if self._thread or interval_seconds <= 0:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._periodic_loop, args=(interval_seconds,), name="cache-snapshot", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Interrompe a gravação periódica"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _periodic_loop(self, interval_seconds: float):
+        while not self._stop_event.wait(interval_seconds):
+            self.save()
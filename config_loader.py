@@ -15,6 +15,24 @@ def load_config() -> Dict[str, Any]:
             "app_name": "gemini-bot",
             "env": env,
             "logging": {"level": "INFO", "log_file": "bot.log"},
-            "telegram": {"admin_user_ids": []},
-            "cache": {"ttl_seconds": 3600},
+            "telegram": {"admin_user_ids": [], "mode": "polling"},
+            "cache": {"ttl_seconds": 3600, "invalidation": {"backend": "none"}},
+            "warmup": {"enabled": True, "max_users": 1000, "time_budget_seconds": 5.0, "batch_size": 200},
+            "snapshot": {"enabled": False, "path": "cache_snapshot.bin", "interval_seconds": 300},
+            "model": {"max_concurrency": 4, "timeout_seconds": 60, "max_queue": 100},
+            "streaming": {"enabled": False, "edit_interval_seconds": 1.0},
+            "coalescing": {"enabled": False, "window_ms": 800, "max_wait_ms": 3000, "max_batch": 5},
+            "generation": {"supersede_policy": "cancel"},
+            "admission": {"enabled": False},
+            "response_cache": {"enabled": False},
+            "updates": {"workers": 1, "max_pending": 1000},
+            "sessions": {"idle_timeout_seconds": 1800, "max_sessions": 100000},
+            "outbound": {"global_rate_per_second": 30, "private_chat_rate_per_second": 1.0, "group_chat_rate_per_minute": 20},
+            "http_client": {"pool_maxsize": 16, "connect_timeout_seconds": 5, "read_timeout_seconds": 15, "max_retries": 3},
+            "images": {"min_side": 768, "max_side": 1024, "max_hash_distance": 6},
+            "media_store": {"path": "media_cache", "max_mb": 2048, "max_file_mb": 20},
+            "audio": {"max_parallel_chunks": 4, "max_chunk_seconds": 30},
+            "video": {"frame_budget": 8, "sample_fps": 2.0, "scene_threshold": 0.35},
+            "tasks": {"backend": "auto", "local": {"db_path": "tasks.db", "workers": 1}},
+            "research": {"result_ttl_seconds": 3600},
         }
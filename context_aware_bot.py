@@ -22,10 +22,12 @@ Características:
 """
 
 import asyncio
+import functools
 import logging
 import os
+import threading
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -34,6 +36,7 @@ from telegram.ext import (
 )
 
 # Importar módulos do projeto
+import database
 from config_manager import get_gemini_handler, ConfigurationError
 from error_handler import validate_input, sanitize_input
 from conversation_persistence import (
@@ -44,7 +47,27 @@ from advanced_context_system import (
 )
 from interactive_keyboards import get_keyboard_manager
 from logging_setup import setup_logging
-from tasks.heavy_tasks import clone_voice_task, research_report_task, generate_image_task
+from config_loader import load_config
+from cache_snapshot import CacheSnapshotter
+from model_executor import ModelExecutor, ModelOverloadedError, ModelTimeoutError
+from streaming_reply import StreamingReply
+from message_coalescer import MessageCoalescer
+from generation_tracker import Generation, GenerationTracker
+from response_cache import ResponseCache
+from update_processor import ChatOrderedUpdateProcessor
+from session_registry import SessionRegistry
+from outbound_sender import OutboundSender
+from image_pipeline import ImagePipeline
+from ocr_stage import OcrStage
+from audio_pipeline import AudioPipeline
+from video_pipeline import VideoPipeline
+from media_store import MediaTooLargeError, get_media_store
+from admission_control import (
+    AdmissionController, KIND_AUDIO, KIND_IMAGE, KIND_TASK, KIND_TEXT, KIND_VIDEO, REASON_GLOBAL_LIMIT, REASON_SHED
+)
+from metrics import get_metrics
+from tasks.backend import get_task_backend, shutdown_task_backend
+from tasks.heavy_tasks import clone_voice_task, generate_image_task, request_research
 
 logger = setup_logging('gemini_bot')
 
@@ -53,6 +76,15 @@ class ContextAwareTelegramBot:
     
     def __init__(self):
         self.gemini_handler = None
+        self.model_executor = None
+        self.image_pipeline: Optional[ImagePipeline] = None
+        self.audio_pipeline: Optional[AudioPipeline] = None
+        self.video_pipeline: Optional[VideoPipeline] = None
+        
+        # Mídia recebida em disco, compartilhada com os workers
+        self.media_store = get_media_store()
+        self.sender: Optional[OutboundSender] = None
+        self.config = load_config()
         self.conversation_manager = get_conversation_manager()
         self.context_system = get_advanced_context_system(self.conversation_manager)
         self.keyboard_manager = get_keyboard_manager()
@@ -62,9 +94,168 @@ class ContextAwareTelegramBot:
         self.max_messages_per_user = 1000
         self.cleanup_days = 30
         
+        # Conversa ativa por usuário, compartilhada pelos handlers
+        session_settings = self.config.get("sessions", {})
+        self.sessions = SessionRegistry(
+            self.conversation_manager,
+            idle_timeout_seconds=float(session_settings.get("idle_timeout_seconds", 1800)),
+            max_sessions=int(session_settings.get("max_sessions", 100000)),
+        )
+        
+        # Snapshot binário dos caches (reinício rápido)
+        self.snapshotter = self._create_snapshotter()
+        
+        # Agrupamento opcional de mensagens em sequência rápida
+        self.message_coalescer = self._create_message_coalescer()
+        
+        # Cache opcional de respostas para prompts repetidos
+        self.response_cache = self._create_response_cache()
+        
+        # Updates concorrentes entre chats, sequenciais dentro de cada chat
+        self.update_processor = self._create_update_processor()
+        
+        # Gerações em andamento por chat (respostas obsoletas são descartadas)
+        self.generations = GenerationTracker(
+            policy=self.config.get("generation", {}).get("supersede_policy", "cancel")
+        )
+        
         self.initialize_handlers()
+        
+        # Limites de taxa e descarte sob sobrecarga (depende do executor do modelo)
+        self.admission = AdmissionController(
+            self.config.get("admission", {}),
+            admin_users=self.admin_users,
+            model_executor=self.model_executor,
+        )
+        
+        # Backend das tarefas pesadas (retoma jobs locais interrompidos)
+        try:
+            get_task_backend()
+        except Exception as e:
+            logger.error(f"Erro ao iniciar backend de tarefas: {e}")
+        
+        self._start_cache_warmup()
         logger.info("Bot Telegram com contexto avançado inicializado")
     
+    def _create_snapshotter(self) -> Optional[CacheSnapshotter]:
+        """Cria o snapshotter de caches a partir da configuração"""
+        settings = self.config.get("snapshot", {})
+        if not settings.get("enabled", False):
+            return None
+        
+        snapshotter = CacheSnapshotter(
+            settings.get("path", "cache_snapshot.bin"),
+            max_age_seconds=settings.get("max_age_seconds"),
+            is_current=database.unchanged_since,
+        )
+        self.context_system.register_snapshot_sections(snapshotter)
+        snapshotter.register_section("sessions", self.sessions.dump_cache, self.sessions.load_cache)
+        return snapshotter
+    
+    def _create_message_coalescer(self) -> Optional[MessageCoalescer]:
+        """Cria o agrupador de mensagens a partir da configuração"""
+        settings = self.config.get("coalescing", {})
+        if not settings.get("enabled", False):
+            return None
+        
+        return MessageCoalescer(
+            self._respond_to_messages,
+            window_seconds=float(settings.get("window_ms", 800)) / 1000,
+            max_wait_seconds=float(settings.get("max_wait_ms", 3000)) / 1000,
+            max_batch=int(settings.get("max_batch", 5)),
+        )
+    
+    def _create_response_cache(self) -> Optional[ResponseCache]:
+        """Cria o cache de respostas a partir da configuração"""
+        settings = self.config.get("response_cache", {})
+        if not settings.get("enabled", False):
+            return None
+        
+        return ResponseCache(
+            ttl_seconds=int(settings.get("ttl_seconds", 3600)),
+            near_duplicates=settings.get("near_duplicates", True),
+            similarity_threshold=float(settings.get("similarity_threshold", 0.85)),
+            max_prompt_chars=int(settings.get("max_prompt_chars", 200)),
+            max_index_entries=int(settings.get("max_index_entries", 5000)),
+        )
+    
+    def _create_update_processor(self) -> Optional[ChatOrderedUpdateProcessor]:
+        """Cria o processador de updates por chat (None mantém o modo sequencial)"""
+        settings = self.config.get("updates", {})
+        workers = int(settings.get("workers", 1))
+        if workers <= 1:
+            return None
+        
+        return ChatOrderedUpdateProcessor(
+            workers=workers,
+            max_pending=int(settings.get("max_pending", 1000)),
+        )
+    
+    def attach_bot(self, telegram_bot):
+        """Cria a fila de envio para o bot da Application"""
+        settings = self.config.get("outbound", {})
+        self.sender = OutboundSender(
+            telegram_bot,
+            global_rate=float(settings.get("global_rate_per_second", 30)),
+            private_chat_rate=float(settings.get("private_chat_rate_per_second", 1.0)),
+            group_chat_rate=float(settings.get("group_chat_rate_per_minute", 20)) / 60,
+            chat_burst=float(settings.get("chat_burst", 3)),
+            max_in_flight=int(settings.get("max_in_flight", 8)),
+            max_retries=int(settings.get("max_retries", 3)),
+        )
+    
+    def _start_cache_warmup(self):
+        """Restaura caches em segundo plano
+        
+        Roda em thread daemon para não atrasar o início do recebimento de
+        updates: primeiro tenta o snapshot e, se ele não existir ou for
+        descartado, faz o warm-up pelo banco com orçamento de tempo.
+        """
+        warmup_thread = threading.Thread(target=self._restore_caches, name="cache-warmup", daemon=True)
+        warmup_thread.start()
+    
+    def _restore_caches(self):
+        """Carrega snapshot ou, na falta dele, executa o warm-up pelo banco"""
+        restored = {}
+        if self.snapshotter:
+            restored = self.snapshotter.load()
+            self.snapshotter.start_periodic(float(self.config.get("snapshot", {}).get("interval_seconds", 300)))
+        
+        settings = self.config.get("warmup", {})
+        if restored or not settings.get("enabled", True):
+            return
+        
+        self.context_system.warm_up(
+            max_users=int(settings.get("max_users", 1000)),
+            time_budget=float(settings.get("time_budget_seconds", 5.0)),
+            batch_size=int(settings.get("batch_size", 200)),
+        )
+    
+    async def stop(self, application: Application):
+        """Antes de encerrar: responde lotes e gerações ainda pendentes"""
+        if self.message_coalescer:
+            await self.message_coalescer.flush_all()
+        await self.generations.wait_all()
+        if self.sender:
+            await self.sender.drain()
+    
+    async def shutdown(self, application: Application):
+        """Encerramento gracioso: grava snapshot e libera recursos"""
+        if self.sender:
+            await self.sender.stop()
+        if self.snapshotter:
+            self.snapshotter.stop()
+            await asyncio.to_thread(self.snapshotter.save, True)
+        if self.model_executor:
+            self.model_executor.shutdown()
+        if self.video_pipeline:
+            self.video_pipeline.shutdown()
+        if self.image_pipeline:
+            self.image_pipeline.shutdown()
+        shutdown_task_backend()
+        self.context_system.close()
+        logger.info("Bot encerrado")
+    
     def _load_admin_users(self) -> List[int]:
         """Carrega lista de usuários administradores"""
         admin_users = os.getenv('ADMIN_USER_IDS', '')
@@ -79,6 +270,60 @@ class ContextAwareTelegramBot:
         """Inicializa todos os handlers"""
         try:
             self.gemini_handler = get_gemini_handler()
+            
+            # Chamadas ao modelo fora do event loop, com concorrência limitada
+            model_settings = self.config.get("model", {})
+            self.model_executor = ModelExecutor(
+                self.gemini_handler,
+                max_concurrency=int(model_settings.get("max_concurrency", 4)),
+                timeout_seconds=float(model_settings.get("timeout_seconds", 60)),
+                max_queue=int(model_settings.get("max_queue", 100)),
+            )
+            
+            # Análise de imagens reduzidas, com cache por hash perceptual
+            image_settings = self.config.get("images", {})
+            ocr_stage = self._create_ocr_stage(image_settings.get("ocr", {}))
+            self.image_pipeline = ImagePipeline(
+                self.model_executor,
+                min_side=int(image_settings.get("min_side", 768)),
+                max_side=int(image_settings.get("max_side", 1024)),
+                jpeg_quality=int(image_settings.get("jpeg_quality", 85)),
+                max_distance=int(image_settings.get("max_hash_distance", 6)),
+                ttl_seconds=int(image_settings.get("cache_ttl_seconds", 7 * 24 * 3600)),
+                max_index_entries=int(image_settings.get("max_index_entries", 5000)),
+                media_store=self.media_store,
+                ocr_stage=ocr_stage,
+                skip_model_when_text=image_settings.get("ocr", {}).get("skip_model_when_text", True),
+                # Mesmo limiar da etapa de OCR para decidir entre chave exata e dHash
+                text_score_threshold=(ocr_stage.min_score if ocr_stage
+                                      else float(image_settings.get("ocr", {}).get("min_text_score", 0.3))),
+            )
+            
+            # Transcrição de áudio em trechos paralelos, com cache por conteúdo
+            audio_settings = self.config.get("audio", {})
+            self.audio_pipeline = AudioPipeline(
+                self.model_executor,
+                max_parallel=int(audio_settings.get("max_parallel_chunks", 4)),
+                min_chunk_seconds=float(audio_settings.get("min_chunk_seconds", 8)),
+                max_chunk_seconds=float(audio_settings.get("max_chunk_seconds", 30)),
+                min_silence_ms=int(audio_settings.get("min_silence_ms", 400)),
+                silence_threshold_db=float(audio_settings.get("silence_threshold_db", -40)),
+                max_duration_seconds=float(audio_settings.get("max_duration_seconds", 1800)),
+                ttl_seconds=int(audio_settings.get("cache_ttl_seconds", 30 * 24 * 3600)),
+            )
+            
+            # Análise de vídeo por quadros-chave (decodificação em processo separado)
+            video_settings = self.config.get("video", {})
+            self.video_pipeline = VideoPipeline(
+                self.model_executor,
+                audio_pipeline=self.audio_pipeline,
+                frame_budget=int(video_settings.get("frame_budget", 8)),
+                sample_fps=float(video_settings.get("sample_fps", 2.0)),
+                scene_threshold=float(video_settings.get("scene_threshold", 0.35)),
+                max_side=int(video_settings.get("max_side", 768)),
+                workers=int(video_settings.get("workers", 1)),
+                ttl_seconds=int(video_settings.get("cache_ttl_seconds", 30 * 24 * 3600)),
+            )
             logger.info("Todos os handlers inicializados com sucesso")
             
         except ConfigurationError as e:
@@ -88,10 +333,46 @@ class ContextAwareTelegramBot:
             logger.error(f"Erro na inicialização: {e}")
             raise
     
+    def _create_ocr_stage(self, settings: Dict[str, Any]) -> Optional[OcrStage]:
+        """Cria a etapa de OCR local a partir da configuração"""
+        if not settings.get("enabled", False):
+            return None
+        
+        return OcrStage(
+            workers=int(settings.get("workers", 1)),
+            languages=settings.get("languages", "por+eng"),
+            min_score=float(settings.get("min_text_score", 0.3)),
+            min_chars=int(settings.get("min_chars", 20)),
+            timeout_seconds=float(settings.get("timeout_seconds", 30)),
+            ttl_seconds=int(settings.get("cache_ttl_seconds", 30 * 24 * 3600)),
+        )
+    
     def is_admin(self, user_id: int) -> bool:
         """Verifica se o usuário é administrador"""
         return user_id in self.admin_users
     
+    async def _admit(self, update: Update, kind: str) -> bool:
+        """Aplica o controle de admissão, respondendo rapidamente quando recusado"""
+        decision = self.admission.admit(update.effective_user.id, kind)
+        if decision.allowed:
+            return True
+        
+        if decision.reason == REASON_SHED:
+            await self.sender.reply_text(update.message, "⏳ Muitas solicitações no momento. Tente novamente em instantes.")
+        elif decision.reason == REASON_GLOBAL_LIMIT:
+            # Limite de todos os usuários: o usuário não fez nada de errado
+            wait_seconds = max(1, int(decision.retry_after + 0.999))
+            await self.sender.reply_text(update.message, 
+                f"⏳ O bot está recebendo muitas solicitações agora. Tente novamente em {wait_seconds}s."
+            )
+        else:
+            wait_seconds = max(1, int(decision.retry_after + 0.999))
+            await self.sender.reply_text(update.message, 
+                f"⏳ Você está enviando solicitações rápido demais. Aguarde {wait_seconds}s e tente novamente."
+            )
+        logger.info(f"Solicitação recusada para {update.effective_user.id} ({kind}: {decision.reason})")
+        return False
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Comando /start - Menu principal com contexto"""
         user_id = str(update.effective_user.id)
@@ -131,15 +412,14 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
         # Criar teclado principal
         keyboard = self.keyboard_manager.create_main_menu_keyboard()
         
-        await update.message.reply_text(
+        await self.sender.reply_text(update.message, 
             welcome_text, 
             parse_mode='Markdown',
             reply_markup=keyboard
         )
         
         # Criar conversa para o usuário
-        session_id = f"session_{int(datetime.now().timestamp())}"
-        self.conversation_manager.get_or_create_conversation(user_id, session_id)
+        await self.sessions.get_conversation_id(user_id)
         
         # Definir estado inicial
         self.context_system.set_conversation_state(user_id, ConversationState.CHAT_GERAL)
@@ -158,7 +438,7 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
                 # Definir personalidade
                 self.context_system.set_user_personality(user_id, personality_type)
                 
-                await update.message.reply_text(
+                await self.sender.reply_text(update.message, 
                     f"🎭 **Personalidade alterada!**\n\n"
                     f"Personalidade: **{personality_type.title()}**\n"
                     f"Descrição: {available_personalities[personality_type]}\n\n"
@@ -176,7 +456,7 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
                 personalities_text += "\n💡 **Uso:** `/personalidade [tipo]`\n"
                 personalities_text += "**Exemplo:** `/personalidade cientista`"
                 
-                await update.message.reply_text(
+                await self.sender.reply_text(update.message, 
                     personalities_text,
                     parse_mode='Markdown'
                 )
@@ -199,7 +479,7 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
             
             personality_text += "\n💡 **Uso:** `/personalidade [tipo]`"
             
-            await update.message.reply_text(
+            await self.sender.reply_text(update.message, 
                 personality_text,
                 parse_mode='Markdown'
             )
@@ -231,7 +511,7 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
         
         context_text += "\n\n💡 **Dica:** O bot lembra de suas interações multimodais anteriores!"
         
-        await update.message.reply_text(
+        await self.sender.reply_text(update.message, 
             context_text,
             parse_mode='Markdown'
         )
@@ -240,10 +520,13 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
         """Comando /limpar_contexto - Limpar contexto multimodal"""
         user_id = str(update.effective_user.id)
         
+        # Respostas em geração usariam o contexto removido
+        self.generations.supersede((update.effective_chat.id, user_id))
+        
         # Limpar contexto
         self.context_system.clear_user_context(user_id)
         
-        await update.message.reply_text(
+        await self.sender.reply_text(update.message, 
             "🧹 **Contexto Limpo!**\n\n"
             "Todo o contexto multimodal foi removido.\n"
             "O bot não lembrará mais de interações anteriores.",
@@ -259,7 +542,7 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
         # Definir estado para aguardar áudio
         self.context_system.set_conversation_state(user_id, ConversationState.AGUARDANDO_AUDIO_CLONE)
         
-        await update.message.reply_text(
+        await self.sender.reply_text(update.message, 
             "🎤 **Modo de Clonagem de Voz Ativado**\n\n"
             "📌 Envie um arquivo de áudio de 5-10 segundos com voz clara.\n"
             "Quando o áudio chegar, vamos enfileirar a clonagem e você poderá continuar usando o bot.",
@@ -268,14 +551,46 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
         
         logger.info(f"Usuário {user_id} entrou em modo de clonagem de voz")
     
+    async def pesquisar_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Comando /pesquisar <tema> - Relatório de pesquisa em segundo plano"""
+        user_id = str(update.effective_user.id)
+        query = sanitize_input(" ".join(context.args or [])).strip()
+        if not query:
+            await self.sender.reply_text(update.message, "📌 Use: /pesquisar <tema>")
+            return
+        
+        if not await self._admit(update, KIND_TASK):
+            return
+        
+        # Pedidos iguais de vários chats compartilham a mesma pesquisa
+        try:
+            status, cached = await asyncio.to_thread(request_research, int(update.effective_chat.id), query)
+        except Exception as e:
+            logger.error(f"Erro ao enfileirar pesquisa: {e}")
+            await self.sender.reply_text(update.message, "⚠️ A fila de tarefas está indisponível no momento. Tente novamente mais tarde.")
+            return
+        
+        if status == "cached":
+            await self.sender.reply_text(update.message, f"📄 Resultado:\n{cached['text']}")
+        elif status == "joined":
+            await self.sender.reply_text(update.message, 
+                f"🔎 Uma pesquisa sobre \"{query}\" já está em andamento. Você receberá o resultado assim que ela terminar."
+            )
+        else:
+            await self.sender.reply_text(update.message, f"🔎 Pesquisando: {query}\nIsso pode levar 1-2 minutos…")
+        
+        conversation_id = await self.sessions.get_conversation_id(user_id)
+        self.context_system.handle_multimodal_interaction(user_id, "research", query, conversation_id)
+    
     async def sair_modo_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Comando /sair_modo - Sair do modo atual"""
         user_id = str(update.effective_user.id)
         
-        # Resetar estado
+        # Resetar estado (descartando respostas ainda em geração)
+        self.generations.supersede((update.effective_chat.id, user_id))
         self.context_system.set_conversation_state(user_id, ConversationState.CHAT_GERAL)
         
-        await update.message.reply_text(
+        await self.sender.reply_text(update.message, 
             "🔄 **Modo Resetado**\n\n"
             "Voltou ao modo de chat geral.\n"
             "Pode conversar normalmente agora!",
@@ -287,24 +602,26 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Manipula mensagens de texto com contexto"""
         user_id = str(update.effective_user.id)
-        username = update.effective_user.username or "Usuário"
         user_message = update.message.text
         
         # Validar entrada
         if not validate_input(user_message):
-            await update.message.reply_text("❌ Mensagem inválida. Tente novamente.")
+            await self.sender.reply_text(update.message, "❌ Mensagem inválida. Tente novamente.")
             return
         
         # Sanitizar entrada
         sanitized_input = sanitize_input(user_message)
         
+        if not await self._admit(update, KIND_TEXT):
+            return
+        
         try:
             # Obter estado atual
             current_state = self.context_system.get_conversation_state(user_id)
             
             # Verificar se está em modo especial
             if current_state == ConversationState.AGUARDANDO_AUDIO_CLONE:
-                await update.message.reply_text(
+                await self.sender.reply_text(update.message, 
                     "🎤 **Aguardando arquivo de áudio...**\n\n"
                     "Por favor, envie um arquivo de áudio para clonagem.\n"
                     "Use `/sair_modo` para cancelar.",
@@ -313,13 +630,12 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
                 return
             
             # Mostrar indicador de digitação
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+            self.sender.send_chat_action(update.effective_chat.id, "typing")
             
             # Obter ou criar conversa
-            session_id = f"session_{int(datetime.now().timestamp())}"
-            conversation_id = self.conversation_manager.get_or_create_conversation(user_id, session_id)
+            conversation_id = await self.sessions.get_conversation_id(user_id)
             
-            # Adicionar mensagem do usuário
+            # Adicionar mensagem do usuário (toda mensagem é persistida, mesmo quando agrupada)
             user_chat_message = ChatMessage(
                 timestamp=datetime.now().isoformat(),
                 role="user",
@@ -328,89 +644,191 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
             )
             self.conversation_manager.add_message(user_id, user_chat_message)
             
+        except Exception as e:
+            logger.error(f"Erro ao processar mensagem: {e}")
+            await self.sender.reply_text(update.message, 
+                "❌ **Erro interno.** Tente novamente em alguns segundos.\n"
+                "💡 Se o problema persistir, use `/start` para reiniciar.",
+                parse_mode='Markdown'
+            )
+            return
+        
+        chat_key = (update.effective_chat.id, user_id)
+        if self.message_coalescer:
+            # Mensagens em sequência rápida geram uma única resposta
+            await self.message_coalescer.submit(chat_key, (update, sanitized_input))
+        else:
+            await self._respond_to_messages(chat_key, [(update, sanitized_input)])
+    
+    async def _respond_to_messages(self, chat_key: Tuple[int, str], pending: List[Tuple[Update, str]]):
+        """Inicia a geração da resposta, substituindo a anterior do mesmo chat
+        
+        A geração roda em task própria para que o processamento de updates
+        siga e uma nova mensagem possa cancelar a resposta em curso.
+        """
+        self.generations.start(chat_key, lambda generation: self._generate_reply(chat_key, pending, generation))
+    
+    async def _generate_reply(self, chat_key: Tuple[int, str], pending: List[Tuple[Update, str]],
+                              generation: Generation):
+        """Gera uma única resposta para uma ou mais mensagens de texto já persistidas"""
+        update = pending[-1][0]
+        user_id = chat_key[1]
+        username = update.effective_user.username or "Usuário"
+        combined_input = "\n".join(text for _, text in pending)
+        
+        try:
             # Enriquecer mensagem com contexto multimodal
-            enriched_message = self.context_system.enrich_message_with_context(user_id, sanitized_input)
+            enriched_message = self.context_system.enrich_message_with_context(user_id, combined_input)
             
             # Obter instrução do sistema baseada na personalidade
             system_instruction = self.context_system.get_system_instruction(user_id)
             
+            # Criar teclado de ações de chat
+            keyboard = self.keyboard_manager.create_chat_actions_keyboard(user_id)
+            
             # Obter histórico da conversa
             history = self.conversation_manager.get_conversation_history(user_id, limit=20)
+            recent = history[-10:]  # Últimas 10 mensagens
             
             # Preparar contexto para o Gemini
             if history:
                 context_text = "Contexto da conversa:\n"
-                for msg in history[-10:]:  # Últimas 10 mensagens
+                for msg in recent:
                     role_label = "Usuário" if msg.role == "user" else "Assistente"
                     context_text += f"{role_label}: {msg.content}\n"
                 context_text += f"\nNova mensagem do usuário: {enriched_message}"
             else:
                 context_text = enriched_message
             
-            # Gerar resposta usando Gemini com personalidade
-            response = self.gemini_handler.generate_content(context_text)
+            # Prompts repetidos podem ser respondidos pelo cache; a resposta depende
+            # do histórico, que entra na chave (conversas diferentes não a compartilham)
+            cache_prompt = None
+            if self.response_cache:
+                multimodal_context = enriched_message if enriched_message != combined_input else ""
+                cache_prompt = self.response_cache.prepare(
+                    combined_input, system_instruction, multimodal_context,
+                    history=self._prior_history(recent, pending),
+                )
+            cached_response = self.response_cache.get(cache_prompt) if cache_prompt else None
             
-            # Adicionar resposta do assistente
-            assistant_chat_message = ChatMessage(
-                timestamp=datetime.now().isoformat(),
-                role="model",
-                content=response,
-                message_id=f"msg_{int(datetime.now().timestamp())}"
-            )
-            self.conversation_manager.add_message(user_id, assistant_chat_message)
+            if cached_response is not None:
+                if generation.superseded:
+                    return
+                response = cached_response
+                await self.sender.reply_text(update.message, response, parse_mode='Markdown', reply_markup=keyboard)
+                self._persist_assistant_message(user_id, response)
+                logger.info(f"Resposta em cache enviada para {username} ({user_id})")
+                return
             
-            # Criar teclado de ações de chat
-            keyboard = self.keyboard_manager.create_chat_actions_keyboard(user_id)
+            streaming_settings = self.config.get("streaming", {})
+            if streaming_settings.get("enabled", False):
+                # Publicar a resposta à medida que os tokens chegam
+                reply = StreamingReply(
+                    update.message,
+                    edit_interval=float(streaming_settings.get("edit_interval_seconds", 1.0)),
+                    reply_markup=keyboard,
+                    sender=self.sender
+                )
+                async for chunk in self.model_executor.stream_content(context_text, interactive=True):
+                    if generation.superseded:
+                        # Encerrar o iterador interrompe a leitura do stream
+                        return
+                    await reply.append(chunk)
+                response = await reply.finish()
+            else:
+                # Gerar resposta usando Gemini com personalidade (fora do event loop)
+                response = await self.model_executor.generate_content(context_text, interactive=True)
+                
+                if generation.superseded:
+                    logger.info(f"Resposta obsoleta descartada para {user_id}")
+                    return
+                
+                await self.sender.reply_text(update.message, 
+                    response,
+                    parse_mode='Markdown',
+                    reply_markup=keyboard
+                )
             
-            # Enviar resposta
-            await update.message.reply_text(
-                response,
-                parse_mode='Markdown',
-                reply_markup=keyboard
-            )
+            # Adicionar resposta do assistente (uma única vez, ao final)
+            self._persist_assistant_message(user_id, response)
+            if cache_prompt:
+                self.response_cache.put(cache_prompt, response)
             
-            logger.info(f"Resposta contextual enviada para {username} ({user_id})")
+            logger.info(f"Resposta contextual enviada para {username} ({user_id}) - {len(pending)} mensagem(ns)")
             
+        except ModelOverloadedError:
+            if not generation.superseded:
+                await self.sender.reply_text(update.message, "⏳ Muitas solicitações no momento. Tente novamente em instantes.")
+        except ModelTimeoutError as e:
+            logger.warning(f"Tempo esgotado ao gerar resposta para {user_id}: {e}")
+            if not generation.superseded:
+                await self.sender.reply_text(update.message, "⌛ A resposta demorou demais. Tente novamente em alguns segundos.")
         except Exception as e:
             logger.error(f"Erro ao processar mensagem: {e}")
-            await update.message.reply_text(
-                "❌ **Erro interno.** Tente novamente em alguns segundos.\n"
-                "💡 Se o problema persistir, use `/start` para reiniciar.",
-                parse_mode='Markdown'
-            )
+            if not generation.superseded:
+                await self.sender.reply_text(update.message, 
+                    "❌ **Erro interno.** Tente novamente em alguns segundos.\n"
+                    "💡 Se o problema persistir, use `/start` para reiniciar.",
+                    parse_mode='Markdown'
+                )
+    
+    @staticmethod
+    def _prior_history(recent: List[Any], pending: List[Tuple[Update, str]]) -> List[Tuple[str, str]]:
+        """Histórico usado na geração sem as mensagens pendentes (já persistidas no fim)"""
+        messages = [(msg.role, msg.content) for msg in recent]
+        texts = [("user", text) for _, text in pending]
+        if texts and messages[-len(texts):] == texts:
+            return messages[:-len(texts)]
+        return messages
+    
+    def _persist_assistant_message(self, user_id: str, response: str):
+        """Adiciona a resposta do assistente ao histórico da conversa"""
+        assistant_chat_message = ChatMessage(
+            timestamp=datetime.now().isoformat(),
+            role="model",
+            content=response,
+            message_id=f"msg_{int(datetime.now().timestamp())}"
+        )
+        self.conversation_manager.add_message(user_id, assistant_chat_message)
     
     async def handle_image_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Manipula mensagens com imagem"""
         user_id = str(update.effective_user.id)
         
+        if not await self._admit(update, KIND_IMAGE):
+            return
+        
         try:
-            # Obter arquivo de imagem
-            image_file = await context.bot.get_file(update.message.photo[-1].file_id)
+            self.sender.send_chat_action(update.effective_chat.id, "typing")
             
-            # Simular análise de imagem (em produção, usar multimodal_processor)
-            image_description = f"Imagem recebida de {update.effective_user.username or 'usuário'}: contém elementos visuais diversos"
+            # Menor tamanho adequado, reduzido em memória; repetidas vêm do cache
+            analysis = await self.image_pipeline.describe(context.bot, update.message.photo)
+            image_description = analysis.description
             
             # Salvar contexto de imagem
-            session_id = f"session_{int(datetime.now().timestamp())}"
-            conversation_id = self.conversation_manager.get_or_create_conversation(user_id, session_id)
+            conversation_id = await self.sessions.get_conversation_id(user_id)
             
             self.context_system.handle_multimodal_interaction(
                 user_id, "image", image_description, conversation_id
             )
+            if analysis.text:
+                self.context_system.handle_multimodal_interaction(
+                    user_id, "ocr", analysis.text, conversation_id
+                )
             
             # Responder com descrição
-            await update.message.reply_text(
+            await self.sender.reply_text(update.message, 
                 f"🖼️ **Imagem Analisada!**\n\n"
                 f"**Descrição:** {image_description}\n\n"
                 f"💡 **Dica:** Agora você pode pedir para criar uma história sobre esta imagem!",
                 parse_mode='Markdown'
             )
             
-            logger.info(f"Imagem analisada para usuário {user_id}")
+            logger.info(f"Imagem analisada para usuário {user_id}{' (cache)' if analysis.cached else ''}")
             
         except Exception as e:
             logger.error(f"Erro ao processar imagem: {e}")
-            await update.message.reply_text(
+            await self.sender.reply_text(update.message, 
                 "❌ **Erro ao processar imagem**\n\n"
                 "Não foi possível analisar a imagem. Tente novamente."
             )
@@ -423,25 +841,36 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
         try:
             if current_state == ConversationState.AGUARDANDO_AUDIO_CLONE:
                 # Enfileirar a clonagem de voz no Celery (não bloquear o bot)
-                file_id = None
-                if update.message.voice:
-                    file_id = update.message.voice.file_id
-                elif update.message.audio:
-                    file_id = update.message.audio.file_id
+                media = update.message.voice or update.message.audio
+                file_id = media.file_id if media else None
                 
                 if not file_id:
-                    await update.message.reply_text("❌ Não encontrei o arquivo de áudio. Envie novamente como áudio/voz.")
+                    await self.sender.reply_text(update.message, "❌ Não encontrei o arquivo de áudio. Envie novamente como áudio/voz.")
                     return
                 
-                await update.message.reply_text("⏳ Áudio recebido. Iniciando processamento em segundo plano…")
+                # Tarefa pesada: mantém o modo de clonagem se for recusada
+                if not await self._admit(update, KIND_TASK):
+                    return
+                
+                await self.sender.reply_text(update.message, "⏳ Áudio recebido. Iniciando processamento em segundo plano…")
+                
+                # O worker lê o arquivo do armazenamento compartilhado em vez de baixá-lo de novo
+                options = {}
+                try:
+                    ref = await self.media_store.fetch(context.bot, file_id, media.file_unique_id, media.file_size)
+                    options["media_sha256"] = ref.sha256
+                except Exception as e:
+                    logger.error(f"Erro ao armazenar áudio para clonagem: {e}")
+                
                 try:
-                    clone_voice_task.delay(int(update.effective_chat.id), file_id, {})
-                except Exception:
-                    await update.message.reply_text("⚠️ A fila de tarefas está indisponível no momento. Tente novamente mais tarde.")
+                    # A publicação pode bloquear (broker ou SQLite): fora do loop de eventos
+                    await asyncio.to_thread(clone_voice_task.delay, int(update.effective_chat.id), file_id, options)
+                except Exception as e:
+                    logger.error(f"Erro ao enfileirar clonagem de voz: {e}")
+                    await self.sender.reply_text(update.message, "⚠️ A fila de tarefas está indisponível no momento. Tente novamente mais tarde.")
                 
                 # Registrar interação e resetar estado
-                session_id = f"session_{int(datetime.now().timestamp())}"
-                conversation_id = self.conversation_manager.get_or_create_conversation(user_id, session_id)
+                conversation_id = await self.sessions.get_conversation_id(user_id)
                 self.context_system.handle_multimodal_interaction(
                     user_id, "audio", "Áudio enviado para clonagem (em fila)", conversation_id
                 )
@@ -449,31 +878,119 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
                 
             else:
                 # Modo normal - transcrever áudio
-                await update.message.reply_text(
-                    "🎵 **Processando áudio...**\n\n"
-                    "⏳ Transcrevendo conteúdo...\n\n"
-                    "📝 **Transcrição:** [Conteúdo do áudio transcrito]\n\n"
-                    "💡 **Dica:** Agora você pode fazer perguntas sobre o conteúdo do áudio!",
-                    parse_mode='Markdown'
+                if not await self._admit(update, KIND_AUDIO):
+                    return
+                
+                media = update.message.voice or update.message.audio
+                if not media:
+                    await self.sender.reply_text(update.message, "❌ Não encontrei o arquivo de áudio. Envie novamente como áudio/voz.")
+                    return
+                
+                self.sender.send_chat_action(update.effective_chat.id, "typing")
+                ref = await self.media_store.fetch(context.bot, media.file_id, media.file_unique_id, media.file_size)
+                
+                # Trechos transcritos em paralelo, exibidos na ordem conforme ficam prontos
+                reply = StreamingReply(
+                    update.message,
+                    edit_interval=float(self.config.get("streaming", {}).get("edit_interval_seconds", 1.0)),
+                    parse_mode=None,
+                    sender=self.sender
                 )
+                await reply.append("🎵 Transcrição:\n\n")
+                transcript = await self.audio_pipeline.transcribe(ref, on_partial=reply.append)
+                if not transcript:
+                    await reply.append("(nenhuma fala reconhecida)")
+                await reply.append("\n\n💡 Dica: Agora você pode fazer perguntas sobre o conteúdo do áudio!")
+                await reply.finish()
                 
                 # Salvar contexto de áudio
-                session_id = f"session_{int(datetime.now().timestamp())}"
-                conversation_id = self.conversation_manager.get_or_create_conversation(user_id, session_id)
+                conversation_id = await self.sessions.get_conversation_id(user_id)
                 
                 self.context_system.handle_multimodal_interaction(
-                    user_id, "audio", "Conteúdo do áudio transcrito", conversation_id
+                    user_id, "audio", transcript or "Áudio sem fala reconhecida", conversation_id
                 )
             
             logger.info(f"Áudio processado para usuário {user_id}")
             
         except Exception as e:
             logger.error(f"Erro ao processar áudio: {e}")
-            await update.message.reply_text(
+            await self.sender.reply_text(update.message, 
                 "❌ **Erro ao processar áudio**\n\n"
                 "Não foi possível processar o áudio. Tente novamente."
             )
     
+    async def handle_video_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Manipula mensagens com vídeo"""
+        user_id = str(update.effective_user.id)
+        
+        if not await self._admit(update, KIND_VIDEO):
+            return
+        
+        try:
+            video = update.message.video or update.message.video_note
+            await self.sender.reply_text(update.message, "🎬 Vídeo recebido. Analisando as cenas principais…")
+            self.sender.send_chat_action(update.effective_chat.id, "typing")
+            
+            # Apenas quadros-chave (mudanças de cena) e o áudio vão para o modelo
+            ref = await self.media_store.fetch(context.bot, video.file_id, video.file_unique_id, video.file_size)
+            analysis, cached = await self.video_pipeline.analyze(ref)
+            if not analysis:
+                # Sem análise não há o que responder nem salvar no contexto
+                await self.sender.reply_text(update.message, 
+                    "❌ Não foi possível analisar o vídeo no momento. Tente novamente em instantes."
+                )
+                logger.warning(f"Análise de vídeo vazia para usuário {user_id}")
+                return
+            
+            conversation_id = await self.sessions.get_conversation_id(user_id)
+            self.context_system.handle_multimodal_interaction(
+                user_id, "video", analysis, conversation_id
+            )
+            if self.context_system.get_conversation_state(user_id) == ConversationState.AGUARDANDO_VIDEO_ANALISE:
+                self.context_system.set_conversation_state(user_id, ConversationState.CHAT_GERAL)
+            
+            await self.sender.reply_text(update.message, 
+                f"🎬 Análise do vídeo:\n\n{analysis}\n\n"
+                f"💡 Dica: Agora você pode fazer perguntas sobre o vídeo!"
+            )
+            
+            logger.info(f"Vídeo analisado para usuário {user_id}{' (cache)' if cached else ''}")
+            
+        except MediaTooLargeError:
+            await self.sender.reply_text(update.message, "❌ Vídeo grande demais. Envie um vídeo de até 20 MB.")
+        except Exception as e:
+            logger.error(f"Erro ao processar vídeo: {e}")
+            await self.sender.reply_text(update.message, 
+                "❌ **Erro ao processar vídeo**\n\n"
+                "Não foi possível analisar o vídeo. Tente novamente."
+            )
+    
+    async def metricas_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Comando /metricas - Métricas internas (apenas administradores)"""
+        if not self.is_admin(update.effective_user.id):
+            await self.sender.reply_text(update.message, "❌ Comando disponível apenas para administradores.")
+            return
+        
+        snapshot = get_metrics().snapshot()
+        lines = ["📊 Métricas do bot", ""]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"{name}: {value:g}")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name}: {value}")
+        for name, values in sorted(snapshot["latencies"].items()):
+            p50 = f"{values['p50']:.2f}s" if values["p50"] is not None else "-"
+            p95 = f"{values['p95']:.2f}s" if values["p95"] is not None else "-"
+            lines.append(f"{name}: p50={p50} p95={p95}")
+        
+        if self.update_processor:
+            busiest = sorted(self.update_processor.backlog().items(), key=lambda item: -item[1])[:5]
+            if busiest:
+                lines.append("")
+                lines.append("Chats com maior backlog:")
+                lines.extend(f"{chat}: {depth}" for chat, depth in busiest)
+        
+        await self.sender.reply_text(update.message, "\n".join(lines))
+    
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Manipula erros globais"""
         logger.error(f"Erro no bot: {context.error}")
@@ -481,7 +998,7 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
         if update and update.effective_message:
             try:
                 keyboard = self.keyboard_manager.create_main_menu_keyboard()
-                await update.effective_message.reply_text(
+                await self.sender.reply_text(update.effective_message, 
                     "❌ **Ocorreu um erro interno.**\n"
                     "💡 Tente novamente ou use `/start` para reiniciar.",
                     parse_mode='Markdown',
@@ -490,25 +1007,45 @@ Bom dia! São {local_time} no seu horário local. Bem-vindo ao **Bot com Context
             except Exception:
                 pass
     
+    def _with_unit_of_work(self, callback):
+        """Executa o handler numa unidade de trabalho
+        
+        Os dados do usuário que faltam no cache são lidos numa única consulta
+        e as escritas no banco do bot são confirmadas num único commit ao fim
+        do update (desfeitas se o handler falhar).
+        """
+        @functools.wraps(callback)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if update.effective_user:
+                self.context_system.prefetch_user(str(update.effective_user.id))
+            with database.unit_of_work():
+                return await callback(update, context)
+        return wrapper
+    
     def setup_handlers(self, application: Application):
         """Configura os manipuladores do bot"""
         # Comandos básicos
-        application.add_handler(CommandHandler("start", self.start_command))
-        application.add_handler(CommandHandler("help", self.start_command))  # Usar start como help
+        application.add_handler(CommandHandler("start", self._with_unit_of_work(self.start_command)))
+        application.add_handler(CommandHandler("help", self._with_unit_of_work(self.start_command)))  # Usar start como help
         
         # Comandos de contexto e personalidade
-        application.add_handler(CommandHandler("personalidade", self.personality_command))
-        application.add_handler(CommandHandler("contexto", self.contexto_command))
-        application.add_handler(CommandHandler("limpar_contexto", self.limpar_contexto_command))
+        application.add_handler(CommandHandler("personalidade", self._with_unit_of_work(self.personality_command)))
+        application.add_handler(CommandHandler("contexto", self._with_unit_of_work(self.contexto_command)))
+        application.add_handler(CommandHandler("limpar_contexto", self._with_unit_of_work(self.limpar_contexto_command)))
         
         # Comandos de modo
-        application.add_handler(CommandHandler("clonarvoz", self.clonar_voz_command))
-        application.add_handler(CommandHandler("sair_modo", self.sair_modo_command))
+        application.add_handler(CommandHandler("clonarvoz", self._with_unit_of_work(self.clonar_voz_command)))
+        application.add_handler(CommandHandler("sair_modo", self._with_unit_of_work(self.sair_modo_command)))
+        application.add_handler(CommandHandler("pesquisar", self._with_unit_of_work(self.pesquisar_command)))
+        
+        # Comandos administrativos
+        application.add_handler(CommandHandler("metricas", self.metricas_command))
         
         # Manipuladores de mensagens
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
-        application.add_handler(MessageHandler(filters.PHOTO, self.handle_image_message))
-        application.add_handler(MessageHandler(filters.AUDIO | filters.VOICE, self.handle_audio_message))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._with_unit_of_work(self.handle_message)))
+        application.add_handler(MessageHandler(filters.PHOTO, self._with_unit_of_work(self.handle_image_message)))
+        application.add_handler(MessageHandler(filters.AUDIO | filters.VOICE, self._with_unit_of_work(self.handle_audio_message)))
+        application.add_handler(MessageHandler(filters.VIDEO | filters.VIDEO_NOTE, self._with_unit_of_work(self.handle_video_message)))
         
         # Manipulador de erros
         application.add_error_handler(self.error_handler)
@@ -545,18 +1082,40 @@ def main():
         if not telegram_token:
             raise ValueError("TELEGRAM_TOKEN não configurado no arquivo .env")
         
-        # Criar aplicação
-        application = Application.builder().token(telegram_token).build()
-        
         # Criar bot
         bot = ContextAwareTelegramBot()
         
+        # Criar aplicação
+        builder = (
+            Application.builder()
+            .token(telegram_token)
+            .post_stop(bot.stop)
+            .post_shutdown(bot.shutdown)
+        )
+        if bot.update_processor:
+            builder = builder.concurrent_updates(bot.update_processor)
+        application = builder.build()
+        bot.attach_bot(application.bot)
+        
         # Configurar manipuladores
         bot.setup_handlers(application)
         
-        # Iniciar bot
-        logger.info("Iniciando bot Telegram com contexto avançado...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        # Iniciar bot (polling ou webhook, conforme configuração)
+        telegram_settings = bot.config.get("telegram", {})
+        if telegram_settings.get("mode", "polling") == "webhook":
+            from webhook_server import create_webhook_server
+            
+            server = create_webhook_server(
+                application,
+                telegram_settings.get("webhook", {}),
+                secret_token=os.getenv('TELEGRAM_WEBHOOK_SECRET'),
+                webhook_url=os.getenv('WEBHOOK_URL'),
+            )
+            logger.info("Iniciando bot Telegram com contexto avançado (webhook)...")
+            asyncio.run(server.serve())
+        else:
+            logger.info("Iniciando bot Telegram com contexto avançado...")
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
         
     except Exception as e:
         logger.error(f"Erro na inicialização: {e}")
@@ -1,12 +1,146 @@
 import sqlite3
 import logging
 import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import List, Tuple, Dict, Optional, Any
+from typing import List, Tuple, Dict, Optional, Any, Callable, Iterator
 
 DB_FILE = "bot_data.db"
 logger = logging.getLogger(__name__)
 
+# -------------------------
+# Unidade de trabalho
+# -------------------------
+
+class UnitOfWork:
+    """Escritas de um update adiadas para uma única transação.
+
+    As operações são executadas em ordem no commit, dentro de uma transação
+    só; qualquer erro desfaz todas. Callbacks pós-commit (ex.: invalidação
+    de cache em outros processos) só rodam se a transação for confirmada;
+    callbacks de rollback (ex.: descartar do cache local valores que não
+    chegaram ao banco) só rodam se ela for desfeita ou descartada.
+    Leituras diretas no banco não enxergam escritas ainda pendentes; os
+    gerenciadores de contexto leem dos próprios caches.
+    """
+
+    def __init__(self):
+        self.operations: List[Tuple[Callable[..., None], tuple]] = []
+        self.after_commit_callbacks: List[Callable[[], None]] = []
+        self.rollback_callbacks: List[Callable[[], None]] = []
+        self.closed = False
+
+    def defer(self, operation: Callable[..., None], *args):
+        self.operations.append((operation, args))
+
+    def after_commit(self, callback: Callable[[], None]):
+        self.after_commit_callbacks.append(callback)
+
+    def on_rollback(self, callback: Callable[[], None]):
+        self.rollback_callbacks.append(callback)
+
+    def commit(self) -> bool:
+        """Executa as escritas pendentes numa transação; retorna False se desfeita"""
+        self.closed = True
+        if self.operations:
+            conn = sqlite3.connect(DB_FILE)
+            try:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                for operation, args in self.operations:
+                    operation(cursor, *args)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error(f"Erro ao confirmar unidade de trabalho ({len(self.operations)} escritas desfeitas): {e}")
+                self._run_rollback_callbacks()
+                return False
+            finally:
+                conn.close()
+        
+        for callback in self.after_commit_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Erro em callback pós-commit: {e}")
+        return True
+
+    def rollback(self):
+        """Descarta as escritas pendentes"""
+        self.closed = True
+        if self.operations:
+            logger.warning(f"Unidade de trabalho desfeita ({len(self.operations)} escritas descartadas)")
+        self.operations.clear()
+        self.after_commit_callbacks.clear()
+        self._run_rollback_callbacks()
+
+    def _run_rollback_callbacks(self):
+        callbacks, self.rollback_callbacks = self.rollback_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Erro em callback de rollback: {e}")
+
+
+_current_unit_of_work: ContextVar[Optional[UnitOfWork]] = ContextVar("unit_of_work", default=None)
+
+
+def _active_unit_of_work() -> Optional[UnitOfWork]:
+    # Tasks criadas durante o update herdam o contexto, mas não a unidade já confirmada
+    unit = _current_unit_of_work.get()
+    return unit if unit is not None and not unit.closed else None
+
+
+@contextmanager
+def unit_of_work() -> Iterator[UnitOfWork]:
+    """Agrupa as escritas do bloco numa única transação (reaproveita a unidade externa)"""
+    current = _active_unit_of_work()
+    if current is not None:
+        yield current
+        return
+    
+    unit = UnitOfWork()
+    token = _current_unit_of_work.set(unit)
+    try:
+        yield unit
+    except BaseException:
+        unit.rollback()
+        raise
+    else:
+        unit.commit()
+    finally:
+        _current_unit_of_work.reset(token)
+
+
+def after_commit(callback: Callable[[], None]):
+    """Executa o callback após o commit da unidade ativa (ou imediatamente, sem unidade)"""
+    unit = _active_unit_of_work()
+    if unit is not None:
+        unit.after_commit(callback)
+    else:
+        callback()
+
+
+def on_rollback(callback: Callable[[], None]):
+    """Executa o callback se a unidade ativa for desfeita (sem unidade, a escrita já foi feita)"""
+    unit = _active_unit_of_work()
+    if unit is not None:
+        unit.on_rollback(callback)
+
+
+def _write(operation: Callable[..., None], *args):
+    """Executa a escrita agora ou a adia para a unidade de trabalho ativa"""
+    unit = _active_unit_of_work()
+    if unit is not None:
+        unit.defer(operation, *args)
+        return
+    with sqlite3.connect(DB_FILE) as conn:
+        operation(conn.cursor(), *args)
+        conn.commit()
+
 def initialize_db():
     """Cria as tabelas do banco de dados se elas não existirem."""
     try:
@@ -37,11 +171,17 @@ def initialize_db():
                     last_generated_image_prompt TEXT,
                     context_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                     context_type TEXT,
+                    history_blob BLOB,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             """)
             
+            # Migração: bancos antigos não possuem a coluna do ring buffer binário
+            cursor.execute("PRAGMA table_info(multimodal_context)")
+            if "history_blob" not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE multimodal_context ADD COLUMN history_blob BLOB")
+            
             # Tabela para estados de conversa
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS conversation_states (
@@ -92,6 +232,9 @@ def initialize_db():
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_states_user_id ON conversation_states(user_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_personalities_user_id ON user_personalities(user_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_settings_user_id ON user_settings(user_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_multimodal_context_updated_at ON multimodal_context(updated_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_states_updated_at ON conversation_states(updated_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_personalities_updated_at ON user_personalities(updated_at)")
 
             # Tabela de cache simples para APIs
             cursor.execute(
@@ -105,6 +248,27 @@ def initialize_db():
                 """
             )
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_cache_created_at ON api_cache(created_at)")
+
+            # Pesquisas em andamento e chats aguardando o resultado (deduplicação)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS research_jobs (
+                    key TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    run_id TEXT
+                )
+            """)
+            # Migração: identificador da execução, para a conclusão de uma execução substituída não apagar a nova
+            cursor.execute("PRAGMA table_info(research_jobs)")
+            if "run_id" not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE research_jobs ADD COLUMN run_id TEXT")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS research_subscribers (
+                    key TEXT NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    PRIMARY KEY (key, chat_id)
+                )
+            """)
             
             conn.commit()
             logger.info("Banco de dados avançado inicializado com sucesso.")
@@ -115,16 +279,16 @@ def initialize_db():
 def add_message_to_history(chat_id: int, role: str, content: str):
     """Adiciona uma nova mensagem ao histórico de um chat."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO chat_history (chat_id, role, content) VALUES (?, ?, ?)",
-                (chat_id, role, content)
-            )
-            conn.commit()
+        _write(_add_message_to_history, chat_id, role, content)
     except sqlite3.Error as e:
         logger.error(f"Erro ao adicionar mensagem ao histórico: {e}")
 
+def _add_message_to_history(cursor: sqlite3.Cursor, chat_id: int, role: str, content: str):
+    cursor.execute(
+        "INSERT INTO chat_history (chat_id, role, content) VALUES (?, ?, ?)",
+        (chat_id, role, content)
+    )
+
 def get_chat_history(chat_id: int) -> List[Tuple[str, str]]:
     """Recupera o histórico de um chat, formatado para o Gemini."""
     try:
@@ -144,79 +308,80 @@ def get_chat_history(chat_id: int) -> List[Tuple[str, str]]:
 def reset_chat_history(chat_id: int):
     """Apaga o histórico de um chat específico."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
-            conn.commit()
-            logger.info(f"Histórico do chat {chat_id} resetado no banco de dados.")
+        _write(_reset_chat_history, chat_id)
     except sqlite3.Error as e:
         logger.error(f"Erro ao resetar histórico: {e}")
 
+def _reset_chat_history(cursor: sqlite3.Cursor, chat_id: int):
+    cursor.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
+    logger.info(f"Histórico do chat {chat_id} resetado no banco de dados.")
+
 # Funções para contexto multimodal
 def save_multimodal_context(user_id: str, conversation_id: int, context_data: Dict[str, Any]):
     """Salva contexto multimodal no banco de dados."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            
-            # Verificar se já existe contexto para este usuário
-            cursor.execute("""
-                SELECT id FROM multimodal_context 
-                WHERE user_id = ? AND conversation_id = ?
-            """, (user_id, conversation_id))
-            
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Atualizar contexto existente
-                cursor.execute("""
-                    UPDATE multimodal_context SET
-                        last_image_description = ?,
-                        last_audio_transcription = ?,
-                        last_video_analysis = ?,
-                        last_research_topic = ?,
-                        last_generated_image_prompt = ?,
-                        context_timestamp = ?,
-                        context_type = ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ? AND conversation_id = ?
-                """, (
-                    context_data.get('last_image_description'),
-                    context_data.get('last_audio_transcription'),
-                    context_data.get('last_video_analysis'),
-                    context_data.get('last_research_topic'),
-                    context_data.get('last_generated_image_prompt'),
-                    context_data.get('context_timestamp'),
-                    context_data.get('context_type'),
-                    user_id,
-                    conversation_id
-                ))
-            else:
-                # Criar novo contexto
-                cursor.execute("""
-                    INSERT INTO multimodal_context (
-                        user_id, conversation_id, last_image_description,
-                        last_audio_transcription, last_video_analysis,
-                        last_research_topic, last_generated_image_prompt,
-                        context_timestamp, context_type
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    user_id, conversation_id,
-                    context_data.get('last_image_description'),
-                    context_data.get('last_audio_transcription'),
-                    context_data.get('last_video_analysis'),
-                    context_data.get('last_research_topic'),
-                    context_data.get('last_generated_image_prompt'),
-                    context_data.get('context_timestamp'),
-                    context_data.get('context_type')
-                ))
-            
-            conn.commit()
-            logger.info(f"Contexto multimodal salvo para usuário {user_id}")
-            
+        _write(_save_multimodal_context, user_id, conversation_id, context_data)
     except sqlite3.Error as e:
         logger.error(f"Erro ao salvar contexto multimodal: {e}")
 
+def _save_multimodal_context(cursor: sqlite3.Cursor, user_id: str, conversation_id: int, context_data: Dict[str, Any]):
+    # Verificar se já existe contexto para este usuário
+    cursor.execute("""
+        SELECT id FROM multimodal_context 
+        WHERE user_id = ? AND conversation_id = ?
+    """, (user_id, conversation_id))
+    
+    existing = cursor.fetchone()
+    
+    if existing:
+        # Atualizar contexto existente
+        cursor.execute("""
+            UPDATE multimodal_context SET
+                last_image_description = ?,
+                last_audio_transcription = ?,
+                last_video_analysis = ?,
+                last_research_topic = ?,
+                last_generated_image_prompt = ?,
+                context_timestamp = ?,
+                context_type = ?,
+                history_blob = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND conversation_id = ?
+        """, (
+            context_data.get('last_image_description'),
+            context_data.get('last_audio_transcription'),
+            context_data.get('last_video_analysis'),
+            context_data.get('last_research_topic'),
+            context_data.get('last_generated_image_prompt'),
+            context_data.get('context_timestamp'),
+            context_data.get('context_type'),
+            context_data.get('history_blob'),
+            user_id,
+            conversation_id
+        ))
+    else:
+        # Criar novo contexto
+        cursor.execute("""
+            INSERT INTO multimodal_context (
+                user_id, conversation_id, last_image_description,
+                last_audio_transcription, last_video_analysis,
+                last_research_topic, last_generated_image_prompt,
+                context_timestamp, context_type, history_blob
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            user_id, conversation_id,
+            context_data.get('last_image_description'),
+            context_data.get('last_audio_transcription'),
+            context_data.get('last_video_analysis'),
+            context_data.get('last_research_topic'),
+            context_data.get('last_generated_image_prompt'),
+            context_data.get('context_timestamp'),
+            context_data.get('context_type'),
+            context_data.get('history_blob')
+        ))
+    
+    logger.info(f"Contexto multimodal salvo para usuário {user_id}")
+
 def get_multimodal_context(user_id: str, conversation_id: int) -> Optional[Dict[str, Any]]:
     """Obtém contexto multimodal do banco de dados."""
     try:
@@ -248,66 +413,80 @@ def get_multimodal_context(user_id: str, conversation_id: int) -> Optional[Dict[
         logger.error(f"Erro ao obter contexto multimodal: {e}")
         return None
 
-def clear_multimodal_context(user_id: str, conversation_id: int = None):
-    """Limpa contexto multimodal do banco de dados."""
+def get_latest_multimodal_context_blob(user_id: str) -> Optional[bytes]:
+    """Obtém o ring buffer binário mais recente do usuário (qualquer conversa)."""
     try:
         with sqlite3.connect(DB_FILE) as conn:
             cursor = conn.cursor()
+            cursor.execute("""
+                SELECT history_blob FROM multimodal_context
+                WHERE user_id = ? AND history_blob IS NOT NULL
+                ORDER BY updated_at DESC, id DESC LIMIT 1
+            """, (user_id,))
             
-            if conversation_id:
-                cursor.execute("""
-                    DELETE FROM multimodal_context 
-                    WHERE user_id = ? AND conversation_id = ?
-                """, (user_id, conversation_id))
-            else:
-                cursor.execute("""
-                    DELETE FROM multimodal_context WHERE user_id = ?
-                """, (user_id,))
-            
-            conn.commit()
-            logger.info(f"Contexto multimodal limpo para usuário {user_id}")
+            result = cursor.fetchone()
+            return result[0] if result else None
             
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao obter contexto multimodal: {e}")
+        return None
+
+def clear_multimodal_context(user_id: str, conversation_id: int = None):
+    """Limpa contexto multimodal do banco de dados."""
+    try:
+        _write(_clear_multimodal_context, user_id, conversation_id)
     except sqlite3.Error as e:
         logger.error(f"Erro ao limpar contexto multimodal: {e}")
 
+def _clear_multimodal_context(cursor: sqlite3.Cursor, user_id: str, conversation_id: int = None):
+    if conversation_id:
+        cursor.execute("""
+            DELETE FROM multimodal_context 
+            WHERE user_id = ? AND conversation_id = ?
+        """, (user_id, conversation_id))
+    else:
+        cursor.execute("""
+            DELETE FROM multimodal_context WHERE user_id = ?
+        """, (user_id,))
+    
+    logger.info(f"Contexto multimodal limpo para usuário {user_id}")
+
 # Funções para estados de conversa
 def save_conversation_state(user_id: str, conversation_id: int, state: str, state_data: str = None):
     """Salva estado da conversa no banco de dados."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            
-            # Verificar se já existe estado para este usuário
-            cursor.execute("""
-                SELECT id FROM conversation_states 
-                WHERE user_id = ? AND conversation_id = ?
-            """, (user_id, conversation_id))
-            
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Atualizar estado existente
-                cursor.execute("""
-                    UPDATE conversation_states SET
-                        current_state = ?,
-                        state_data = ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ? AND conversation_id = ?
-                """, (state, state_data, user_id, conversation_id))
-            else:
-                # Criar novo estado
-                cursor.execute("""
-                    INSERT INTO conversation_states (
-                        user_id, conversation_id, current_state, state_data
-                    ) VALUES (?, ?, ?, ?)
-                """, (user_id, conversation_id, state, state_data))
-            
-            conn.commit()
-            logger.info(f"Estado da conversa salvo para usuário {user_id}: {state}")
-            
+        _write(_save_conversation_state, user_id, conversation_id, state, state_data)
     except sqlite3.Error as e:
         logger.error(f"Erro ao salvar estado da conversa: {e}")
 
+def _save_conversation_state(cursor: sqlite3.Cursor, user_id: str, conversation_id: int, state: str, state_data: str = None):
+    # Verificar se já existe estado para este usuário
+    cursor.execute("""
+        SELECT id FROM conversation_states 
+        WHERE user_id = ? AND conversation_id = ?
+    """, (user_id, conversation_id))
+    
+    existing = cursor.fetchone()
+    
+    if existing:
+        # Atualizar estado existente
+        cursor.execute("""
+            UPDATE conversation_states SET
+                current_state = ?,
+                state_data = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND conversation_id = ?
+        """, (state, state_data, user_id, conversation_id))
+    else:
+        # Criar novo estado
+        cursor.execute("""
+            INSERT INTO conversation_states (
+                user_id, conversation_id, current_state, state_data
+            ) VALUES (?, ?, ?, ?)
+        """, (user_id, conversation_id, state, state_data))
+    
+    logger.info(f"Estado da conversa salvo para usuário {user_id}: {state}")
+
 def get_conversation_state(user_id: str, conversation_id: int) -> Optional[str]:
     """Obtém estado da conversa do banco de dados."""
     try:
@@ -330,44 +509,204 @@ def reset_conversation_state(user_id: str, conversation_id: int):
     """Reseta estado da conversa para padrão."""
     save_conversation_state(user_id, conversation_id, "chat_geral")
 
-# Funções para personalidades
-def save_user_personality(user_id: str, personality_type: str, personality_description: str, custom_instructions: str = None):
-    """Salva personalidade do usuário no banco de dados."""
+# -------------------------
+# Carga em lote (warm-up)
+# -------------------------
+
+# SQLite antigo limita a 999 parâmetros por consulta
+_MAX_BULK_PARAMS = 500
+
+def _chunks(items: List[str], size: int = _MAX_BULK_PARAMS):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def unchanged_since(timestamp: float) -> bool:
+    """Se nenhuma linha de contexto, estado ou personalidade foi gravada a partir do instante
+
+    updated_at tem resolução de segundos: escritas no mesmo segundo contam
+    como posteriores (na dúvida, o chamador volta ao banco).
+    """
+    since = datetime.utcfromtimestamp(int(timestamp)).strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            for table in ("multimodal_context", "conversation_states", "user_personalities"):
+                row = conn.execute(f"SELECT MAX(updated_at) FROM {table}").fetchone()
+                if row and row[0] and row[0] >= since:
+                    return False
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao verificar alterações no banco: {e}")
+        return False
+
+
+def get_recently_active_users(limit: int) -> List[str]:
+    """Obtém os usuários com escrita mais recente em estado, personalidade ou contexto."""
     try:
         with sqlite3.connect(DB_FILE) as conn:
             cursor = conn.cursor()
+            latest: Dict[str, str] = {}
+            
+            # Percorre cada tabela pelo índice de updated_at e para ao reunir
+            # `limit` usuários distintos; os resultados são combinados em memória
+            for table in ("conversation_states", "user_personalities", "multimodal_context"):
+                seen = set()
+                cursor.execute(f"SELECT user_id, updated_at FROM {table} ORDER BY updated_at DESC")
+                for user_id, updated_at in cursor:
+                    if user_id in seen:
+                        continue
+                    seen.add(user_id)
+                    if updated_at and updated_at > latest.get(user_id, ""):
+                        latest[user_id] = updated_at
+                    if len(seen) >= limit:
+                        break
+            
+            ranked = sorted(latest.items(), key=lambda item: item[1], reverse=True)
+            return [user_id for user_id, _ in ranked[:limit]]
             
-            # Verificar se já existe personalidade para este usuário
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao obter usuários ativos: {e}")
+        return []
+
+def get_conversation_states_bulk(user_ids: List[str], conversation_id: int = 0) -> Dict[str, str]:
+    """Obtém estados de vários usuários em uma consulta por lote."""
+    states: Dict[str, str] = {}
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            for chunk in _chunks(user_ids):
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT user_id, current_state FROM conversation_states "
+                    f"WHERE conversation_id = ? AND user_id IN ({placeholders})",
+                    (conversation_id, *chunk)
+                )
+                states.update(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao obter estados em lote: {e}")
+    return states
+
+def get_user_personalities_bulk(user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Obtém personalidades de vários usuários em uma consulta por lote."""
+    personalities: Dict[str, Dict[str, Any]] = {}
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            for chunk in _chunks(user_ids):
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT user_id, personality_type, personality_description, custom_instructions, "
+                    f"created_at, updated_at FROM user_personalities WHERE user_id IN ({placeholders})",
+                    chunk
+                )
+                for row in cursor.fetchall():
+                    personalities[row[0]] = {
+                        'personality_type': row[1],
+                        'personality_description': row[2],
+                        'custom_instructions': row[3],
+                        'created_at': row[4],
+                        'updated_at': row[5]
+                    }
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao obter personalidades em lote: {e}")
+    return personalities
+
+def get_multimodal_contexts_bulk(user_ids: List[str], since_timestamp: float) -> Dict[str, bytes]:
+    """Obtém o ring buffer mais recente e não expirado de vários usuários."""
+    contexts: Dict[str, bytes] = {}
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            for chunk in _chunks(user_ids):
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT user_id, history_blob FROM multimodal_context "
+                    f"WHERE history_blob IS NOT NULL AND context_timestamp >= ? "
+                    f"AND user_id IN ({placeholders}) ORDER BY updated_at ASC, id ASC",
+                    (since_timestamp, *chunk)
+                )
+                # Ordem crescente: a última linha de cada usuário prevalece
+                contexts.update(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao obter contextos em lote: {e}")
+    return contexts
+
+def get_user_bundle(user_id: str, conversation_id: int = 0) -> Dict[str, Any]:
+    """Estado, personalidade e contexto mais recente do usuário numa única transação de leitura."""
+    bundle: Dict[str, Any] = {"state": None, "personality": None, "context_blob": None}
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
             cursor.execute("""
-                SELECT id FROM user_personalities WHERE user_id = ?
-            """, (user_id,))
-            
-            existing = cursor.fetchone()
+                SELECT current_state FROM conversation_states
+                WHERE user_id = ? AND conversation_id = ?
+                ORDER BY updated_at DESC LIMIT 1
+            """, (user_id, conversation_id))
+            row = cursor.fetchone()
+            if row:
+                bundle["state"] = row[0]
             
-            if existing:
-                # Atualizar personalidade existente
-                cursor.execute("""
-                    UPDATE user_personalities SET
-                        personality_type = ?,
-                        personality_description = ?,
-                        custom_instructions = ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ?
-                """, (personality_type, personality_description, custom_instructions, user_id))
-            else:
-                # Criar nova personalidade
-                cursor.execute("""
-                    INSERT INTO user_personalities (
-                        user_id, personality_type, personality_description, custom_instructions
-                    ) VALUES (?, ?, ?, ?)
-                """, (user_id, personality_type, personality_description, custom_instructions))
+            cursor.execute("""
+                SELECT personality_type, personality_description, custom_instructions
+                FROM user_personalities WHERE user_id = ?
+            """, (user_id,))
+            row = cursor.fetchone()
+            if row:
+                bundle["personality"] = {
+                    'personality_type': row[0],
+                    'personality_description': row[1],
+                    'custom_instructions': row[2]
+                }
             
+            cursor.execute("""
+                SELECT history_blob FROM multimodal_context
+                WHERE user_id = ? AND history_blob IS NOT NULL
+                ORDER BY updated_at DESC, id DESC LIMIT 1
+            """, (user_id,))
+            row = cursor.fetchone()
+            if row:
+                bundle["context_blob"] = row[0]
             conn.commit()
-            logger.info(f"Personalidade salva para usuário {user_id}: {personality_type}")
-            
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao obter dados do usuário: {e}")
+    return bundle
+
+# Funções para personalidades
+def save_user_personality(user_id: str, personality_type: str, personality_description: str, custom_instructions: str = None):
+    """Salva personalidade do usuário no banco de dados."""
+    try:
+        _write(_save_user_personality, user_id, personality_type, personality_description, custom_instructions)
     except sqlite3.Error as e:
         logger.error(f"Erro ao salvar personalidade: {e}")
 
+def _save_user_personality(cursor: sqlite3.Cursor, user_id: str, personality_type: str, personality_description: str, custom_instructions: str = None):
+    # Verificar se já existe personalidade para este usuário
+    cursor.execute("""
+        SELECT id FROM user_personalities WHERE user_id = ?
+    """, (user_id,))
+    
+    existing = cursor.fetchone()
+    
+    if existing:
+        # Atualizar personalidade existente
+        cursor.execute("""
+            UPDATE user_personalities SET
+                personality_type = ?,
+                personality_description = ?,
+                custom_instructions = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        """, (personality_type, personality_description, custom_instructions, user_id))
+    else:
+        # Criar nova personalidade
+        cursor.execute("""
+            INSERT INTO user_personalities (
+                user_id, personality_type, personality_description, custom_instructions
+            ) VALUES (?, ?, ?, ?)
+        """, (user_id, personality_type, personality_description, custom_instructions))
+    
+    logger.info(f"Personalidade salva para usuário {user_id}: {personality_type}")
+
 def get_user_personality(user_id: str) -> Optional[Dict[str, Any]]:
     """Obtém personalidade do usuário do banco de dados."""
     try:
@@ -395,57 +734,55 @@ def get_user_personality(user_id: str) -> Optional[Dict[str, Any]]:
 def save_user_settings(user_id: str, settings: Dict[str, Any]):
     """Salva configurações do usuário no banco de dados."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            
-            # Verificar se já existem configurações para este usuário
-            cursor.execute("""
-                SELECT id FROM user_settings WHERE user_id = ?
-            """, (user_id,))
-            
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Atualizar configurações existentes
-                cursor.execute("""
-                    UPDATE user_settings SET
-                        language = ?,
-                        voice_type = ?,
-                        theme = ?,
-                        notifications_enabled = ?,
-                        privacy_level = ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ?
-                """, (
-                    settings.get('language', 'pt'),
-                    settings.get('voice_type', 'feminina'),
-                    settings.get('theme', 'escuro'),
-                    settings.get('notifications_enabled', 1),
-                    settings.get('privacy_level', 'normal'),
-                    user_id
-                ))
-            else:
-                # Criar novas configurações
-                cursor.execute("""
-                    INSERT INTO user_settings (
-                        user_id, language, voice_type, theme,
-                        notifications_enabled, privacy_level
-                    ) VALUES (?, ?, ?, ?, ?, ?)
-                """, (
-                    user_id,
-                    settings.get('language', 'pt'),
-                    settings.get('voice_type', 'feminina'),
-                    settings.get('theme', 'escuro'),
-                    settings.get('notifications_enabled', 1),
-                    settings.get('privacy_level', 'normal')
-                ))
-            
-            conn.commit()
-            logger.info(f"Configurações salvas para usuário {user_id}")
-            
+        _write(_save_user_settings, user_id, settings)
     except sqlite3.Error as e:
         logger.error(f"Erro ao salvar configurações: {e}")
 
+def _save_user_settings(cursor: sqlite3.Cursor, user_id: str, settings: Dict[str, Any]):
+    # Verificar se já existem configurações para este usuário
+    cursor.execute("""
+        SELECT id FROM user_settings WHERE user_id = ?
+    """, (user_id,))
+    
+    existing = cursor.fetchone()
+    
+    if existing:
+        # Atualizar configurações existentes
+        cursor.execute("""
+            UPDATE user_settings SET
+                language = ?,
+                voice_type = ?,
+                theme = ?,
+                notifications_enabled = ?,
+                privacy_level = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        """, (
+            settings.get('language', 'pt'),
+            settings.get('voice_type', 'feminina'),
+            settings.get('theme', 'escuro'),
+            settings.get('notifications_enabled', 1),
+            settings.get('privacy_level', 'normal'),
+            user_id
+        ))
+    else:
+        # Criar novas configurações
+        cursor.execute("""
+            INSERT INTO user_settings (
+                user_id, language, voice_type, theme,
+                notifications_enabled, privacy_level
+            ) VALUES (?, ?, ?, ?, ?, ?)
+        """, (
+            user_id,
+            settings.get('language', 'pt'),
+            settings.get('voice_type', 'feminina'),
+            settings.get('theme', 'escuro'),
+            settings.get('notifications_enabled', 1),
+            settings.get('privacy_level', 'normal')
+        ))
+    
+    logger.info(f"Configurações salvas para usuário {user_id}")
+
 def get_user_settings(user_id: str) -> Optional[Dict[str, Any]]:
     """Obtém configurações do usuário do banco de dados."""
     try:
@@ -505,7 +842,8 @@ def cache_get(key: str) -> Optional[Dict[str, Any]]:
                 return None
             value_json, created_at_str, ttl_sec = row
             created = datetime.fromisoformat(created_at_str)
-            if datetime.now() - created > timedelta(seconds=int(ttl_sec)):
+            # created_at vem de CURRENT_TIMESTAMP (UTC)
+            if datetime.utcnow() - created > timedelta(seconds=int(ttl_sec)):
                 # Expirado: remover e retornar None
                 try:
                     cursor.execute("DELETE FROM api_cache WHERE key = ?", (key,))
@@ -516,4 +854,101 @@ def cache_get(key: str) -> Optional[Dict[str, Any]]:
             return json.loads(value_json)
     except sqlite3.Error as e:
         logger.error(f"Erro ao obter cache: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+# -------------------------
+# Deduplicação de pesquisas
+# -------------------------
+
+_CACHE_VALID_SQL = (
+    "SELECT value FROM api_cache WHERE key = ? "
+    "AND datetime(created_at, '+' || ttl_seconds || ' seconds') > CURRENT_TIMESTAMP"
+)
+
+
+def research_claim(key: str, query: str, chat_id: int, stale_after_seconds: float = 900,
+                   run_id: Optional[str] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Registra o chat como interessado na pesquisa da chave.
+
+    Retorna ("cached", resultado) se houver resultado válido no cache,
+    ("joined", None) se a pesquisa já estiver em andamento ou
+    ("started", None) se o chamador deve disparar a pesquisa; nesse caso
+    run_id identifica a execução e deve ser repassado a research_complete.
+    Tudo na mesma transação: quem chega logo após a conclusão vê o cache.
+    """
+    try:
+        with sqlite3.connect(DB_FILE, timeout=10, isolation_level=None) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(_CACHE_VALID_SQL, (key,)).fetchone()
+                if row:
+                    conn.execute("COMMIT")
+                    return "cached", json.loads(row[0])
+
+                job = conn.execute("SELECT started_at FROM research_jobs WHERE key = ?", (key,)).fetchone()
+                # Pesquisa antiga demais: o worker provavelmente caiu, então recomeça
+                running = job is not None and time.time() - job[0] < stale_after_seconds
+                if not running:
+                    conn.execute(
+                        "REPLACE INTO research_jobs (key, query, started_at, run_id) VALUES (?, ?, ?, ?)",
+                        (key, query, time.time(), run_id),
+                    )
+                conn.execute(
+                    "INSERT OR IGNORE INTO research_subscribers (key, chat_id) VALUES (?, ?)",
+                    (key, chat_id),
+                )
+                conn.execute("COMMIT")
+                return ("joined" if running else "started"), None
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao registrar pesquisa: {e}")
+        # Sem deduplicação, mas a pesquisa ainda acontece
+        return "started", None
+
+
+def research_waiting_chats(key: str) -> List[int]:
+    """Chats aguardando a pesquisa da chave (para mensagens de progresso)"""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            rows = conn.execute("SELECT chat_id FROM research_subscribers WHERE key = ?", (key,)).fetchall()
+            return [row[0] for row in rows]
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao obter chats da pesquisa: {e}")
+        return []
+
+
+def research_complete(key: str, value: Optional[Dict[str, Any]], ttl_seconds: int = 3600,
+                      run_id: Optional[str] = None) -> List[int]:
+    """Conclui a pesquisa: grava o resultado no cache (se houver) e retorna os chats a notificar
+
+    Com run_id, uma execução que foi dada como travada e substituída por
+    outra não libera a chave nem notifica os chats: eles ficam com a nova.
+    """
+    try:
+        with sqlite3.connect(DB_FILE, timeout=10, isolation_level=None) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if value is not None:
+                    conn.execute(
+                        "REPLACE INTO api_cache (key, value, ttl_seconds, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                        (key, json.dumps(value, ensure_ascii=False), ttl_seconds),
+                    )
+                if run_id is not None:
+                    job = conn.execute("SELECT run_id FROM research_jobs WHERE key = ?", (key,)).fetchone()
+                    if job is not None and job[0] != run_id:
+                        conn.execute("COMMIT")
+                        return []
+                rows = conn.execute("SELECT chat_id FROM research_subscribers WHERE key = ?", (key,)).fetchall()
+                conn.execute("DELETE FROM research_subscribers WHERE key = ?", (key,))
+                conn.execute("DELETE FROM research_jobs WHERE key = ?", (key,))
+                conn.execute("COMMIT")
+                return [row[0] for row in rows]
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    except sqlite3.Error as e:
+        logger.error(f"Erro ao concluir pesquisa: {e}")
+        return []
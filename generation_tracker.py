@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Rastreamento de Gerações em Andamento
+=====================================
+
+Mantém, por chat, as gerações de resposta ainda em curso para que uma nova
+mensagem ou mudança de modo possa descartar a resposta que ficou obsoleta.
+
+Políticas para a geração anterior quando chega uma nova:
+- cancel: cancela a task (libera o slot do modelo assim que possível)
+- finish_silently: deixa terminar, mas não envia nem persiste a resposta
+- queue: a nova geração espera a anterior terminar (nada é descartado)
+
+Mudanças de modo (/sair_modo, /limpar_contexto) sempre descartam as gerações
+pendentes; com a política "queue" elas terminam em silêncio.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from metrics import Metrics, get_metrics
+
+logger = logging.getLogger('gemini_bot')
+
+POLICY_CANCEL = "cancel"
+POLICY_FINISH_SILENTLY = "finish_silently"
+POLICY_QUEUE = "queue"
+POLICIES = (POLICY_CANCEL, POLICY_FINISH_SILENTLY, POLICY_QUEUE)
+
+
+class Generation:
+    """Geração de resposta em andamento para um chat"""
+
+    __slots__ = ("key", "task", "superseded")
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.task: Optional[asyncio.Task] = None
+        self.superseded = False
+
+
+GenerationFactory = Callable[[Generation], Awaitable[Any]]
+
+
+class GenerationTracker:
+    """Registro por chat das gerações em curso"""
+
+    def __init__(self, policy: str = POLICY_CANCEL, metrics: Optional[Metrics] = None):
+        if policy not in POLICIES:
+            logger.warning(f"Política de geração desconhecida '{policy}', usando '{POLICY_CANCEL}'")
+            policy = POLICY_CANCEL
+        self.policy = policy
+        self.metrics = metrics or get_metrics()
+        self._active: Dict[Hashable, List[Generation]] = {}
+
+    def in_flight(self, key: Hashable) -> int:
+        """Gerações ainda em curso para a chave"""
+        return len(self._active.get(key, ()))
+
+    def start(self, key: Hashable, factory: GenerationFactory) -> Generation:
+        """Inicia geração para a chave, aplicando a política às anteriores"""
+        previous = list(self._active.get(key, ()))
+        if previous and self.policy != POLICY_QUEUE:
+            self._supersede(previous, self.policy)
+        elif previous:
+            self.metrics.increment("generation.queued")
+
+        generation = Generation(key)
+        wait_for = previous[-1].task if previous and self.policy == POLICY_QUEUE else None
+        generation.task = asyncio.create_task(self._run(generation, factory, wait_for))
+        self._active.setdefault(key, []).append(generation)
+        self.metrics.increment("generation.started")
+        return generation
+
+    def supersede(self, key: Hashable) -> int:
+        """Descarta as gerações em curso da chave (mudança de modo)
+
+        Retorna quantas gerações foram afetadas.
+        """
+        pending = [g for g in self._active.get(key, ()) if not g.superseded]
+        if pending:
+            policy = POLICY_FINISH_SILENTLY if self.policy == POLICY_QUEUE else self.policy
+            self._supersede(pending, policy)
+        return len(pending)
+
+    async def wait_all(self):
+        """Aguarda todas as gerações em curso"""
+        tasks = [g.task for generations in self._active.values() for g in generations]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _supersede(self, generations: List[Generation], policy: str):
+        for generation in generations:
+            if generation.superseded:
+                continue
+            generation.superseded = True
+            if policy == POLICY_CANCEL:
+                generation.task.cancel()
+                self.metrics.increment("generation.cancelled")
+            else:
+                self.metrics.increment("generation.silenced")
+        logger.debug(f"{len(generations)} geração(ões) substituída(s) (política {policy})")
+
+    async def _run(self, generation: Generation, factory: GenerationFactory,
+                   wait_for: Optional[asyncio.Task]):
+        try:
+            if wait_for is not None:
+                await asyncio.wait([wait_for])
+            if generation.superseded:
+                return
+            await factory(generation)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Erro na geração de resposta ({generation.key}): {e}")
+        finally:
+            generations = self._active.get(generation.key)
+            if generations and generation in generations:
+                generations.remove(generation)
+                if not generations:
+                    del self._active[generation.key]
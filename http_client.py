@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP Compartilhado
+==========================
+
+Sessão requests com keep-alive reutilizada por todas as chamadas HTTP
+síncronas do processo (notificações das tarefas Celery e alertas de log).
+Sem ela, cada mensagem abria uma nova conexão TCP+TLS com api.telegram.org.
+
+Funcionalidades:
+- Pool de conexões por host (pool_connections/pool_maxsize configuráveis)
+- Timeouts separados de conexão e leitura
+- Retentativas limitadas com backoff exponencial e jitter
+- Uma sessão por processo (workers criados via fork recriam a sua)
+
+Características:
+- Só retenta falhas de conexão e respostas 502/503/504, em que o Telegram
+  não processou a requisição; 429 fica a cargo do chamador (retry_after)
+- TELEGRAM_API_URL aponta as chamadas para um servidor Telegram falso local
+"""
+
+import os
+import random
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config_loader import load_config
+
+logger = logging.getLogger('gemini_bot')
+
+DEFAULT_TELEGRAM_API_URL = "https://api.telegram.org"
+RETRY_STATUSES = (502, 503, 504)
+
+
+class JitteredRetry(Retry):
+    """Retry do urllib3 com jitter aleatório somado ao backoff exponencial"""
+
+    def __init__(self, *args, jitter: float = 0.5, **kwargs):
+        self.jitter = jitter
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs) -> "JitteredRetry":
+        kwargs.setdefault("jitter", self.jitter)
+        return super().new(**kwargs)
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return backoff
+        return backoff + random.uniform(0, self.jitter)
+
+
+def create_session(pool_connections: int = 4, pool_maxsize: int = 16, max_retries: int = 3,
+                   backoff_factor: float = 0.5, jitter: float = 0.5) -> requests.Session:
+    """Cria sessão com pool de conexões e retentativas limitadas"""
+    retry = JitteredRetry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,  # a requisição pode ter sido processada: não reenviar
+        status=max_retries,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,  # inclui POST (sendMessage)
+        backoff_factor=backoff_factor,
+        respect_retry_after_header=False,
+        raise_on_status=False,
+        jitter=jitter,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class HttpClient:
+    """Sessão compartilhada do processo com timeouts padrão"""
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        settings = settings or {}
+        self.timeout: Tuple[float, float] = (
+            float(settings.get("connect_timeout_seconds", 5)),
+            float(settings.get("read_timeout_seconds", 15)),
+        )
+        self.session = create_session(
+            pool_connections=int(settings.get("pool_connections", 4)),
+            pool_maxsize=int(settings.get("pool_maxsize", 16)),
+            max_retries=int(settings.get("max_retries", 3)),
+            backoff_factor=float(settings.get("backoff_factor", 0.5)),
+            jitter=float(settings.get("backoff_jitter_seconds", 0.5)),
+        )
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """POST reutilizando conexões (timeout padrão se não informado)"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """GET reutilizando conexões (timeout padrão se não informado)"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        """Fecha as conexões do pool"""
+        self.session.close()
+
+
+def telegram_api_url(token: str) -> str:
+    """URL base da Bot API para o token (TELEGRAM_API_URL permite servidor falso)"""
+    base = os.getenv("TELEGRAM_API_URL") or DEFAULT_TELEGRAM_API_URL
+    return f"{base.rstrip('/')}/bot{token}"
+
+
+def telegram_file_url(token: str) -> str:
+    """URL base de download de arquivos da Bot API para o token"""
+    base = os.getenv("TELEGRAM_API_URL") or DEFAULT_TELEGRAM_API_URL
+    return f"{base.rstrip('/')}/file/bot{token}"
+
+
+# Instância global por processo
+_http_client: Optional[HttpClient] = None
+_http_client_pid: Optional[int] = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> HttpClient:
+    """Obtém o cliente HTTP do processo atual"""
+    global _http_client, _http_client_pid
+    config_error: Optional[Exception] = None
+    with _http_client_lock:
+        pid = os.getpid()
+        if _http_client is None or _http_client_pid != pid:
+            # Conexões herdadas via fork não podem ser compartilhadas com o processo pai
+            try:
+                settings = load_config().get("http_client", {})
+            except Exception as e:
+                config_error = e
+                settings = {}
+            _http_client = HttpClient(settings)
+            _http_client_pid = pid
+        client = _http_client
+    if config_error is not None:
+        # Fora do lock: o handler de log do Telegram envia o erro usando este mesmo cliente
+        logger.error(f"Erro ao carregar configuração do cliente HTTP: {config_error}")
+    return client
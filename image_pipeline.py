@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline de Análise de Imagens
+==============================
+
+Prepara fotos recebidas para o modelo com o menor custo possível e evita
+analisar de novo imagens já vistas (memes encaminhados, fotos reenviadas).
+
+Funcionalidades:
+- Escolha do menor tamanho de foto do Telegram que atende ao lado mínimo
+- Download pelo MediaStore (fotos repetidas não são baixadas de novo)
+- Decodificação e redução em memória com Pillow (sem arquivos temporários)
+- Hash perceptual (dHash de 64 bits) para reconhecer imagens repetidas
+- Descrições em cache no api_cache, com correspondência de quase-duplicatas
+  por distância de Hamming
+- OCR local (OcrStage) em paralelo com a redução; imagens com texto podem
+  dispensar a chamada ao modelo
+
+Características:
+- Decodificação e hash rodam fora do event loop
+- O índice de quase-duplicatas fica em memória (limitado, LRU) e é dividido
+  em faixas de 8 bits: imagens a até 7 bits de distância compartilham ao
+  menos uma faixa
+- Descrições de fallback (modelo indisponível) não são cacheadas
+- Imagens com texto (OCR ou heurística) usam só o sha256 exato como chave:
+  capturas de tela e documentos têm dHash quase igual e textos diferentes
+"""
+
+import io
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from PIL import Image, ImageOps
+
+import database
+from media_store import MediaStore
+from metrics import Metrics, get_metrics
+from ocr_stage import OcrStage, text_likelihood
+
+logger = logging.getLogger('gemini_bot')
+
+_KEY_PREFIX = "img:"
+
+# dHash: 8 linhas x 9 colunas em tons de cinza -> 64 bits
+HASH_SIZE = 8
+_BANDS = 8
+_BAND_BITS = 64 // _BANDS
+
+DESCRIBE_PROMPT = (
+    "Descreva esta imagem em português, em até 5 frases: elementos principais, "
+    "texto visível, cores e contexto. Seja objetivo."
+)
+
+
+class PreparedImage:
+    """Imagem reduzida e pronta para envio ao modelo"""
+
+    __slots__ = ("data", "width", "height", "phash", "sha256", "text_score")
+
+    def __init__(self, data: bytes, width: int, height: int, phash: int,
+                 sha256: str = "", text_score: float = 0.0):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.phash = phash
+        self.sha256 = sha256
+        self.text_score = text_score
+
+
+class ImageAnalysis:
+    """Resultado da análise de uma imagem"""
+
+    __slots__ = ("description", "text", "cached")
+
+    def __init__(self, description: str, text: Optional[str] = None, cached: bool = False):
+        self.description = description
+        self.text = text
+        self.cached = cached
+
+
+def select_photo_size(photos: Sequence[Any], min_side: int = 768) -> Any:
+    """Menor PhotoSize cujo maior lado atinge min_side (ou o maior disponível)"""
+    ordered = sorted(photos, key=lambda photo: photo.width * photo.height)
+    for photo in ordered:
+        if max(photo.width, photo.height) >= min_side:
+            return photo
+    return ordered[-1]
+
+
+def dhash(image: Image.Image) -> int:
+    """Hash perceptual por diferença de brilho entre pixels vizinhos"""
+    small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Bits diferentes entre dois hashes"""
+    return (a ^ b).bit_count()
+
+
+def prepare_image(data: Any, max_side: int = 1024, jpeg_quality: int = 85) -> PreparedImage:
+    """Decodifica, reduz e recodifica a imagem em JPEG (bytes ou memoryview)"""
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG: decodifica já em escala reduzida (muito mais rápido que decodificar e reduzir)
+        image.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=jpeg_quality, optimize=True)
+        return PreparedImage(output.getvalue(), image.width, image.height, dhash(image),
+                             hashlib.sha256(data).hexdigest(), text_likelihood(image))
+
+
+class ImagePipeline:
+    """Análise de imagens com redução prévia e cache por hash perceptual"""
+
+    def __init__(self, model_executor: Any, min_side: int = 768, max_side: int = 1024,
+                 jpeg_quality: int = 85, max_distance: int = 6, ttl_seconds: int = 7 * 24 * 3600,
+                 max_index_entries: int = 5000, media_store: Optional[MediaStore] = None,
+                 ocr_stage: Optional[OcrStage] = None, skip_model_when_text: bool = True,
+                 text_score_threshold: float = 0.3, metrics: Optional[Metrics] = None):
+        self.model_executor = model_executor
+        self.media_store = media_store
+        self.ocr_stage = ocr_stage
+        self.skip_model_when_text = skip_model_when_text
+        self.text_score_threshold = text_score_threshold
+        self.min_side = min_side
+        self.max_side = max_side
+        self.jpeg_quality = jpeg_quality
+        self.max_distance = min(max_distance, _BANDS - 1)
+        self.ttl_seconds = ttl_seconds
+        self.max_index_entries = max_index_entries
+        self.metrics = metrics or get_metrics()
+
+        # Índice de quase-duplicatas: hash -> None (LRU) e (faixa, valor) -> hashes
+        self._hashes: "OrderedDict[int, None]" = OrderedDict()
+        self._bands: Dict[Tuple[int, int], Set[int]] = defaultdict(set)
+
+    async def describe(self, bot: Any, photos: Sequence[Any]) -> ImageAnalysis:
+        """Descrição (e texto, se houver) da foto"""
+        photo = select_photo_size(photos, self.min_side)
+        if self.media_store:
+            ref = await self.media_store.fetch(bot, photo.file_id, photo.file_unique_id, photo.file_size)
+            data = await asyncio.to_thread(ref.read_bytes)
+        else:
+            telegram_file = await bot.get_file(photo.file_id)
+            data = await telegram_file.download_as_bytearray()
+            self.metrics.increment("images.download_bytes", len(data))
+        return await self.describe_bytes(data)
+
+    async def describe_bytes(self, data: Any) -> ImageAnalysis:
+        """Descrição de uma imagem já baixada"""
+        ocr_task = None
+        if self.ocr_stage:
+            # OCR em outro processo enquanto a imagem é reduzida
+            ocr_task = asyncio.create_task(self.ocr_stage.extract(bytes(data)))
+        try:
+            prepared = await asyncio.to_thread(prepare_image, memoryview(data), self.max_side, self.jpeg_quality)
+        except BaseException:
+            if ocr_task:
+                ocr_task.cancel()
+            raise
+        text = await ocr_task if ocr_task else None
+
+        # Com texto, quase-duplicatas não servem: a chave é o conteúdo exato
+        has_text = bool(text) or prepared.text_score >= self.text_score_threshold
+        key = f"{_KEY_PREFIX}sha:{prepared.sha256}" if has_text else self._key(prepared.phash)
+        phash = None if has_text else prepared.phash
+
+        cached = self._get_cached(key, phash)
+        if cached is not None:
+            return ImageAnalysis(cached, text, cached=True)
+
+        if text and self.skip_model_when_text:
+            # Captura de tela ou documento: o texto local basta para o contexto
+            self.metrics.increment("images.model_skipped")
+            preview = text if len(text) <= 200 else text[:200].rstrip() + "…"
+            return ImageAnalysis(f"Imagem com texto ({len(text)} caracteres). Início: {preview}", text)
+
+        try:
+            description = await self.model_executor.generate_content(
+                [DESCRIBE_PROMPT, {"mime_type": "image/jpeg", "data": prepared.data}]
+            )
+        except Exception as e:
+            logger.error(f"Erro ao analisar imagem no modelo: {e}")
+            description = None
+
+        description = (description or "").strip()
+        if not description:
+            self.metrics.increment("images.fallback")
+            return ImageAnalysis(f"Imagem de {prepared.width}x{prepared.height} pixels (análise indisponível no momento)", text)
+        self._put(key, description, phash)
+        return ImageAnalysis(description, text)
+
+    def shutdown(self):
+        """Encerra os processos de OCR"""
+        if self.ocr_stage:
+            self.ocr_stage.shutdown()
+
+    def _get_cached(self, key: str, phash: Optional[int] = None) -> Optional[str]:
+        """Descrição pela chave exata e, com phash, por quase-duplicata"""
+        try:
+            cached = database.cache_get(key)
+            if cached is not None:
+                if phash is not None:
+                    self._index(phash)
+                self.metrics.increment("images.cache_hits")
+                return cached.get("description")
+
+            similar = self._find_similar(phash) if phash is not None else None
+            if similar is not None:
+                cached = database.cache_get(self._key(similar))
+                if cached is not None:
+                    self.metrics.increment("images.cache_near_hits")
+                    return cached.get("description")
+                # Expirou no banco: remover do índice
+                self._unindex(similar)
+        except Exception as e:
+            logger.error(f"Erro ao consultar cache de imagens: {e}")
+
+        self.metrics.increment("images.cache_misses")
+        return None
+
+    def _put(self, key: str, description: str, phash: Optional[int] = None):
+        try:
+            database.cache_set(key, {"description": description}, ttl_seconds=self.ttl_seconds)
+            if phash is not None:
+                self._index(phash)
+        except Exception as e:
+            logger.error(f"Erro ao salvar no cache de imagens: {e}")
+
+    @staticmethod
+    def _key(phash: int) -> str:
+        return f"{_KEY_PREFIX}{phash:016x}"
+
+    @staticmethod
+    def _band_keys(phash: int) -> List[Tuple[int, int]]:
+        mask = (1 << _BAND_BITS) - 1
+        return [(band, (phash >> (band * _BAND_BITS)) & mask) for band in range(_BANDS)]
+
+    def _find_similar(self, phash: int) -> Optional[int]:
+        candidates: Set[int] = set()
+        for band_key in self._band_keys(phash):
+            candidates.update(self._bands.get(band_key, ()))
+
+        best, best_distance = None, self.max_distance + 1
+        for candidate in candidates:
+            distance = hamming_distance(phash, candidate)
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        if best is not None:
+            self._hashes.move_to_end(best)
+        return best
+
+    def _index(self, phash: int):
+        if phash in self._hashes:
+            self._hashes.move_to_end(phash)
+            return
+        self._hashes[phash] = None
+        for band_key in self._band_keys(phash):
+            self._bands[band_key].add(phash)
+        while len(self._hashes) > self.max_index_entries:
+            self._unindex(next(iter(self._hashes)))
+
+    def _unindex(self, phash: int):
+        if phash not in self._hashes:
+            return
+        del self._hashes[phash]
+        for band_key in self._band_keys(phash):
+            hashes = self._bands.get(band_key)
+            if hashes is not None:
+                hashes.discard(phash)
+                if not hashes:
+                    del self._bands[band_key]
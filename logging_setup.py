@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
-import requests
 from logging.handlers import RotatingFileHandler
 from typing import List
 
@@ -13,24 +12,19 @@ class TelegramErrorHandler(logging.Handler):
         super().__init__(level=logging.ERROR)
         self.bot_token = bot_token
         self.admin_ids = admin_ids
-        self.api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage" if bot_token else None
 
     def emit(self, record: logging.LogRecord) -> None:
         if not self.bot_token or not self.admin_ids:
             return
         try:
             msg = self.format(record)
+            # Importação tardia: outbound_sender também registra logs
+            from outbound_sender import get_sync_sender
+            sender = get_sync_sender(self.bot_token)
             for admin_id in self.admin_ids:
                 try:
-                    requests.post(
-                        self.api_url,
-                        json={
-                            "chat_id": admin_id,
-                            "text": f"🚨 ERRO no bot:\n{msg}",
-                            "parse_mode": "Markdown",
-                        },
-                        timeout=10,
-                    )
+                    # Sem bloquear quem registrou o erro: alertas acima do limite são descartados
+                    sender.send_message(admin_id, f"🚨 ERRO no bot:\n{msg}", parse_mode="Markdown", block=False)
                 except Exception:
                     continue
         except Exception:
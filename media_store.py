@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Armazenamento de Mídia Endereçado por Conteúdo
+==============================================
+
+Cache em disco dos arquivos recebidos pelo Telegram (fotos, áudios, vídeos),
+compartilhado entre o bot e os workers Celery. O mesmo arquivo viral só é
+baixado uma vez: a busca é feita pelo file_unique_id do Telegram e o blob é
+guardado pelo sha256 do conteúdo.
+
+Funcionalidades:
+- Índice file_unique_id -> sha256 e blobs em blobs/<sha256[:2]>/<sha256>
+- Downloads em streaming direto para o disco, com hash calculado durante a
+  escrita e limite de tamanho por arquivo
+- Downloads simultâneos limitados; pedidos simultâneos do mesmo arquivo
+  aguardam um único download
+- Limite de tamanho total com despejo LRU (data de acesso = mtime)
+- API síncrona para os workers (fetch_sync) e referência por sha256 para
+  repassar arquivos já baixados às tarefas
+
+Características:
+- Escritas atômicas (arquivo temporário + os.replace), seguras entre
+  processos que compartilham o diretório
+- Um índice que aponta para blob despejado é tratado como ausência
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+from config_loader import load_config
+from http_client import get_http_client, telegram_api_url, telegram_file_url
+from metrics import Metrics, get_metrics
+
+logger = logging.getLogger('gemini_bot')
+
+# Limite de download da Bot API
+MAX_FILE_BYTES = 20 * 1024 * 1024
+_CHUNK_SIZE = 64 * 1024
+
+
+class MediaTooLargeError(Exception):
+    """Arquivo acima do limite de tamanho do armazenamento"""
+
+
+class MediaRef:
+    """Referência a um blob armazenado"""
+
+    __slots__ = ("sha256", "path", "size")
+
+    def __init__(self, sha256: str, path: str, size: int):
+        self.sha256 = sha256
+        self.path = path
+        self.size = size
+
+    def read_bytes(self) -> bytes:
+        """Conteúdo do blob"""
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+class MediaStore:
+    """Blobs em disco deduplicados por file_unique_id e sha256"""
+
+    def __init__(self, root_dir: str = "media_cache", max_bytes: int = 2 * 1024 ** 3,
+                 max_file_bytes: int = MAX_FILE_BYTES, max_concurrent_downloads: int = 4,
+                 metrics: Optional[Metrics] = None):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.metrics = metrics or get_metrics()
+
+        self._blobs_dir = os.path.join(root_dir, "blobs")
+        self._index_dir = os.path.join(root_dir, "by_id")
+        self._tmp_dir = os.path.join(root_dir, "tmp")
+        for directory in (self._blobs_dir, self._index_dir, self._tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._total_bytes = self._scan_total()
+        self._downloads: Dict[str, asyncio.Future] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._sync_semaphore = threading.BoundedSemaphore(max_concurrent_downloads)
+
+    # ------------------------------------------------------------------
+    # Consulta
+    # ------------------------------------------------------------------
+
+    def blob_path(self, sha256: str) -> str:
+        """Caminho do blob de um sha256"""
+        return os.path.join(self._blobs_dir, sha256[:2], sha256)
+
+    def get(self, sha256: str) -> Optional[MediaRef]:
+        """Blob pelo sha256 (atualiza o acesso para o LRU)"""
+        path = self.blob_path(sha256)
+        try:
+            os.utime(path)
+            return MediaRef(sha256, path, os.path.getsize(path))
+        except OSError:
+            return None
+
+    def lookup(self, file_unique_id: str) -> Optional[MediaRef]:
+        """Blob já armazenado para o file_unique_id do Telegram"""
+        try:
+            with open(self._index_path(file_unique_id), "r", encoding="ascii") as f:
+                sha256 = f.read().strip()
+        except OSError:
+            return None
+        return self.get(sha256)
+
+    # ------------------------------------------------------------------
+    # Download (bot)
+    # ------------------------------------------------------------------
+
+    async def fetch(self, bot: Any, file_id: str, file_unique_id: str,
+                    file_size: Optional[int] = None) -> MediaRef:
+        """Blob do arquivo do Telegram, baixando apenas se ainda não estiver no disco"""
+        ref = self.lookup(file_unique_id)
+        if ref is not None:
+            self.metrics.increment("media.hits")
+            return ref
+
+        # Pedidos simultâneos do mesmo arquivo aguardam o mesmo download
+        pending = self._downloads.get(file_unique_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._downloads[file_unique_id] = future
+        try:
+            self._check_size(file_size)
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+            async with self._semaphore:
+                telegram_file = await bot.get_file(file_id)
+                self._check_size(telegram_file.file_size)
+                ref = await asyncio.to_thread(self._download, telegram_file.file_path, file_unique_id)
+            future.set_result(ref)
+            return ref
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Evita "exception was never retrieved" quando ninguém mais aguardava
+            future.exception()
+            raise
+        finally:
+            del self._downloads[file_unique_id]
+
+    # ------------------------------------------------------------------
+    # Download (workers)
+    # ------------------------------------------------------------------
+
+    def fetch_sync(self, token: str, file_id: str, file_unique_id: Optional[str] = None) -> MediaRef:
+        """Versão síncrona de fetch para processos sem event loop"""
+        if file_unique_id:
+            ref = self.lookup(file_unique_id)
+            if ref is not None:
+                self.metrics.increment("media.hits")
+                return ref
+
+        with self._sync_semaphore:
+            response = get_http_client().get(f"{telegram_api_url(token)}/getFile", params={"file_id": file_id})
+            response.raise_for_status()
+            result = response.json()["result"]
+            self._check_size(result.get("file_size"))
+            file_unique_id = file_unique_id or result["file_unique_id"]
+            ref = self.lookup(file_unique_id)
+            if ref is not None:
+                self.metrics.increment("media.hits")
+                return ref
+            return self._download(f"{telegram_file_url(token)}/{result['file_path']}", file_unique_id)
+
+    # ------------------------------------------------------------------
+    # Internos
+    # ------------------------------------------------------------------
+
+    def _check_size(self, size: Optional[int]):
+        if size and size > self.max_file_bytes:
+            self.metrics.increment("media.too_large")
+            raise MediaTooLargeError(f"Arquivo de {size} bytes excede o limite de {self.max_file_bytes}")
+
+    def _download(self, url: str, file_unique_id: str) -> MediaRef:
+        """Baixa em streaming para arquivo temporário e move para o endereço do conteúdo"""
+        started = time.monotonic()
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp, get_http_client().get(url, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        self._check_size(size)
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            sha256 = digest.hexdigest()
+            ref = self._store(tmp_path, sha256, size)
+            tmp_path = None
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+        self._write_index(file_unique_id, sha256)
+        self.metrics.increment("media.downloads")
+        self.metrics.increment("media.download_bytes", size)
+        self.metrics.observe("media.download_time", time.monotonic() - started)
+        self._evict()
+        return ref
+
+    def _store(self, tmp_path: str, sha256: str, size: int) -> MediaRef:
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            # Mesmo conteúdo com outro file_unique_id (ex.: reenvio por outro usuário)
+            os.remove(tmp_path)
+            os.utime(path)
+            self.metrics.increment("media.dedup")
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._total_bytes += size
+        return MediaRef(sha256, path, size)
+
+    def _index_path(self, file_unique_id: str) -> str:
+        return os.path.join(self._index_dir, file_unique_id)
+
+    def _write_index(self, file_unique_id: str, sha256: str):
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        with os.fdopen(fd, "w", encoding="ascii") as f:
+            f.write(sha256)
+        os.replace(tmp_path, self._index_path(file_unique_id))
+
+    def _scan_total(self) -> int:
+        total = 0
+        for directory, _, files in os.walk(self._blobs_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(directory, name))
+                except OSError:
+                    continue
+        return total
+
+    def _evict(self):
+        """Remove os blobs menos usados até ficar 10% abaixo do limite"""
+        with self._lock:
+            if self._total_bytes <= self.max_bytes:
+                return
+            blobs = []
+            for directory, _, files in os.walk(self._blobs_dir):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, path))
+            blobs.sort()
+
+            # Recalcula o total: outros processos também escrevem no diretório
+            self._total_bytes = sum(size for _, size, _ in blobs)
+            target = int(self.max_bytes * 0.9)
+            removed = 0
+            for _, size, path in blobs:
+                if self._total_bytes <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._total_bytes -= size
+                removed += 1
+        if removed:
+            self.metrics.increment("media.evicted", removed)
+            logger.info(f"{removed} arquivo(s) de mídia removido(s) do cache em disco")
+
+    def stats(self) -> Dict[str, int]:
+        """Uso do armazenamento"""
+        return {"bytes": self._total_bytes, "max_bytes": self.max_bytes, "downloading": len(self._downloads)}
+
+
+# Instância global por processo
+_media_store: Optional[MediaStore] = None
+_media_store_lock = threading.Lock()
+
+
+def get_media_store() -> MediaStore:
+    """Obtém o armazenamento de mídia do processo"""
+    global _media_store
+    with _media_store_lock:
+        if _media_store is None:
+            settings = load_config().get("media_store", {})
+            _media_store = MediaStore(
+                root_dir=settings.get("path", "media_cache"),
+                max_bytes=int(settings.get("max_mb", 2048)) * 1024 * 1024,
+                max_file_bytes=int(settings.get("max_file_mb", 20)) * 1024 * 1024,
+                max_concurrent_downloads=int(settings.get("max_concurrent_downloads", 4)),
+            )
+        return _media_store
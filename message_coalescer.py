@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Agrupamento de Mensagens por Chat
+=================================
+
+Mensagens que chegam em sequência rápida do mesmo usuário são agrupadas em
+um único lote, entregue ao callback quando a janela de silêncio expira, o
+tempo máximo de espera é atingido ou o lote fica cheio.
+
+Características:
+- Janela de debounce reiniciada a cada nova mensagem
+- Tempo máximo de espera contado a partir da primeira mensagem do lote
+- Tamanho máximo de lote (entrega imediata ao atingir)
+- Callbacks executados em tasks próprias; erros são registrados em log
+"""
+
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+logger = logging.getLogger('gemini_bot')
+
+FlushCallback = Callable[[Hashable, List[Any]], Awaitable[None]]
+
+
+class _PendingBatch:
+    """Lote em formação para uma chave"""
+
+    __slots__ = ("items", "first_at", "timer")
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.first_at = time.monotonic()
+        self.timer: Optional[asyncio.Task] = None
+
+
+class MessageCoalescer:
+    """Agrupa itens por chave dentro de uma janela de debounce"""
+
+    def __init__(self, flush_callback: FlushCallback, window_seconds: float = 0.8,
+                 max_wait_seconds: float = 3.0, max_batch: int = 5):
+        self.flush_callback = flush_callback
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.max_batch = max_batch
+        self._batches: Dict[Hashable, _PendingBatch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def pending(self, key: Hashable) -> int:
+        """Quantidade de itens aguardando para a chave"""
+        batch = self._batches.get(key)
+        return len(batch.items) if batch else 0
+
+    async def submit(self, key: Hashable, item: Any):
+        """Adiciona item ao lote da chave, agendando ou antecipando a entrega"""
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _PendingBatch()
+        batch.items.append(item)
+
+        if batch.timer:
+            batch.timer.cancel()
+
+        if len(batch.items) >= self.max_batch:
+            self._start_flush(key)
+            return
+
+        elapsed = time.monotonic() - batch.first_at
+        delay = max(0.0, min(self.window_seconds, self.max_wait_seconds - elapsed))
+        batch.timer = asyncio.create_task(self._flush_after(key, delay))
+
+    async def flush_all(self):
+        """Entrega imediatamente todos os lotes pendentes"""
+        for key in list(self._batches):
+            batch = self._batches[key]
+            if batch.timer:
+                batch.timer.cancel()
+            self._start_flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _flush_after(self, key: Hashable, delay: float):
+        await asyncio.sleep(delay)
+        self._start_flush(key)
+
+    def _start_flush(self, key: Hashable):
+        batch = self._batches.pop(key, None)
+        if not batch or not batch.items:
+            return
+        task = asyncio.create_task(self._deliver(key, batch.items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, key: Hashable, items: List[Any]):
+        try:
+            await self.flush_callback(key, items)
+        except Exception as e:
+            logger.error(f"Erro ao processar lote de mensagens ({key}): {e}")
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Métricas em Memória
+===================
+
+Contadores, gauges e janelas de latência compartilhados pelos componentes
+do bot (executor do modelo, filas, controle de admissão), consultáveis pelo
+comando /metricas dos administradores.
+"""
+
+import time
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# Amostras de latência mantidas por métrica
+LATENCY_WINDOW = 1024
+
+
+class Metrics:
+    """Registro de métricas thread-safe"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._gauges: Dict[str, float] = {}
+        # Amostras (instante monotônico, segundos), para janelas por tempo
+        self._latencies: Dict[str, Deque[Tuple[float, float]]] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def increment(self, name: str, value: int = 1):
+        """Incrementa contador"""
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name: str, value: float):
+        """Define valor instantâneo"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        """Registra amostra de latência"""
+        with self._lock:
+            self._latencies[name].append((time.monotonic(), seconds))
+
+    def percentile(self, name: str, pct: float, max_age_seconds: Optional[float] = None) -> Optional[float]:
+        """Percentil das amostras recentes (None sem amostras)
+
+        Com max_age_seconds, considera só as amostras registradas nesse
+        intervalo: picos antigos deixam de contar mesmo com pouco tráfego.
+        """
+        oldest = time.monotonic() - max_age_seconds if max_age_seconds else None
+        with self._lock:
+            samples = sorted(
+                seconds for observed_at, seconds in self._latencies.get(name, ())
+                if oldest is None or observed_at >= oldest
+            )
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cópia de todas as métricas, com p50/p95 das latências"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            latency_names = list(self._latencies)
+        latencies = {
+            name: {"p50": self.percentile(name, 50), "p95": self.percentile(name, 95)}
+            for name in latency_names
+        }
+        return {"counters": counters, "gauges": gauges, "latencies": latencies}
+
+
+# Instância global
+metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """Obtém o registro global de métricas"""
+    return metrics
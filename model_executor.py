@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Executor de Chamadas ao Modelo
+==============================
+
+Este módulo tira as chamadas síncronas ao Gemini do event loop, executando-as
+em um pool de threads limitado, com prazo por chamada e cancelamento.
+
+Funcionalidades:
+- Concorrência máxima configurável
+- Fila de espera limitada (rejeição rápida quando cheia)
+- Prazo por chamada
+- Cancelamento pelo chamador (cancelando a task que aguarda)
+- Streaming de tokens via generate_content_stream do handler
+- Métricas de profundidade de fila, chamadas em andamento e latência
+
+Características:
+- O slot só é liberado quando a thread termina de fato, então chamadas que
+  estouraram o prazo continuam contando na concorrência até acabarem
+- Chamadas ainda na fila do pool são descartadas ao serem canceladas
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+from metrics import Metrics, get_metrics
+
+logger = logging.getLogger('gemini_bot')
+
+# Marcador de fim do stream
+_STREAM_END = object()
+
+# Latência das respostas de texto ao usuário (no stream, até o primeiro token)
+INTERACTIVE_LATENCY = "model.latency.interactive"
+
+
+class ModelOverloadedError(Exception):
+    """Fila de chamadas ao modelo cheia"""
+
+
+class ModelTimeoutError(Exception):
+    """Chamada ao modelo excedeu o prazo"""
+
+
+class ModelExecutor:
+    """Pool limitado para chamadas ao handler do Gemini"""
+
+    def __init__(self, handler: Any, max_concurrency: int = 4, timeout_seconds: float = 60.0,
+                 max_queue: int = 100, metrics: Optional[Metrics] = None):
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.max_queue = max_queue
+        self.metrics = metrics or get_metrics()
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+        self._in_flight = 0
+
+        logger.info(f"Executor do modelo inicializado (concorrência={max_concurrency}, prazo={timeout_seconds}s)")
+
+    @property
+    def queue_depth(self) -> int:
+        """Chamadas aguardando slot"""
+        return self._waiting
+
+    @property
+    def in_flight(self) -> int:
+        """Chamadas em execução"""
+        return self._in_flight
+
+    async def generate_content(self, prompt: Any, timeout: Optional[float] = None,
+                               interactive: bool = False) -> str:
+        """Gera conteúdo sem bloquear o event loop"""
+        return await self.run(self.handler.generate_content, prompt, timeout=timeout, interactive=interactive)
+
+    async def run(self, func, *args, timeout: Optional[float] = None, interactive: bool = False) -> Any:
+        """Executa chamada bloqueante ao modelo no pool, respeitando fila e prazo
+
+        interactive marca respostas de texto ao usuário, que também entram
+        em INTERACTIVE_LATENCY (sem as chamadas longas de áudio e vídeo).
+        """
+        started = await self._acquire()
+        future = self._submit(func, *args)
+
+        try:
+            result = await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout if timeout is not None else self.timeout_seconds
+            )
+            self.metrics.increment("model.completed")
+            return result
+        except asyncio.TimeoutError:
+            future.cancel()
+            self.metrics.increment("model.timeouts")
+            raise ModelTimeoutError(f"Modelo não respondeu em {timeout or self.timeout_seconds}s")
+        except asyncio.CancelledError:
+            future.cancel()
+            self.metrics.increment("model.cancelled")
+            raise
+        except Exception:
+            self.metrics.increment("model.failed")
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self.metrics.observe("model.latency", elapsed)
+            if interactive:
+                self.metrics.observe(INTERACTIVE_LATENCY, elapsed)
+
+    async def stream_content(self, prompt: Any, timeout: Optional[float] = None,
+                             interactive: bool = False) -> AsyncIterator[str]:
+        """Gera conteúdo em partes, à medida que o modelo produz tokens
+        
+        O prazo vale para o stream inteiro. Encerrar o iterador antes do fim
+        (ou cancelar a task consumidora) interrompe a leitura na thread.
+        """
+        started = await self._acquire()
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop_event = threading.Event()
+
+        def produce():
+            try:
+                for chunk in self._iter_stream(prompt):
+                    if stop_event.is_set():
+                        break
+                    text = chunk if isinstance(chunk, str) else getattr(chunk, "text", "")
+                    if text:
+                        loop.call_soon_threadsafe(queue.put_nowait, text)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, _STREAM_END)
+
+        future = self._submit(produce)
+        deadline = started + (timeout if timeout is not None else self.timeout_seconds)
+        first_chunk = True
+
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                item = await asyncio.wait_for(queue.get(), remaining)
+                if item is _STREAM_END:
+                    break
+                if first_chunk:
+                    first_chunk = False
+                    first_token = time.monotonic() - started
+                    self.metrics.observe("model.first_token", first_token)
+                    if interactive:
+                        # O usuário espera pelo primeiro token, não pelo stream inteiro
+                        self.metrics.observe(INTERACTIVE_LATENCY, first_token)
+                yield item
+            # Propaga exceção do produtor, se houver
+            await asyncio.wrap_future(future)
+            self.metrics.increment("model.completed")
+        except asyncio.TimeoutError:
+            self.metrics.increment("model.timeouts")
+            raise ModelTimeoutError(f"Modelo não concluiu o stream em {timeout or self.timeout_seconds}s")
+        except (asyncio.CancelledError, GeneratorExit):
+            self.metrics.increment("model.cancelled")
+            raise
+        except Exception:
+            self.metrics.increment("model.failed")
+            raise
+        finally:
+            stop_event.set()
+            future.cancel()
+            elapsed = time.monotonic() - started
+            self.metrics.observe("model.latency", elapsed)
+            if interactive and first_chunk:
+                self.metrics.observe(INTERACTIVE_LATENCY, elapsed)
+
+    def _iter_stream(self, prompt: Any) -> Iterator[Any]:
+        """Itera o stream do handler; sem suporte a stream, entrega a resposta inteira"""
+        stream_fn = getattr(self.handler, "generate_content_stream", None)
+        if stream_fn is None:
+            yield self.handler.generate_content(prompt)
+            return
+        yield from stream_fn(prompt)
+
+    async def _acquire(self) -> float:
+        """Aguarda slot no pool (rejeitando se a fila estiver cheia)"""
+        if self._waiting >= self.max_queue:
+            self.metrics.increment("model.rejected")
+            raise ModelOverloadedError(f"{self._waiting} chamadas aguardando")
+
+        queued_at = time.monotonic()
+        self._waiting += 1
+        self._update_gauges()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        started = time.monotonic()
+        self.metrics.observe("model.queue_wait", started - queued_at)
+        self._in_flight += 1
+        self._update_gauges()
+        return started
+
+    def _submit(self, func, *args) -> Future:
+        """Envia a chamada ao pool; o slot volta quando a thread termina"""
+        loop = asyncio.get_running_loop()
+        future: Future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        return future
+
+    def _release(self):
+        self._in_flight -= 1
+        self._semaphore.release()
+        self._update_gauges()
+
+    def _update_gauges(self):
+        self.metrics.set_gauge("model.queue_depth", self._waiting)
+        self.metrics.set_gauge("model.in_flight", self._in_flight)
+
+    def stats(self) -> Dict[str, Any]:
+        """Resumo do estado do pool"""
+        return {
+            "queue_depth": self._waiting,
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "latency_p50": self.metrics.percentile("model.latency", 50),
+            "latency_p95": self.metrics.percentile("model.latency", 95),
+        }
+
+    def shutdown(self):
+        """Encerra o pool descartando chamadas pendentes"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+OCR Local de Imagens
+====================
+
+Extrai o texto de capturas de tela, documentos e fotos com texto usando o
+Tesseract instalado no contêiner, em vez de pedir a extração ao modelo.
+
+Funcionalidades:
+- Heurística barata de probabilidade de texto (densidade de bordas
+  horizontais e estrutura em linhas) antes de rodar o OCR
+- Pré-processamento (tons de cinza, ampliação de imagens pequenas,
+  autocontraste) e Tesseract em processos de trabalho (ProcessPoolExecutor)
+- Texto extraído em cache no api_cache pelo sha256 da imagem
+
+Características:
+- O cache usa o hash exato do conteúdo: duas capturas quase iguais podem
+  ter textos diferentes, então o hash perceptual não serve aqui
+- Imagens sem texto provável também ficam em cache (texto vazio)
+- Sem Tesseract no sistema, a etapa é desativada com um aviso
+"""
+
+import io
+import shutil
+import asyncio
+import hashlib
+import logging
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import database
+from metrics import Metrics, get_metrics
+from process_pool import create_process_pool
+
+logger = logging.getLogger('gemini_bot')
+
+_KEY_PREFIX = "ocr:"
+
+# Lado usado pela heurística e lado mínimo para o OCR
+_HEURISTIC_SIDE = 512
+_OCR_MIN_SIDE = 1000
+_EDGE_THRESHOLD = 40
+
+
+def text_likelihood(image: Image.Image) -> float:
+    """Pontuação 0..1 de a imagem conter texto
+
+    Texto gera muitas transições fortes e curtas de brilho na horizontal,
+    concentradas em faixas (as linhas) separadas por faixas quase vazias.
+    """
+    gray = image.convert("L")
+    gray.thumbnail((_HEURISTIC_SIDE, _HEURISTIC_SIDE))
+    pixels = np.asarray(gray, dtype=np.int16)
+    if pixels.shape[0] < 8 or pixels.shape[1] < 8:
+        return 0.0
+
+    edges = np.abs(np.diff(pixels, axis=1)) > _EDGE_THRESHOLD
+    density = float(edges.mean())
+    rows = edges.mean(axis=1)
+    if density == 0.0:
+        return 0.0
+
+    # Variação entre linhas (texto alterna linhas cheias e vazias)
+    row_variation = float(rows.std() / (rows.mean() + 1e-6))
+    # Fração de linhas quase sem bordas (entrelinhas e margens)
+    blank_rows = float((rows < density * 0.2).mean())
+
+    density_score = min(1.0, density / 0.04) if density <= 0.3 else max(0.0, 1.0 - (density - 0.3) / 0.2)
+    structure_score = min(1.0, row_variation / 1.2) * 0.6 + min(1.0, blank_rows / 0.3) * 0.4
+    return density_score * structure_score
+
+
+def _prepare_for_ocr(image: Image.Image) -> bytes:
+    gray = ImageOps.autocontrast(ImageOps.exif_transpose(image).convert("L"))
+    side = max(gray.size)
+    if side < _OCR_MIN_SIDE:
+        # Tesseract erra muito com letras pequenas
+        scale = _OCR_MIN_SIDE / side
+        gray = gray.resize((int(gray.width * scale), int(gray.height * scale)), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    gray.save(output, format="PNG")
+    return output.getvalue()
+
+
+def ocr_image(data: bytes, languages: str = "por+eng", min_score: float = 0.3,
+              timeout_seconds: float = 30.0, tesseract_path: str = "tesseract") -> Tuple[float, str]:
+    """Pontuação da heurística e texto extraído (vazio se não valer o OCR); roda no processo de trabalho"""
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        score = text_likelihood(image)
+        if score < min_score:
+            return score, ""
+        png = _prepare_for_ocr(image)
+
+    result = subprocess.run(
+        [tesseract_path, "stdin", "stdout", "-l", languages, "--psm", "3"],
+        input=png, capture_output=True, timeout=timeout_seconds, check=True,
+    )
+    return score, result.stdout.decode("utf-8", "replace").strip()
+
+
+class OcrStage:
+    """Etapa de OCR do pipeline de imagens"""
+
+    def __init__(self, workers: int = 1, languages: str = "por+eng", min_score: float = 0.3,
+                 min_chars: int = 20, timeout_seconds: float = 30.0, ttl_seconds: int = 30 * 24 * 3600,
+                 tesseract_path: str = "tesseract", metrics: Optional[Metrics] = None):
+        self.workers = workers
+        self.languages = languages
+        self.min_score = min_score
+        self.min_chars = min_chars
+        self.timeout_seconds = timeout_seconds
+        self.ttl_seconds = ttl_seconds
+        self.tesseract_path = tesseract_path
+        self.metrics = metrics or get_metrics()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+        self.available = shutil.which(tesseract_path) is not None
+        if not self.available:
+            logger.warning("Tesseract não encontrado: OCR local desativado")
+
+    async def extract(self, data: bytes) -> Optional[str]:
+        """Texto da imagem, ou None se ela não tiver texto relevante"""
+        if not self.available:
+            return None
+
+        key = _KEY_PREFIX + hashlib.sha256(data).hexdigest()
+        cached = self._get_cached(key)
+        if cached is not None:
+            return cached or None
+
+        if self._pool is None:
+            self._pool = create_process_pool(self.workers)
+        loop = asyncio.get_running_loop()
+        try:
+            score, text = await loop.run_in_executor(
+                self._pool, ocr_image, data, self.languages, self.min_score,
+                self.timeout_seconds, self.tesseract_path,
+            )
+        except Exception as e:
+            logger.error(f"Erro ao executar OCR: {e}")
+            self.metrics.increment("ocr.failed")
+            return None
+
+        if score < self.min_score:
+            self.metrics.increment("ocr.skipped")
+        else:
+            self.metrics.increment("ocr.executed")
+        if len(text) < self.min_chars:
+            text = ""
+        self._put(key, text)
+        return text or None
+
+    def shutdown(self):
+        """Encerra os processos de OCR"""
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _get_cached(self, key: str) -> Optional[str]:
+        try:
+            cached = database.cache_get(key)
+            if cached is not None:
+                self.metrics.increment("ocr.cache_hits")
+                return cached.get("text", "")
+        except Exception as e:
+            logger.error(f"Erro ao consultar cache de OCR: {e}")
+        return None
+
+    def _put(self, key: str, text: str):
+        try:
+            database.cache_set(key, {"text": text}, ttl_seconds=self.ttl_seconds)
+        except Exception as e:
+            logger.error(f"Erro ao salvar OCR no cache: {e}")
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+Envio Centralizado ao Telegram
+==============================
+
+Todo envio de mensagem passa por aqui para respeitar os limites de flood do
+Telegram (cerca de 30 mensagens/s no total e 1 mensagem/s por chat; 20 por
+minuto em grupos) em vez de desperdiçar requisições com erros 429.
+
+Funcionalidades:
+- OutboundSender (bot, assíncrono): fila com classes de prioridade, token
+  bucket global e por chat, tratamento de retry_after, agrupamento de
+  edições seguidas da mesma mensagem e divisão automática de textos longos
+- SyncTelegramSender (tarefas Celery e alertas de log): mesmos limites via
+  HTTP síncrono (sessão keep-alive compartilhada), com espera bloqueante ou
+  descarte
+
+Características:
+- No máximo um envio em andamento por chat (a ordem dos pedaços é mantida)
+- Chats limitados não bloqueiam os demais
+- Os limites valem por processo; bot e workers não compartilham buckets
+"""
+
+import time
+import heapq
+import asyncio
+import logging
+import threading
+from itertools import count
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from telegram import Message
+from telegram.constants import ChatType
+from telegram.error import BadRequest, RetryAfter
+
+from admission_control import TokenBucket
+from http_client import HttpClient, get_http_client, telegram_api_url
+from metrics import Metrics, get_metrics
+from telegram_text import split_message
+
+logger = logging.getLogger('gemini_bot')
+
+# Classes de prioridade (menor sai primeiro)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_EDIT = 1
+PRIORITY_NOTIFICATION = 2
+PRIORITY_BULK = 3
+
+# Limites padrão do Telegram
+GLOBAL_RATE = 30.0
+PRIVATE_CHAT_RATE = 1.0
+GROUP_CHAT_RATE = 20.0 / 60
+CHAT_BURST = 3.0
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    total_seconds = getattr(retry_after, "total_seconds", None)
+    return float(total_seconds() if total_seconds else retry_after)
+
+
+def _chat_rate(chat_id: int, private_rate: float, group_rate: float) -> float:
+    # IDs negativos são grupos, supergrupos e canais
+    return group_rate if int(chat_id) < 0 else private_rate
+
+
+class _Job:
+    """Chamada pendente à Bot API"""
+
+    __slots__ = ("priority", "seq", "chat_id", "method", "kwargs", "futures", "coalesce_key", "queued_at")
+
+    def __init__(self, priority: int, seq: int, chat_id: int, method: str, kwargs: Dict[str, Any],
+                 future: asyncio.Future, coalesce_key: Optional[Tuple] = None):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.coalesce_key = coalesce_key
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def resolve(self, result: Any = None, error: Optional[BaseException] = None):
+        for future in self.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class OutboundSender:
+    """Fila de saída do bot com limites globais e por chat"""
+
+    def __init__(self, bot: Any, global_rate: float = GLOBAL_RATE, private_chat_rate: float = PRIVATE_CHAT_RATE,
+                 group_chat_rate: float = GROUP_CHAT_RATE, chat_burst: float = CHAT_BURST,
+                 max_in_flight: int = 8, max_retries: int = 3, metrics: Optional[Metrics] = None):
+        self.bot = bot
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.metrics = metrics or get_metrics()
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._chat_paused_until: Dict[int, float] = {}
+        self._busy_chats: set = set()
+        self._heap: List[_Job] = []
+        self._coalescing: Dict[Tuple, _Job] = {}
+        self._attempts: Dict[int, int] = {}
+        self._seq = count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    async def send_text(self, chat_id: int, text: str, priority: int = PRIORITY_INTERACTIVE,
+                        **kwargs) -> List[Message]:
+        """Envia texto dividido em pedaços de até 4096 caracteres
+
+        O teclado (reply_markup) vai apenas no último pedaço. Se um texto
+        dividido tiver a formatação rejeitada, o pedaço é reenviado sem
+        parse_mode.
+        """
+        chunks = [chunk for chunk in split_message(text) if chunk.strip()] or [text]
+        reply_markup = kwargs.pop("reply_markup", None)
+        futures = []
+        for index, chunk in enumerate(chunks):
+            is_last = index == len(chunks) - 1
+            chunk_kwargs = dict(kwargs, chat_id=chat_id, text=chunk)
+            if is_last and reply_markup is not None:
+                chunk_kwargs["reply_markup"] = reply_markup
+            futures.append(self._enqueue(priority, chat_id, "send_message", chunk_kwargs))
+
+        messages = []
+        for index, future in enumerate(futures):
+            try:
+                messages.append(await future)
+            except BadRequest as e:
+                if len(chunks) == 1 or not kwargs.get("parse_mode"):
+                    raise
+                logger.warning(f"Formatação rejeitada no pedaço {index + 1}/{len(chunks)}, reenviando sem formatação: {e}")
+                plain_kwargs = {key: value for key, value in kwargs.items() if key != "parse_mode"}
+                if index == len(chunks) - 1 and reply_markup is not None:
+                    plain_kwargs["reply_markup"] = reply_markup
+                messages.append(await self._enqueue(
+                    priority, chat_id, "send_message", dict(plain_kwargs, chat_id=chat_id, text=chunks[index])
+                ))
+        return messages
+
+    async def reply_text(self, message: Message, text: str, priority: int = PRIORITY_INTERACTIVE,
+                         **kwargs) -> Message:
+        """Equivalente a Message.reply_text passando pela fila (retorna o último pedaço)"""
+        if message.chat.type != ChatType.PRIVATE:
+            # Em grupos, Message.reply_text cita a mensagem original
+            kwargs.setdefault("reply_to_message_id", message.message_id)
+        messages = await self.send_text(message.chat_id, text, priority=priority, **kwargs)
+        return messages[-1]
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str,
+                                priority: int = PRIORITY_EDIT, **kwargs) -> Any:
+        """Edita mensagem; edições ainda na fila para a mesma mensagem são agrupadas"""
+        kwargs.update(chat_id=chat_id, message_id=message_id, text=text)
+        return await self._enqueue(priority, chat_id, "edit_message_text", kwargs,
+                                   coalesce_key=("edit", chat_id, message_id))
+
+    def send_chat_action(self, chat_id: int, action: str, priority: int = PRIORITY_NOTIFICATION) -> asyncio.Future:
+        """Indicador de atividade sem aguardar o envio (um pendente por chat)"""
+        future = self._enqueue(priority, chat_id, "send_chat_action",
+                               {"chat_id": chat_id, "action": action},
+                               coalesce_key=("action", chat_id))
+        # Melhor esforço: falhas não interessam a ninguém
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def stats(self) -> Dict[str, int]:
+        """Tamanho da fila e envios em andamento"""
+        return {"queued": len(self._heap), "in_flight": len(self._in_flight), "paused_chats": len(self._chat_paused_until)}
+
+    async def drain(self, timeout: float = 10.0):
+        """Aguarda a fila esvaziar (até timeout)"""
+        deadline = time.monotonic() + timeout
+        while (self._heap or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def stop(self):
+        """Encerra o despachante, falhando envios pendentes"""
+        if self._runner:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        while self._heap:
+            heapq.heappop(self._heap).resolve(error=RuntimeError("Fila de envio encerrada"))
+        self._coalescing.clear()
+
+    # ------------------------------------------------------------------
+    # Fila
+    # ------------------------------------------------------------------
+
+    def _enqueue(self, priority: int, chat_id: int, method: str, kwargs: Dict[str, Any],
+                 coalesce_key: Optional[Tuple] = None) -> asyncio.Future:
+        self._ensure_running()
+        future = asyncio.get_running_loop().create_future()
+
+        if coalesce_key is not None:
+            pending = self._coalescing.get(coalesce_key)
+            if pending is not None:
+                # Ainda não enviado: vale só o conteúdo mais recente
+                pending.kwargs = kwargs
+                pending.futures.append(future)
+                if priority < pending.priority:
+                    pending.priority = priority
+                    heapq.heapify(self._heap)
+                self.metrics.increment("outbound.coalesced")
+                return future
+
+        job = _Job(priority, next(self._seq), chat_id, method, kwargs, future, coalesce_key)
+        if coalesce_key is not None:
+            self._coalescing[coalesce_key] = job
+        heapq.heappush(self._heap, job)
+        self.metrics.set_gauge("outbound.queued", len(self._heap))
+        self._wakeup.set()
+        return future
+
+    def _ensure_running(self):
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._runner = asyncio.create_task(self._run(), name="outbound-sender")
+
+    async def _run(self):
+        while True:
+            job, wait = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            task = asyncio.create_task(self._send(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    def _next_job(self) -> Tuple[Optional[_Job], Optional[float]]:
+        """Próximo envio permitido agora, ou quanto esperar (None: até novo evento)"""
+        now = time.monotonic()
+        blocked: List[_Job] = []
+        chosen: Optional[_Job] = None
+        wait: Optional[float] = None
+
+        while self._heap:
+            job = heapq.heappop(self._heap)
+            if all(future.done() for future in job.futures):
+                # Todos os interessados desistiram (ex.: geração cancelada)
+                self._coalescing.pop(job.coalesce_key, None)
+                continue
+            ready_in = self._chat_ready_in(job.chat_id, now)
+            if ready_in == 0.0:
+                chosen = job
+                break
+            blocked.append(job)
+            if ready_in is not None:
+                wait = ready_in if wait is None else min(wait, ready_in)
+
+        for job in blocked:
+            heapq.heappush(self._heap, job)
+
+        if chosen is not None:
+            if not self._global.try_acquire():
+                heapq.heappush(self._heap, chosen)
+                return None, self._global.retry_after()
+            self._chat_bucket(chosen.chat_id).try_acquire()
+            self._busy_chats.add(chosen.chat_id)
+            self._coalescing.pop(chosen.coalesce_key, None)
+        self.metrics.set_gauge("outbound.queued", len(self._heap))
+        return chosen, wait
+
+    def _chat_ready_in(self, chat_id: int, now: float) -> Optional[float]:
+        """Segundos até o chat poder enviar (None: aguardando envio em andamento)"""
+        if chat_id in self._busy_chats:
+            return None
+        paused_until = self._chat_paused_until.get(chat_id)
+        if paused_until is not None:
+            if paused_until > now:
+                return paused_until - now
+            del self._chat_paused_until[chat_id]
+        return self._chat_bucket(chat_id).retry_after()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = _chat_rate(chat_id, self.private_chat_rate, self.group_chat_rate)
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _send(self, job: _Job):
+        self.metrics.observe("outbound.wait", time.monotonic() - job.queued_at)
+        try:
+            result = await getattr(self.bot, job.method)(**job.kwargs)
+            self._attempts.pop(job.seq, None)
+            self.metrics.increment("outbound.sent")
+            job.resolve(result)
+        except RetryAfter as e:
+            retry_after = _retry_after_seconds(e)
+            self.metrics.increment("outbound.retry_after")
+            attempts = self._attempts.get(job.seq, 0) + 1
+            if attempts > self.max_retries:
+                self._attempts.pop(job.seq, None)
+                job.resolve(error=e)
+            else:
+                # Mesma posição na fila: a ordem do chat é preservada
+                self._attempts[job.seq] = attempts
+                self._chat_paused_until[job.chat_id] = time.monotonic() + retry_after
+                logger.warning(f"Flood control no chat {job.chat_id}: aguardando {retry_after:.0f}s")
+                if job.coalesce_key is not None:
+                    self._coalescing.setdefault(job.coalesce_key, job)
+                heapq.heappush(self._heap, job)
+        except Exception as e:
+            self._attempts.pop(job.seq, None)
+            self.metrics.increment("outbound.failed")
+            job.resolve(error=e)
+        finally:
+            self._busy_chats.discard(job.chat_id)
+            self._slots.release()
+            self._trim_buckets()
+            self._wakeup.set()
+
+    def _trim_buckets(self):
+        # Buckets cheios equivalem a buckets novos: descartar mantém a memória limitada
+        if len(self._chat_buckets) < 10000:
+            return
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if bucket.retry_after(bucket.capacity) == 0.0 and chat_id not in self._busy_chats]:
+            del self._chat_buckets[chat_id]
+
+
+class SyncTelegramSender:
+    """Envio síncrono (HTTP) com os mesmos limites, para processos sem event loop"""
+
+    def __init__(self, token: str, global_rate: float = GLOBAL_RATE, private_chat_rate: float = PRIVATE_CHAT_RATE,
+                 group_chat_rate: float = GROUP_CHAT_RATE, chat_burst: float = CHAT_BURST,
+                 max_retries: int = 3, http_client: Optional[HttpClient] = None,
+                 metrics: Optional[Metrics] = None):
+        self.api_url = telegram_api_url(token) if token else None
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.http_client = http_client
+        self.metrics = metrics or get_metrics()
+
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._chat_paused_until: Dict[int, float] = {}
+
+    def send_message(self, chat_id: int, text: str, parse_mode: Optional[str] = None,
+                     block: bool = True) -> bool:
+        """Envia texto (dividido se necessário); com block=False descarta se limitado"""
+        if not self.api_url:
+            return False
+        for chunk in split_message(text):
+            if not chunk.strip():
+                continue
+            if not self._post_with_limits(chat_id, {"chat_id": chat_id, "text": chunk, "parse_mode": parse_mode}, block):
+                return False
+        return True
+
+    def _post_with_limits(self, chat_id: int, payload: Dict[str, Any], block: bool) -> bool:
+        for _ in range(self.max_retries + 1):
+            wait = self._reserve(chat_id)
+            if wait > 0:
+                if not block:
+                    self.metrics.increment("outbound.dropped")
+                    return False
+                time.sleep(wait)
+                continue
+
+            body = {key: value for key, value in payload.items() if value is not None}
+            try:
+                # Cliente resolvido a cada envio: workers criados via fork usam o próprio pool
+                client = self.http_client or get_http_client()
+                response = client.post(f"{self.api_url}/sendMessage", json=body)
+            except requests.RequestException as e:
+                logger.warning(f"Falha ao enviar mensagem ao chat {chat_id}: {e}")
+                self.metrics.increment("outbound.failed")
+                return False
+
+            if response.status_code == 429:
+                retry_after = float(self._parameters(response).get("retry_after", 1))
+                self.metrics.increment("outbound.retry_after")
+                with self._lock:
+                    self._chat_paused_until[chat_id] = time.monotonic() + retry_after
+                if not block:
+                    return False
+                continue
+            if response.status_code == 400 and payload.get("parse_mode"):
+                # Formatação rejeitada: reenviar como texto puro
+                payload = dict(payload, parse_mode=None)
+                continue
+            if not response.ok:
+                self.metrics.increment("outbound.failed")
+                return False
+            self.metrics.increment("outbound.sent")
+            return True
+        return False
+
+    def _reserve(self, chat_id: int) -> float:
+        """Consome cota global e do chat; retorna quanto esperar se não houver"""
+        with self._lock:
+            now = time.monotonic()
+            paused_until = self._chat_paused_until.get(chat_id, 0.0)
+            if paused_until > now:
+                return paused_until - now
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                rate = _chat_rate(chat_id, self.private_chat_rate, self.group_chat_rate)
+                bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+            chat_wait = bucket.retry_after()
+            global_wait = self._global.retry_after()
+            if chat_wait > 0 or global_wait > 0:
+                return max(chat_wait, global_wait)
+            bucket.try_acquire()
+            self._global.try_acquire()
+            return 0.0
+
+    @staticmethod
+    def _parameters(response: requests.Response) -> Dict[str, Any]:
+        try:
+            return response.json().get("parameters", {}) or {}
+        except ValueError:
+            return {}
+
+
+# Instâncias síncronas por token
+_sync_senders: Dict[str, SyncTelegramSender] = {}
+_sync_senders_lock = threading.Lock()
+
+
+def get_sync_sender(token: str) -> SyncTelegramSender:
+    """Obtém o enviador síncrono do processo para o token"""
+    with _sync_senders_lock:
+        sender = _sync_senders.get(token)
+        if sender is None:
+            sender = _sync_senders[token] = SyncTelegramSender(token)
+        return sender
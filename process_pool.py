@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Pools de Processos
+==================
+
+Cria os ProcessPoolExecutor usados para trabalho de CPU (vídeo, OCR e o
+backend local de tarefas) sem herdar o estado do processo do bot.
+
+Características:
+- Usa "forkserver" (ou "spawn" onde ele não existe) em vez do "fork"
+  padrão: o bot tem muitas threads (executor do modelo, sender, snapshot,
+  cliente HTTP) e um filho criado por fork com um lock dessas threads
+  ocupado trava para sempre
+- Os filhos partem de um processo limpo e importam só o módulo da função
+  executada, então não compartilham conexões SQLite nem sessões HTTP
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _start_method() -> str:
+    methods = multiprocessing.get_all_start_methods()
+    return "forkserver" if "forkserver" in methods else "spawn"
+
+
+def create_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Pool de processos com filhos que não herdam threads nem locks do bot"""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(_start_method()))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Cache de Respostas
+==================
+
+Reaproveita respostas do modelo para prompts repetidos ("oi", perguntas
+frequentes, assuntos do momento) enviados com a mesma personalidade e sem
+contexto multimodal, evitando novas chamadas ao Gemini.
+
+Funcionalidades:
+- Chave: hash da mensagem normalizada + personalidade + impressão do contexto
+  multimodal + impressão do histórico usado na geração
+- Prompts pessoais ou que dependem da conversa não são cacheados
+- Armazenamento na tabela api_cache (com TTL)
+- Correspondência opcional de quase-duplicatas por shingles de caracteres
+
+Características:
+- O índice de quase-duplicatas fica em memória (limitado, LRU) e só aponta
+  para chaves exatas; o valor continua vindo do api_cache
+- A resposta é gerada a partir do histórico recente, então ele entra na
+  chave: respostas nunca passam de uma conversa para outra diferente
+- Referências à conversa ("isso", "acima", "continue") continuam fora do
+  cache, já que dependem do histórico mesmo quando ele coincide
+"""
+
+import re
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict, defaultdict
+from typing import Dict, FrozenSet, Optional, Sequence, Set, Tuple
+
+import database
+from metrics import Metrics, get_metrics
+
+logger = logging.getLogger('gemini_bot')
+
+_KEY_PREFIX = "resp:"
+
+# Tamanho dos shingles de caracteres
+SHINGLE_SIZE = 3
+
+# Palavras que indicam prompt pessoal ou dependente da conversa
+_PERSONAL_WORDS = frozenset({
+    "eu", "meu", "minha", "meus", "minhas", "me", "mim", "comigo", "nos", "nosso", "nossa",
+    "i", "my", "mine", "we", "our",
+})
+_CONTEXTUAL_WORDS = frozenset({
+    "isso", "isto", "disso", "nisso", "esse", "essa", "este", "esta", "acima", "anterior",
+    "continue", "continua", "continuar", "depois", "ela", "ele", "dela", "dele",
+    "imagem", "foto", "audio", "video", "that", "this", "above", "previous",
+})
+_SENSITIVE_PATTERN = re.compile(r"https?://|www\.|@|\d{4,}")
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Minúsculas, sem acentos, sem pontuação e com espaços colapsados"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = _NON_WORD.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def shingles(normalized: str, size: int = SHINGLE_SIZE) -> FrozenSet[str]:
+    """Conjunto de n-gramas de caracteres do texto normalizado"""
+    padded = f" {normalized} "
+    if len(padded) <= size:
+        return frozenset({padded})
+    return frozenset(padded[i:i + size] for i in range(len(padded) - size + 1))
+
+
+def history_digest(history: Sequence[Tuple[str, str]]) -> str:
+    """Impressão do histórico (papel e conteúdo de cada mensagem, em ordem)"""
+    digest = hashlib.sha256()
+    for role, content in history:
+        digest.update(f"{role}\x00{content}\x01".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PromptKey:
+    """Chave de cache de um prompt cacheável"""
+
+    __slots__ = ("key", "scope", "shingles")
+
+    def __init__(self, key: str, scope: str, prompt_shingles: FrozenSet[str]):
+        self.key = key
+        self.scope = scope
+        self.shingles = prompt_shingles
+
+
+class ResponseCache:
+    """Cache de respostas do modelo sobre o api_cache"""
+
+    def __init__(self, ttl_seconds: int = 3600, near_duplicates: bool = True,
+                 similarity_threshold: float = 0.85, max_prompt_chars: int = 200,
+                 max_index_entries: int = 5000, metrics: Optional[Metrics] = None):
+        self.ttl_seconds = ttl_seconds
+        self.near_duplicates = near_duplicates
+        self.similarity_threshold = similarity_threshold
+        self.max_prompt_chars = max_prompt_chars
+        self.max_index_entries = max_index_entries
+        self.metrics = metrics or get_metrics()
+
+        # Índice de quase-duplicatas: chave -> (escopo, shingles) e shingle -> chaves
+        self._entries: "OrderedDict[str, PromptKey]" = OrderedDict()
+        self._postings: Dict[str, Dict[str, Set[str]]] = defaultdict(lambda: defaultdict(set))
+
+    def prepare(self, message: str, personality: str, context: str = "",
+                history: Sequence[Tuple[str, str]] = ()) -> Optional[PromptKey]:
+        """Calcula a chave do prompt, ou None se ele não deve ser cacheado
+
+        history são as mensagens (papel, conteúdo) anteriores ao prompt que
+        entram na geração; duas conversas só compartilham resposta se forem
+        idênticas.
+        """
+        if context:
+            # Mensagem enriquecida com contexto multimodal do usuário
+            return None
+        if len(message) > self.max_prompt_chars or _SENSITIVE_PATTERN.search(message):
+            return None
+
+        normalized = normalize_prompt(message)
+        if not normalized:
+            return None
+        words = set(normalized.split())
+        if words & _PERSONAL_WORDS or words & _CONTEXTUAL_WORDS:
+            return None
+
+        # Números entram no escopo: "2 + 2" e "2 + 3" nunca são quase-duplicatas
+        numbers = " ".join(word for word in normalized.split() if any(ch.isdigit() for ch in word))
+        history_fingerprint = history_digest(history)
+        scope = hashlib.sha256(
+            f"{personality}\x00{context}\x00{numbers}\x00{history_fingerprint}".encode("utf-8")
+        ).hexdigest()[:16]
+        digest = hashlib.sha256(f"{scope}\x00{normalized}".encode("utf-8")).hexdigest()
+        return PromptKey(_KEY_PREFIX + digest, scope, shingles(normalized))
+
+    def get(self, prompt: PromptKey) -> Optional[str]:
+        """Resposta em cache para o prompt (exata ou quase-duplicata)"""
+        try:
+            cached = database.cache_get(prompt.key)
+            if cached is not None:
+                self.metrics.increment("response_cache.hits")
+                return cached.get("response")
+
+            if self.near_duplicates:
+                similar_key = self._find_similar(prompt)
+                if similar_key:
+                    cached = database.cache_get(similar_key)
+                    if cached is not None:
+                        self.metrics.increment("response_cache.near_hits")
+                        return cached.get("response")
+                    # Expirou no banco: remover do índice
+                    self._unindex(similar_key)
+        except Exception as e:
+            logger.error(f"Erro ao consultar cache de respostas: {e}")
+
+        self.metrics.increment("response_cache.misses")
+        return None
+
+    def put(self, prompt: PromptKey, response: str):
+        """Armazena resposta gerada para o prompt"""
+        if not response or not response.strip():
+            return
+        try:
+            database.cache_set(prompt.key, {"response": response}, ttl_seconds=self.ttl_seconds)
+            if self.near_duplicates:
+                self._index(prompt)
+        except Exception as e:
+            logger.error(f"Erro ao salvar no cache de respostas: {e}")
+
+    def _find_similar(self, prompt: PromptKey) -> Optional[str]:
+        postings = self._postings.get(prompt.scope)
+        if not postings:
+            return None
+
+        # Conta shingles em comum apenas entre candidatos que compartilham algum
+        overlap: Dict[str, int] = defaultdict(int)
+        for shingle in prompt.shingles:
+            for key in postings.get(shingle, ()):
+                overlap[key] += 1
+
+        best_key, best_score = None, 0.0
+        for key, common in overlap.items():
+            other = self._entries[key].shingles
+            score = common / (len(prompt.shingles) + len(other) - common)
+            if score > best_score:
+                best_key, best_score = key, score
+
+        if best_key is None or best_score < self.similarity_threshold:
+            return None
+        self._entries.move_to_end(best_key)
+        return best_key
+
+    def _index(self, prompt: PromptKey):
+        if prompt.key in self._entries:
+            self._entries.move_to_end(prompt.key)
+            return
+        self._entries[prompt.key] = prompt
+        postings = self._postings[prompt.scope]
+        for shingle in prompt.shingles:
+            postings[shingle].add(prompt.key)
+        while len(self._entries) > self.max_index_entries:
+            self._unindex(next(iter(self._entries)))
+
+    def _unindex(self, key: str):
+        prompt = self._entries.pop(key, None)
+        if prompt is None:
+            return
+        postings = self._postings.get(prompt.scope)
+        if postings is None:
+            return
+        for shingle in prompt.shingles:
+            keys = postings.get(shingle)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del postings[shingle]
+        if not postings:
+            del self._postings[prompt.scope]
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Registro de Sessões
+===================
+
+Mapeia cada usuário para a conversa ativa em memória, compartilhado por
+todos os handlers. Uma nova sessão (e uma nova conversa no banco) só é
+criada quando a anterior fica ociosa além do limite configurado.
+
+Funcionalidades:
+- Consulta sem acesso ao banco enquanto a sessão está ativa
+- Nova sessão após o tempo de ociosidade
+- Criação da conversa fora do event loop, sem duplicar pedidos simultâneos
+- Seção própria no snapshot binário (sessões ativas sobrevivem ao reinício)
+
+Características:
+- Limite de sessões em memória (LRU); a sessão descartada é recriada no
+  próximo uso
+"""
+
+import time
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger('gemini_bot')
+
+# conversation_id, início e última atividade (epoch)
+_SESSION = struct.Struct("<qdd")
+
+
+class Session:
+    """Sessão ativa de um usuário"""
+
+    __slots__ = ("conversation_id", "started_at", "last_seen")
+
+    def __init__(self, conversation_id: int, started_at: float, last_seen: float):
+        self.conversation_id = conversation_id
+        self.started_at = started_at
+        self.last_seen = last_seen
+
+    @property
+    def session_id(self) -> str:
+        """Identificador da sessão no formato usado pelo ConversationManager"""
+        return f"session_{int(self.started_at)}"
+
+
+class SessionRegistry:
+    """Sessões ativas por usuário"""
+
+    def __init__(self, conversation_manager: Any, idle_timeout_seconds: float = 1800,
+                 max_sessions: int = 100000):
+        self.conversation_manager = conversation_manager
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._creating: Dict[str, asyncio.Future] = {}
+
+    async def get_conversation_id(self, user_id: str) -> int:
+        """Conversa ativa do usuário, iniciando nova sessão se necessário"""
+        now = time.time()
+        session = self._sessions.get(user_id)
+        if session is not None and now - session.last_seen <= self.idle_timeout_seconds:
+            session.last_seen = now
+            self._sessions.move_to_end(user_id)
+            return session.conversation_id
+
+        # Pedidos simultâneos do mesmo usuário aguardam a mesma criação
+        pending = self._creating.get(user_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._creating[user_id] = future
+        try:
+            session = await self._start_session(user_id, now)
+            future.set_result(session.conversation_id)
+            return session.conversation_id
+        except Exception as e:
+            future.set_exception(e)
+            # Evita "exception was never retrieved" quando ninguém mais aguardava
+            future.exception()
+            raise
+        finally:
+            del self._creating[user_id]
+
+    def end_session(self, user_id: str):
+        """Encerra a sessão; a próxima mensagem abre uma conversa nova"""
+        self._sessions.pop(user_id, None)
+
+    async def _start_session(self, user_id: str, now: float) -> Session:
+        session_id = f"session_{int(now)}"
+        conversation_id = await asyncio.to_thread(
+            self.conversation_manager.get_or_create_conversation, user_id, session_id
+        )
+        session = Session(conversation_id, now, now)
+        self._store(user_id, session)
+        logger.debug(f"Nova sessão {session_id} para usuário {user_id} (conversa {conversation_id})")
+        return session
+
+    def _store(self, user_id: str, session: Session):
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Total de sessões em memória"""
+        return {"sessions": len(self._sessions)}
+
+    def dump_cache(self) -> Iterator[Tuple[str, bytes]]:
+        """Sessões ainda ativas para o snapshot"""
+        cutoff = time.time() - self.idle_timeout_seconds
+        for user_id, session in list(self._sessions.items()):
+            if session.last_seen >= cutoff:
+                yield user_id, _SESSION.pack(session.conversation_id, session.started_at, session.last_seen)
+
+    def load_cache(self, entries: Iterator[Tuple[str, bytes]]) -> int:
+        """Restaura sessões do snapshot (sem sobrescrever e ignorando as expiradas)"""
+        cutoff = time.time() - self.idle_timeout_seconds
+        loaded = 0
+        for user_id, value in entries:
+            conversation_id, started_at, last_seen = _SESSION.unpack(value)
+            if last_seen < cutoff or user_id in self._sessions:
+                continue
+            self._sessions[user_id] = Session(conversation_id, started_at, last_seen)
+            loaded += 1
+        return loaded
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Resposta Progressiva no Telegram
+================================
+
+Publica a resposta do modelo enquanto ela é gerada: a primeira mensagem sai
+assim que chegam os primeiros tokens e depois é editada em intervalos
+limitados, abrindo novas mensagens ao atingir o limite de 4096 caracteres.
+
+Características:
+- Edições parciais sem parse_mode (Markdown incompleto quebraria a edição)
+- Edição final com Markdown e teclado, com fallback para texto puro
+- Erros "message is not modified" são ignorados
+- Com OutboundSender, envios e edições respeitam os limites de flood e
+  edições ainda na fila para a mesma mensagem são agrupadas
+"""
+
+import time
+import logging
+from typing import Any, List, Optional
+
+from telegram import Message
+from telegram.error import BadRequest
+
+from telegram_text import split_message
+
+logger = logging.getLogger('gemini_bot')
+
+
+class StreamingReply:
+    """Mensagens do Telegram atualizadas à medida que o texto cresce"""
+
+    def __init__(self, source_message: Message, edit_interval: float = 1.0,
+                 parse_mode: Optional[str] = 'Markdown', reply_markup: Any = None, sender: Any = None):
+        self.source_message = source_message
+        self.sender = sender
+        self.edit_interval = edit_interval
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.text = ""
+        self.messages: List[Message] = []
+        self._shown: List[str] = []
+        self._formatted: List[bool] = []
+        self._last_edit = 0.0
+
+    async def append(self, chunk: str):
+        """Acrescenta texto; envia ou edita mensagens conforme a cadência"""
+        self.text += chunk
+        await self._sync(final=False)
+
+    async def finish(self) -> str:
+        """Publica o texto completo com formatação e teclado"""
+        await self._sync(final=True)
+        return self.text
+
+    async def _sync(self, final: bool):
+        parts = split_message(self.text)
+        now = time.monotonic()
+        throttled = not final and now - self._last_edit < self.edit_interval
+
+        for index, part in enumerate(parts):
+            if not part.strip():
+                continue
+            is_last = index == len(parts) - 1
+            formatted = final or not is_last
+
+            if index >= len(self.messages):
+                # Nova mensagem: sem limitação de cadência (é o que reduz o tempo até o primeiro token)
+                message = await self._send(part, formatted, is_last and final)
+                self.messages.append(message)
+                self._shown.append(part)
+                self._formatted.append(formatted)
+                self._last_edit = now
+            elif (self._shown[index] != part or (formatted and not self._formatted[index])
+                  or (final and is_last)):
+                # Partes completas são finalizadas logo; a última respeita a cadência
+                if is_last and throttled:
+                    continue
+                await self._edit(self.messages[index], part, formatted, is_last and final)
+                self._shown[index] = part
+                self._formatted[index] = formatted
+                self._last_edit = now
+
+    async def _send(self, text: str, formatted: bool, with_markup: bool) -> Message:
+        markup = self.reply_markup if with_markup else None
+        reply_text = self.source_message.reply_text
+        if self.sender:
+            reply_text = lambda *args, **kwargs: self.sender.reply_text(self.source_message, *args, **kwargs)
+        if formatted and self.parse_mode:
+            try:
+                return await reply_text(text, parse_mode=self.parse_mode, reply_markup=markup)
+            except BadRequest as e:
+                logger.warning(f"Formatação rejeitada, enviando texto puro: {e}")
+        return await reply_text(text, reply_markup=markup)
+
+    async def _edit(self, message: Message, text: str, formatted: bool, with_markup: bool):
+        markup = self.reply_markup if with_markup else None
+        edit_text = message.edit_text
+        if self.sender:
+            edit_text = lambda *args, **kwargs: self.sender.edit_message_text(
+                message.chat_id, message.message_id, *args, **kwargs
+            )
+        try:
+            if formatted and self.parse_mode:
+                try:
+                    await edit_text(text, parse_mode=self.parse_mode, reply_markup=markup)
+                    return
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        return
+                    logger.warning(f"Formatação rejeitada, editando com texto puro: {e}")
+            await edit_text(text, reply_markup=markup)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
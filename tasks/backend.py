@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+Backends de Tarefas
+===================
+
+Camada entre as tarefas pesadas e quem as executa. As funções decoradas com
+@task oferecem a mesma interface do Celery (.delay/.apply_async, id da
+tarefa e consulta do resultado), mas podem rodar:
+
+- no Celery (broker Redis), como antes
+- localmente, em um pool de processos (ou threads) do próprio bot, com uma
+  tabela SQLite de jobs para retomar o que estava pendente após uma queda
+
+Seleção pela seção "tasks" da configuração (backend = auto | celery | local).
+No modo auto, o Celery é usado enquanto o broker responde; se a publicação
+falhar, o job vai para o backend local e o broker só é tentado de novo após
+broker_retry_seconds.
+"""
+
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import importlib
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config_loader import load_config
+from metrics import get_metrics
+from process_pool import create_process_pool
+from tasks.celery_app import QUEUES, ROUTES, celery_app, queue_for
+
+logger = logging.getLogger('gemini_bot')
+
+# Estados (mesmos nomes do Celery)
+PENDING = "PENDING"
+STARTED = "STARTED"
+SUCCESS = "SUCCESS"
+FAILURE = "FAILURE"
+
+_READY_STATES = frozenset({SUCCESS, FAILURE})
+
+
+class TaskBackendUnavailable(Exception):
+    """Nenhum backend conseguiu aceitar a tarefa"""
+
+
+class TaskError(Exception):
+    """A tarefa terminou com erro"""
+
+
+class TaskResult:
+    """Resultado assíncrono de uma tarefa (equivalente ao AsyncResult do Celery)"""
+
+    def __init__(self, task_id: str, backend: "TaskBackend", name: Optional[str] = None):
+        self.id = task_id
+        self.backend = backend
+        self.name = name
+
+    @property
+    def status(self) -> str:
+        return self.backend.status(self.id)
+
+    def ready(self) -> bool:
+        return self.status in _READY_STATES
+
+    def successful(self) -> bool:
+        return self.status == SUCCESS
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """Aguarda e retorna o resultado (TaskError se a tarefa falhou)"""
+        if self.name and self.backend.ignores_result(self.name):
+            # O resultado nunca seria gravado: esperar por ele travaria até o timeout
+            raise TaskError(f"A tarefa {self.name} não guarda resultado (ignore_result)")
+        return self.backend.get_result(self.id, timeout)
+
+    def __repr__(self) -> str:
+        return f"<TaskResult {self.id} via {self.backend.name}>"
+
+
+class Task:
+    """Tarefa registrada: chamável diretamente ou enviada a um backend"""
+
+    def __init__(self, func: Callable, name: str, celery_task: Any = None):
+        self.func = func
+        self.name = name
+        self.celery_task = celery_task
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.__module__ = func.__module__
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.func(*args, **kwargs)
+
+    def run(self, *args, **kwargs) -> Any:
+        """Executa no processo atual (como Task.run do Celery)"""
+        return self.func(*args, **kwargs)
+
+    def s(self, *args, **kwargs) -> Any:
+        """Assinatura Celery para canvas (group/chord); exige o Celery"""
+        if self.celery_task is None:
+            raise TaskBackendUnavailable("Celery não está instalado")
+        return self.celery_task.s(*args, **kwargs)
+
+    def si(self, *args, **kwargs) -> Any:
+        """Assinatura imutável (ignora o resultado da etapa anterior)"""
+        if self.celery_task is None:
+            raise TaskBackendUnavailable("Celery não está instalado")
+        return self.celery_task.si(*args, **kwargs)
+
+    def delay(self, *args, **kwargs) -> TaskResult:
+        return self.apply_async(args, kwargs)
+
+    def apply_async(self, args: Tuple = (), kwargs: Optional[Dict[str, Any]] = None,
+                    countdown: Optional[float] = None, **options) -> TaskResult:
+        return get_task_backend().submit(self, tuple(args), dict(kwargs or {}), countdown=countdown, **options)
+
+
+# Registro de tarefas por nome
+_registry: Dict[str, Task] = {}
+
+
+def task(name: str, **celery_options) -> Callable[[Callable], Task]:
+    """Registra a função como tarefa (e no Celery, se estiver instalado)"""
+    def decorator(func: Callable) -> Task:
+        celery_task = celery_app.task(name=name, **celery_options)(func) if celery_app is not None else None
+        registered = Task(func, name, celery_task)
+        _registry[name] = registered
+        return registered
+    return decorator
+
+
+def _run_registered(module: str, name: str, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+    """Ponto de entrada nos processos de trabalho: importa o módulo e executa a tarefa"""
+    importlib.import_module(module)
+    return _registry[name].run(*args, **kwargs)
+
+
+def running_in_celery() -> bool:
+    """Se o código atual roda dentro de uma tarefa de um worker Celery"""
+    if celery_app is None:
+        return False
+    from celery import current_task
+    return bool(current_task) and not current_task.request.called_directly
+
+
+class TaskBackend:
+    """Interface comum dos backends"""
+
+    name = "base"
+
+    def submit(self, registered: Task, args: Tuple, kwargs: Dict[str, Any],
+               countdown: Optional[float] = None, **options) -> TaskResult:
+        raise NotImplementedError
+
+    def status(self, task_id: str) -> str:
+        raise NotImplementedError
+
+    def get_result(self, task_id: str, timeout: Optional[float] = None) -> Any:
+        raise NotImplementedError
+
+    def ignores_result(self, task_name: str) -> bool:
+        """Se o backend descarta o resultado da tarefa"""
+        return False
+
+
+class CeleryBackend(TaskBackend):
+    """Publica no broker do Celery"""
+
+    name = "celery"
+
+    def __init__(self, celery_app: Any):
+        self.celery_app = celery_app
+
+    def submit(self, registered: Task, args: Tuple, kwargs: Dict[str, Any],
+               countdown: Optional[float] = None, **options) -> TaskResult:
+        # Sem retentativas de publicação: com o broker fora, falha rápido para o fallback
+        options.setdefault("retry", False)
+        result = self.celery_app.send_task(registered.name, args=args, kwargs=kwargs,
+                                           countdown=countdown, **options)
+        return TaskResult(result.id, self, registered.name)
+
+    def status(self, task_id: str) -> str:
+        return self.celery_app.AsyncResult(task_id).status
+
+    def get_result(self, task_id: str, timeout: Optional[float] = None) -> Any:
+        try:
+            return self.celery_app.AsyncResult(task_id).get(timeout=timeout)
+        except Exception as e:
+            if type(e).__name__ == "TimeoutError":
+                raise TimeoutError(str(e))
+            raise TaskError(str(e)) from e
+
+    def ignores_result(self, task_name: str) -> bool:
+        return bool(ROUTES.get(task_name, {}).get("ignore_result", False))
+
+
+class LocalBackend(TaskBackend):
+    """Executa no próprio processo, com jobs persistidos em SQLite"""
+
+    name = "local"
+
+    def __init__(self, db_path: str = "tasks.db", workers: int = 2, executor: str = "process",
+                 max_attempts: int = 3, result_ttl_seconds: int = 24 * 3600,
+                 queue_workers: Optional[Dict[str, int]] = None):
+        self.db_path = db_path
+        self.workers = workers
+        self.queue_workers = queue_workers or {}
+        self.executor_kind = executor
+        self.max_attempts = max_attempts
+        self.result_ttl_seconds = result_ttl_seconds
+        self.metrics = get_metrics()
+
+        # Um pool por fila, como os workers especializados do Celery
+        self._executors: Dict[str, Executor] = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._timers: Dict[str, threading.Timer] = {}
+        self._initialize_db()
+
+    # ------------------------------------------------------------------
+    # Persistência
+    # ------------------------------------------------------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _initialize_db(self):
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS task_jobs (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    module TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    kwargs TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    eta REAL,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_task_jobs_status ON task_jobs(status)")
+
+    def _update(self, task_id: str, **fields):
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE task_jobs SET {assignments} WHERE id = ?", (*fields.values(), task_id))
+
+    def _row(self, task_id: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT status, result, error FROM task_jobs WHERE id = ?", (task_id,)
+            ).fetchone()
+
+    # ------------------------------------------------------------------
+    # Execução
+    # ------------------------------------------------------------------
+
+    def submit(self, registered: Task, args: Tuple, kwargs: Dict[str, Any],
+               countdown: Optional[float] = None, task_id: Optional[str] = None, **options) -> TaskResult:
+        task_id = task_id or str(uuid.uuid4())
+        now = time.time()
+        eta = now + countdown if countdown else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO task_jobs (id, name, module, args, kwargs, status, eta, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (task_id, registered.name, registered.__module__, json.dumps(list(args), ensure_ascii=False),
+                 json.dumps(kwargs, ensure_ascii=False), PENDING, eta, now),
+            )
+        self._schedule(task_id, registered.name, registered.__module__, args, kwargs, eta)
+        self.metrics.increment("tasks.local_submitted")
+        return TaskResult(task_id, self, registered.name)
+
+    def _schedule(self, task_id: str, name: str, module: str, args: Tuple, kwargs: Dict[str, Any],
+                  eta: Optional[float]):
+        delay = (eta - time.time()) if eta else 0
+        if delay > 0:
+            timer = threading.Timer(delay, self._start, (task_id, name, module, args, kwargs))
+            timer.daemon = True
+            self._timers[task_id] = timer
+            timer.start()
+        else:
+            self._start(task_id, name, module, args, kwargs)
+
+    def _start(self, task_id: str, name: str, module: str, args: Tuple, kwargs: Dict[str, Any]):
+        self._timers.pop(task_id, None)
+        queue = queue_for(name)
+        with self._lock:
+            executor = self._executors.get(queue)
+            if executor is None:
+                workers = int(self.queue_workers.get(queue, self.workers))
+                if self.executor_kind == "thread":
+                    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"task-{queue}")
+                else:
+                    # Filhos sem as threads e locks do bot (tocam no banco e no sender)
+                    executor = create_process_pool(workers)
+                self._executors[queue] = executor
+        with self._connect() as conn:
+            conn.execute("UPDATE task_jobs SET status = ?, attempts = attempts + 1 WHERE id = ?", (STARTED, task_id))
+        future = executor.submit(_run_registered, module, name, tuple(args), dict(kwargs))
+        future.add_done_callback(lambda f: self._finish(task_id, f))
+
+    def _finish(self, task_id: str, future):
+        try:
+            result = future.result()
+            self._update(task_id, status=SUCCESS, result=json.dumps(result, ensure_ascii=False, default=str),
+                         finished_at=time.time())
+            self.metrics.increment("tasks.local_succeeded")
+        except Exception as e:
+            logger.error(f"Erro ao executar tarefa local {task_id}: {e}")
+            self._update(task_id, status=FAILURE, error=str(e), finished_at=time.time())
+            self.metrics.increment("tasks.local_failed")
+        with self._done:
+            self._done.notify_all()
+
+    def recover(self) -> int:
+        """Reenfileira jobs pendentes ou interrompidos por queda do processo"""
+        with self._connect() as conn:
+            cutoff = time.time() - self.result_ttl_seconds
+            conn.execute("DELETE FROM task_jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,))
+            rows = conn.execute(
+                "SELECT id, name, module, args, kwargs, attempts, eta FROM task_jobs WHERE status IN (?, ?)",
+                (PENDING, STARTED),
+            ).fetchall()
+
+        recovered = 0
+        for task_id, name, module, args, kwargs, attempts, eta in rows:
+            if attempts >= self.max_attempts:
+                self._update(task_id, status=FAILURE, error="Número máximo de tentativas excedido",
+                             finished_at=time.time())
+                continue
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                logger.error(f"Erro ao recuperar tarefa {task_id} ({name}): {e}")
+                continue
+            self._schedule(task_id, name, module, tuple(json.loads(args)), json.loads(kwargs), eta)
+            recovered += 1
+        if recovered:
+            logger.info(f"{recovered} tarefa(s) local(is) retomada(s) após reinício")
+        return recovered
+
+    def status(self, task_id: str) -> str:
+        row = self._row(task_id)
+        return row[0] if row else PENDING
+
+    def get_result(self, task_id: str, timeout: Optional[float] = None) -> Any:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            row = self._row(task_id)
+            if row and row[0] == SUCCESS:
+                return json.loads(row[1]) if row[1] is not None else None
+            if row and row[0] == FAILURE:
+                raise TaskError(row[2] or "Tarefa falhou")
+            remaining = deadline - time.monotonic() if deadline is not None else 1.0
+            if remaining <= 0:
+                raise TimeoutError(f"Tarefa {task_id} não terminou a tempo")
+            with self._done:
+                self._done.wait(min(remaining, 1.0))
+
+    def shutdown(self):
+        """Encerra os pools (jobs não concluídos são retomados no próximo início)"""
+        for timer in list(self._timers.values()):
+            timer.cancel()
+        with self._lock:
+            for executor in self._executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+            self._executors.clear()
+
+
+class FallbackBackend(TaskBackend):
+    """Celery enquanto o broker responde; local quando a publicação falha"""
+
+    name = "auto"
+
+    def __init__(self, primary: CeleryBackend, fallback: LocalBackend, broker_retry_seconds: float = 60):
+        self.primary = primary
+        self.fallback = fallback
+        self.broker_retry_seconds = broker_retry_seconds
+        self._broker_down_until = 0.0
+
+    def submit(self, registered: Task, args: Tuple, kwargs: Dict[str, Any],
+               countdown: Optional[float] = None, **options) -> TaskResult:
+        if time.monotonic() >= self._broker_down_until:
+            try:
+                return self.primary.submit(registered, args, kwargs, countdown=countdown, **options)
+            except Exception as e:
+                logger.warning(f"Broker indisponível, executando {registered.name} localmente: {e}")
+                get_metrics().increment("tasks.broker_fallbacks")
+                self._broker_down_until = time.monotonic() + self.broker_retry_seconds
+        # task_id do chamador é preservado; opções só do Celery (priority, queue) são ignoradas no local
+        return self.fallback.submit(registered, args, kwargs, countdown=countdown, **options)
+
+    def status(self, task_id: str) -> str:
+        return self.fallback.status(task_id) if self.fallback._row(task_id) else self.primary.status(task_id)
+
+    def get_result(self, task_id: str, timeout: Optional[float] = None) -> Any:
+        backend = self.fallback if self.fallback._row(task_id) else self.primary
+        return backend.get_result(task_id, timeout)
+
+
+def create_task_backend(settings: Dict[str, Any]) -> TaskBackend:
+    """Cria o backend a partir da seção "tasks" da configuração"""
+    local_settings = settings.get("local", {})
+
+    def local() -> LocalBackend:
+        backend = LocalBackend(
+            db_path=local_settings.get("db_path", "tasks.db"),
+            workers=int(local_settings.get("workers", 2)),
+            executor=local_settings.get("executor", "process"),
+            max_attempts=int(local_settings.get("max_attempts", 3)),
+            result_ttl_seconds=int(local_settings.get("result_ttl_seconds", 24 * 3600)),
+            queue_workers={name: queue.get("concurrency", 1) for name, queue in QUEUES.items()},
+        )
+        backend.recover()
+        return backend
+
+    kind = settings.get("backend", "auto")
+    if kind == "local" or celery_app is None:
+        if kind == "celery":
+            logger.warning("Celery não instalado: usando backend local de tarefas")
+        return local()
+    if kind == "celery":
+        return CeleryBackend(celery_app)
+    return FallbackBackend(CeleryBackend(celery_app), local(),
+                           broker_retry_seconds=float(settings.get("broker_retry_seconds", 60)))
+
+
+# Instância global
+_task_backend: Optional[TaskBackend] = None
+_task_backend_lock = threading.Lock()
+
+
+def get_task_backend() -> TaskBackend:
+    """Obtém o backend de tarefas do processo"""
+    global _task_backend
+    with _task_backend_lock:
+        if _task_backend is None:
+            _task_backend = create_task_backend(load_config().get("tasks", {}))
+            logger.info(f"Backend de tarefas: {_task_backend.name}")
+        return _task_backend
+
+
+def shutdown_task_backend():
+    """Encerra o backend local, se houver"""
+    backend = _task_backend
+    if isinstance(backend, FallbackBackend):
+        backend = backend.fallback
+    if isinstance(backend, LocalBackend):
+        backend.shutdown()
@@ -1,26 +1,99 @@
 # -*- coding: utf-8 -*-
 import os
-from celery import Celery
+from typing import Any, Dict
+
+from config_loader import load_config
+
+try:
+    from celery import Celery
+    from kombu import Queue
+except ImportError:
+    # Sem Celery instalado, as tarefas rodam no backend local (tasks/backend.py)
+    Celery = None
 
 # Variáveis de ambiente
 REDIS_URL = os.getenv("REDIS_URL") or os.getenv("CELERY_BROKER_URL") or "redis://localhost:6379/0"
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", REDIS_URL)
 
+# Filas dedicadas: clonagens longas não atrasam pesquisas rápidas.
+# concurrency/prefetch_multiplier/pool valem para o worker especializado
+# da fila (python -m tasks.worker <fila>) e para o pool do backend local.
+DEFAULT_QUEUES: Dict[str, Dict[str, Any]] = {
+    "voice": {"concurrency": 2, "prefetch_multiplier": 1, "pool": "prefork"},
+    "research": {"concurrency": 4, "prefetch_multiplier": 4, "pool": "prefork"},
+    "images": {"concurrency": 2, "prefetch_multiplier": 1, "pool": "prefork"},
+}
+
+# Rotas por tarefa: fila, prioridade (no Redis, 0 é a mais alta), limite de
+# taxa (por worker) e ignore_result para tarefas cujo resultado ninguém lê
+DEFAULT_ROUTES: Dict[str, Dict[str, Any]] = {
+    "tasks.clone_voice": {"queue": "voice", "priority": 6, "rate_limit": "20/m", "ignore_result": True},
+    "tasks.research_report": {"queue": "research", "priority": 2, "rate_limit": "60/m", "ignore_result": True},
+    # Subconsultas guardam resultado (o chord precisa); a redução tem prioridade
+    # para terminar relatórios já iniciados antes de começar novos
+    "tasks.research_subquery": {"queue": "research", "priority": 2},
+    "tasks.research_reduce": {"queue": "research", "priority": 1, "ignore_result": True},
+    "tasks.research_failed": {"queue": "research", "priority": 1, "ignore_result": True},
+    "tasks.generate_image": {"queue": "images", "priority": 4, "rate_limit": "30/m", "ignore_result": True},
+}
+
+_ROUTING_OPTIONS = ("queue", "priority")
+_TASK_ATTRIBUTES = ("rate_limit", "ignore_result", "time_limit", "soft_time_limit")
+
+TASK_SETTINGS: Dict[str, Any] = load_config().get("tasks", {})
+QUEUES: Dict[str, Dict[str, Any]] = {**DEFAULT_QUEUES, **TASK_SETTINGS.get("queues", {})}
+ROUTES: Dict[str, Dict[str, Any]] = {
+    name: {**DEFAULT_ROUTES.get(name, {}), **TASK_SETTINGS.get("routes", {}).get(name, {})}
+    for name in {*DEFAULT_ROUTES, *TASK_SETTINGS.get("routes", {})}
+}
+
+
+def queue_for(task_name: str) -> str:
+    """Fila da tarefa segundo as rotas ("default" se não roteada)"""
+    return ROUTES.get(task_name, {}).get("queue", "default")
+
+
 celery_app = Celery(
     "gemini_tasks",
     broker=REDIS_URL,
     backend=CELERY_RESULT_BACKEND,
-)
-
-celery_app.conf.update(
-    task_serializer="json",
-    accept_content=["json"],
-    result_serializer="json",
-    timezone="UTC",
-    enable_utc=True,
-    task_time_limit=60 * 20,  # 20 minutos
-    task_soft_time_limit=60 * 15,
-    worker_prefetch_multiplier=1,
-)
-
-__all__ = ["celery_app"]
+    include=["tasks.heavy_tasks"],
+) if Celery is not None else None
+
+if celery_app is not None:
+    celery_app.conf.update(
+        task_serializer="json",
+        accept_content=["json"],
+        result_serializer="json",
+        timezone="UTC",
+        enable_utc=True,
+        task_time_limit=60 * 20,  # 20 minutos
+        task_soft_time_limit=60 * 15,
+        worker_prefetch_multiplier=1,
+        # Publicação falha rápido com o broker fora (o backend "auto" cai para o local)
+        broker_connection_timeout=3,
+        result_backend_transport_options={
+            "retry_policy": {"max_retries": 2, "interval_start": 0, "interval_step": 0.2, "interval_max": 0.5},
+        },
+        # Filas e rotas
+        task_queues=[Queue("default")] + [Queue(name) for name in QUEUES],
+        task_default_queue="default",
+        task_routes={
+            name: {key: route[key] for key in _ROUTING_OPTIONS if key in route}
+            for name, route in ROUTES.items()
+        },
+        task_annotations={
+            name: {key: route[key] for key in _TASK_ATTRIBUTES if key in route}
+            for name, route in ROUTES.items()
+        },
+        # Prioridades dentro de cada fila no Redis
+        broker_transport_options={
+            "priority_steps": list(range(10)),
+            "sep": ":",
+            "queue_order_strategy": "priority",
+        },
+        task_default_priority=5,
+        result_expires=int(TASK_SETTINGS.get("result_expires_seconds", 3600)),
+    )
+
+__all__ = ["celery_app", "QUEUES", "ROUTES", "queue_for"]
@@ -2,30 +2,57 @@
 import os
 import json
 import time
-from typing import Optional, Dict, Any
-import requests
-from tasks.celery_app import celery_app
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Tuple
+import database
+from config_loader import load_config
+from metrics import get_metrics
+from tasks.backend import running_in_celery, task
+from tasks.research_pipeline import fetch_subquery, merge_report, normalize_query, plan_research
+from outbound_sender import get_sync_sender
+from media_store import MediaRef, get_media_store
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
-TELEGRAM_API = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 
+# Deduplicação de pesquisas: resultado no api_cache por result_ttl_seconds;
+# pesquisa "em andamento" há mais de stale_after_seconds é refeita
+RESEARCH_SETTINGS: Dict[str, Any] = load_config().get("research", {})
+RESEARCH_TTL_SECONDS = int(RESEARCH_SETTINGS.get("result_ttl_seconds", 3600))
+RESEARCH_STALE_SECONDS = float(RESEARCH_SETTINGS.get("stale_after_seconds", 900))
 
-def _send_telegram_message(chat_id: int, text: str) -> None:
+
+def _send_telegram_message(chat_id: int, text: str, parse_mode: Optional[str] = "Markdown") -> None:
     if not TELEGRAM_TOKEN:
         return
     try:
-        requests.post(
-            f"{TELEGRAM_API}/sendMessage",
-            json={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"},
-            timeout=15,
-        )
+        # Respeita os limites de flood do Telegram (espera em vez de tomar 429)
+        get_sync_sender(TELEGRAM_TOKEN).send_message(chat_id, text, parse_mode=parse_mode)
     except Exception:
         pass
 
 
-@celery_app.task(name="tasks.clone_voice")
+def _resolve_media(file_id: str, options: Optional[Dict[str, Any]]) -> Optional[MediaRef]:
+    """Arquivo já armazenado pelo bot (media_sha256) ou baixado pelo armazenamento compartilhado"""
+    store = get_media_store()
+    sha256 = (options or {}).get("media_sha256")
+    ref = store.get(sha256) if sha256 else None
+    if ref is None and TELEGRAM_TOKEN:
+        try:
+            ref = store.fetch_sync(TELEGRAM_TOKEN, file_id)
+        except Exception:
+            return None
+    return ref
+
+
+@task(name="tasks.clone_voice")
 def clone_voice_task(chat_id: int, audio_file_id: str, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     _send_telegram_message(chat_id, "🎤 Processando clonagem de voz… isso pode levar alguns minutos.")
+    audio = _resolve_media(audio_file_id, options)
+    if audio is None:
+        _send_telegram_message(chat_id, "❌ Não foi possível obter o áudio para clonagem. Envie novamente.")
+        return {"status": "error", "details": "Áudio indisponível"}
     # Simulação de processamento pesado
     time.sleep(8)
     result = {
@@ -37,16 +64,117 @@ def clone_voice_task(chat_id: int, audio_file_id: str, options: Optional[Dict[st
     return result
 
 
-@celery_app.task(name="tasks.research_report")
+def research_key(query: str) -> str:
+    """Chave da pesquisa no api_cache"""
+    return "research:" + hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+
+def request_research(chat_id: int, query: str, options: Optional[Dict[str, Any]] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Pede uma pesquisa compartilhando-a entre chats
+
+    Retorna ("cached", resultado) quando já há resultado recente, ("joined", None)
+    quando a mesma pesquisa está em andamento (o chat recebe o resultado dela) e
+    ("queued", None) quando uma nova tarefa foi enfileirada.
+    """
+    key = research_key(query)
+    run_id = uuid.uuid4().hex
+    status, cached = database.research_claim(key, query, chat_id, RESEARCH_STALE_SECONDS, run_id)
+    get_metrics().increment(f"research.{status}")
+    if status != "started":
+        return status, cached
+    try:
+        research_report_task.delay(chat_id, query, dict(options or {}, research_run_id=run_id))
+    except Exception:
+        # Libera a chave para o próximo pedido não ficar esperando uma tarefa inexistente
+        database.research_complete(key, None, run_id=run_id)
+        raise
+    return "queued", None
+
+
+def _notify_research(key: str, chat_id: int, text: str) -> None:
+    """Progresso para todos os chats que aguardam a pesquisa"""
+    for waiting_chat in sorted(set(database.research_waiting_chats(key)) | {chat_id}):
+        _send_telegram_message(waiting_chat, text, parse_mode=None)
+
+
+def _fail_research(key: str, chat_id: int, run_id: Optional[str] = None) -> None:
+    """Libera a chave e avisa os chats que aguardavam"""
+    for waiting_chat in sorted(set(database.research_complete(key, None, run_id=run_id)) | {chat_id}):
+        _send_telegram_message(waiting_chat, "❌ A pesquisa falhou. Tente novamente mais tarde.")
+
+
+def _finish_research(key: str, chat_id: int, query: str, parts: List[Dict[str, Any]],
+                     run_id: Optional[str] = None) -> Dict[str, Any]:
+    """Etapa de redução: relatório único enviado a todos os chats que pediram a mesma pesquisa"""
+    report = merge_report(query, parts)
+    if report is None:
+        _fail_research(key, chat_id, run_id)
+        return {"status": "error", "details": "Nenhuma subconsulta retornou resultado"}
+
+    value = {"query": query, "text": report}
+    chats = set(database.research_complete(key, value, RESEARCH_TTL_SECONDS, run_id=run_id)) | {chat_id}
+    for waiting_chat in sorted(chats):
+        _send_telegram_message(waiting_chat, f"📄 Resultado:\n{report}", parse_mode=None)
+    return {"status": "ok", "text": report, "chats": len(chats)}
+
+
+@task(name="tasks.research_report")
 def research_report_task(chat_id: int, query: str, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    _send_telegram_message(chat_id, f"🔎 Pesquisando: {query}\nIsso pode levar 1-2 minutos…")
-    time.sleep(5)
-    result_text = f"Relatório sobre '{query}' (simulado). Inclua aqui síntese e fontes."
-    _send_telegram_message(chat_id, f"📄 Resultado:\n{result_text}")
-    return {"status": "ok", "text": result_text}
+    """Etapa de planejamento: divide a pesquisa e dispara as subconsultas em paralelo"""
+    key = research_key(query)
+    # Execução registrada por request_research (ausente em chamadas diretas)
+    run_id = (options or {}).get("research_run_id")
+    try:
+        subqueries = plan_research(query)
+        _notify_research(key, chat_id, f"🧭 Pesquisa dividida em {len(subqueries)} partes. Buscando em paralelo…")
+
+        if running_in_celery():
+            # chord: subconsultas em paralelo nos workers, redução quando todas terminarem
+            from celery import chord, group
+            reduce = research_reduce_task.s(chat_id, query, run_id).on_error(research_failed_task.si(chat_id, query, run_id))
+            chord(group(research_subquery_task.s(chat_id, key, subquery) for subquery in subqueries))(reduce)
+            return {"status": "dispatched", "subqueries": len(subqueries)}
+
+        # Backend local: mesmo fluxo com um pool de threads (as buscas esperam rede)
+        with ThreadPoolExecutor(max_workers=int(RESEARCH_SETTINGS.get("max_parallel_fetches", 4))) as pool:
+            parts = list(pool.map(lambda subquery: research_subquery_task(chat_id, key, subquery), subqueries))
+    except Exception:
+        _fail_research(key, chat_id, run_id)
+        raise
+    return _finish_research(key, chat_id, query, parts, run_id)
+
+
+@task(name="tasks.research_subquery")
+def research_subquery_task(chat_id: int, key: str, subquery: str) -> Dict[str, Any]:
+    """Etapa de mapeamento: busca e resume uma subconsulta (nunca falha o chord)"""
+    try:
+        part = fetch_subquery(subquery)
+    except Exception as e:
+        part = {"subquery": subquery, "summary": None, "sources": [], "cached": False, "error": str(e)}
+    mark = "✅" if part.get("summary") else "⚠️"
+    _notify_research(key, chat_id, f"{mark} Parte concluída: {subquery}")
+    return part
+
+
+@task(name="tasks.research_reduce")
+def research_reduce_task(parts: List[Dict[str, Any]], chat_id: int, query: str,
+                         run_id: Optional[str] = None) -> Dict[str, Any]:
+    """Etapa de redução no Celery (callback do chord)"""
+    key = research_key(query)
+    try:
+        return _finish_research(key, chat_id, query, parts, run_id)
+    except Exception:
+        _fail_research(key, chat_id, run_id)
+        raise
+
+
+@task(name="tasks.research_failed")
+def research_failed_task(chat_id: int, query: str, run_id: Optional[str] = None) -> None:
+    """Callback de erro do chord: libera a chave e avisa os chats"""
+    _fail_research(research_key(query), chat_id, run_id)
 
 
-@celery_app.task(name="tasks.generate_image")
+@task(name="tasks.generate_image")
 def generate_image_task(chat_id: int, prompt: str) -> Dict[str, Any]:
     _send_telegram_message(chat_id, f"🎨 Gerando imagem para: {prompt}")
     time.sleep(6)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline de Pesquisa (map-reduce)
+=================================
+
+Etapas do relatório de pesquisa executadas pelas tarefas em
+tasks/heavy_tasks.py:
+
+- plan_research: divide a consulta em subconsultas (um aspecto cada)
+- fetch_subquery: busca e resume uma subconsulta (Tavily quando há
+  TAVILY_API_KEY), com cache por subconsulta no api_cache
+- merge_report: junta os resumos em um relatório com as fontes
+
+As subconsultas são independentes: no Celery rodam em paralelo em um chord,
+no backend local em um pool de threads. A latência do relatório fica
+próxima à da subconsulta mais lenta, não à soma de todas.
+"""
+
+import os
+import re
+import time
+import hashlib
+import logging
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+import database
+from config_loader import load_config
+from http_client import get_http_client
+
+logger = logging.getLogger('gemini_bot')
+
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+
+_SUBQUERY_PREFIX = "research_sub:"
+
+DEFAULT_ASPECTS = [
+    "{query}",
+    "{query} dados e estatísticas recentes",
+    "{query} vantagens, desvantagens e controvérsias",
+    "{query} notícias e desenvolvimentos recentes",
+]
+
+RESEARCH_SETTINGS: Dict[str, Any] = load_config().get("research", {})
+
+
+def plan_research(query: str, max_subqueries: Optional[int] = None) -> List[str]:
+    """Subconsultas da pesquisa, uma por aspecto configurado (sem repetições)"""
+    aspects = RESEARCH_SETTINGS.get("aspects") or DEFAULT_ASPECTS
+    limit = max_subqueries or int(RESEARCH_SETTINGS.get("max_subqueries", len(aspects)))
+    subqueries: List[str] = []
+    for aspect in aspects:
+        subquery = " ".join(aspect.format(query=query).split())
+        if subquery and subquery not in subqueries:
+            subqueries.append(subquery)
+    return subqueries[:limit]
+
+
+def normalize_query(query: str) -> str:
+    """Forma canônica da consulta: sem acentos, caixa e pontuação, espaços únicos"""
+    text = unicodedata.normalize("NFKD", query)
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def _subquery_key(subquery: str) -> str:
+    return _SUBQUERY_PREFIX + hashlib.sha256(normalize_query(subquery).encode("utf-8")).hexdigest()
+
+
+def _search_tavily(subquery: str, api_key: str) -> Dict[str, Any]:
+    response = get_http_client().post(
+        TAVILY_SEARCH_URL,
+        json={
+            "api_key": api_key,
+            "query": subquery,
+            "search_depth": "basic",
+            "include_answer": True,
+            "max_results": int(RESEARCH_SETTINGS.get("results_per_subquery", 5)),
+        },
+    )
+    response.raise_for_status()
+    data = response.json()
+    results = data.get("results") or []
+    summary = (data.get("answer") or "").strip()
+    if not summary:
+        # Sem resposta sintetizada: primeiros trechos dos resultados
+        summary = " ".join((item.get("content") or "").strip() for item in results[:2])
+    return {
+        "summary": summary[:int(RESEARCH_SETTINGS.get("max_summary_chars", 700))],
+        "sources": [{"title": item.get("title", ""), "url": item.get("url", "")} for item in results if item.get("url")],
+    }
+
+
+def fetch_subquery(subquery: str) -> Dict[str, Any]:
+    """Resumo e fontes de uma subconsulta (do cache quando disponível)"""
+    key = _subquery_key(subquery)
+    try:
+        cached = database.cache_get(key)
+        if cached is not None:
+            return {"subquery": subquery, **cached, "cached": True}
+    except Exception as e:
+        logger.error(f"Erro ao consultar cache de subconsulta: {e}")
+
+    api_key = os.getenv("TAVILY_API_KEY", "")
+    if not api_key:
+        # Sem chave de busca: resultado simulado (não vai para o cache)
+        time.sleep(float(RESEARCH_SETTINGS.get("simulated_fetch_seconds", 2)))
+        return {"subquery": subquery, "summary": f"Síntese sobre '{subquery}' (simulada).", "sources": [], "cached": False}
+
+    try:
+        result = _search_tavily(subquery, api_key)
+    except Exception as e:
+        logger.error(f"Erro ao buscar subconsulta '{subquery}': {e}")
+        return {"subquery": subquery, "summary": None, "sources": [], "cached": False}
+
+    try:
+        database.cache_set(key, result, ttl_seconds=int(RESEARCH_SETTINGS.get("subquery_ttl_seconds", 6 * 3600)))
+    except Exception as e:
+        logger.error(f"Erro ao salvar subconsulta no cache: {e}")
+    return {"subquery": subquery, **result, "cached": False}
+
+
+def merge_report(query: str, parts: List[Dict[str, Any]]) -> Optional[str]:
+    """Relatório final a partir dos resumos (None se nenhuma subconsulta trouxe resultado)"""
+    sections = [part for part in parts if part.get("summary")]
+    if not sections:
+        return None
+
+    lines = [f"Relatório sobre '{query}'", ""]
+    for part in sections:
+        lines.append(f"• {part['subquery']}: {part['summary']}")
+
+    # Fontes sem repetição, na ordem em que apareceram
+    seen = set()
+    sources = []
+    for part in sections:
+        for source in part.get("sources", []):
+            if source["url"] not in seen:
+                seen.add(source["url"])
+                sources.append(source)
+    max_sources = int(RESEARCH_SETTINGS.get("max_sources", 8))
+    if sources:
+        lines.extend(["", "Fontes:"])
+        lines.extend(f"- {source['title'] or source['url']}: {source['url']}" for source in sources[:max_sources])
+
+    missing = len(parts) - len(sections)
+    if missing:
+        lines.extend(["", f"({missing} de {len(parts)} partes da pesquisa não retornaram resultado)"])
+    return "\n".join(lines)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Workers Especializados por Fila
+===============================
+
+Inicia um worker Celery consumindo apenas as filas indicadas, com a
+concorrência, o prefetch e o tipo de pool da seção "tasks.queues" da
+configuração.
+
+Uso:
+    python -m tasks.worker voice
+    python -m tasks.worker research images
+
+Com mais de uma fila, a concorrência é a soma das filas e o prefetch o
+menor entre elas; as filas precisam usar o mesmo tipo de pool.
+"""
+
+import sys
+import socket
+from typing import List
+
+from tasks.celery_app import QUEUES, celery_app
+
+
+def worker_argv(queues: List[str]) -> List[str]:
+    """Argumentos do worker Celery para as filas"""
+    unknown = [name for name in queues if name not in QUEUES]
+    if unknown:
+        raise ValueError(f"Fila(s) desconhecida(s): {', '.join(unknown)}")
+
+    settings = [QUEUES[name] for name in queues]
+    concurrency = sum(int(queue.get("concurrency", 1)) for queue in settings)
+    prefetch = min(int(queue.get("prefetch_multiplier", 1)) for queue in settings)
+    pools = sorted({queue.get("pool", "prefork") for queue in settings})
+    if len(pools) > 1:
+        # Um worker tem um único pool: filas com pools diferentes exigem workers separados
+        raise ValueError(f"Filas com pools diferentes ({', '.join(pools)}); inicie um worker por fila")
+    pool = pools[0]
+    return [
+        "worker",
+        "-l", "info",
+        "-Q", ",".join(queues),
+        "-c", str(concurrency),
+        "-P", pool,
+        "--prefetch-multiplier", str(prefetch),
+        "-n", f"{'+'.join(queues)}@{socket.gethostname()}",
+    ]
+
+
+def main():
+    queues = sys.argv[1:]
+    if not queues:
+        print(f"Uso: python -m tasks.worker <fila> [<fila>...]  (filas: {', '.join(QUEUES)})")
+        sys.exit(2)
+    if celery_app is None:
+        print("Celery não está instalado")
+        sys.exit(1)
+    try:
+        argv = worker_argv(queues)
+    except ValueError as e:
+        print(str(e))
+        sys.exit(2)
+    celery_app.worker_main(argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Utilitários de texto para mensagens do Telegram.
+"""
+
+from typing import List
+
+# Limite de caracteres de uma mensagem de texto no Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Divide texto em partes de até `limit` caracteres.
+
+    Prefere quebrar em parágrafo, depois em linha e depois em espaço. O ponto
+    de corte de cada parte depende só dos primeiros `limit` caracteres
+    restantes, então acrescentar texto ao final não altera partes já
+    completas (importante para edições progressivas).
+    """
+    chunks: List[str] = []
+    while len(text) > limit:
+        window = text[:limit]
+        cut = -1
+        for separator in ("\n\n", "\n", " "):
+            cut = window.rfind(separator)
+            if cut > limit // 2:
+                cut += len(separator)
+                break
+        if cut <= limit // 2:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """Banco SQLite temporário com o esquema completo"""
+    monkeypatch.setattr(database, "DB_FILE", str(tmp_path / "bot_data.db"))
+    database.initialize_db()
+    return database.DB_FILE
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import time
+
+import database
+from cache_snapshot import CacheSnapshotter
+
+
+def _snapshotter(path, store, is_current=database.unchanged_since):
+    snapshotter = CacheSnapshotter(str(path), is_current=is_current)
+
+    def load(entries):
+        count = 0
+        for key, value in entries:
+            store[key] = bytes(value)
+            count += 1
+        return count
+
+    snapshotter.register_section("states", lambda: [("u1", b"chat_geral")], load)
+    return snapshotter
+
+
+def test_snapshot_periodico_carregado_com_banco_inalterado(temp_db, tmp_path):
+    store = {}
+    assert _snapshotter(tmp_path / "snap.bin", store).save()
+    assert _snapshotter(tmp_path / "snap.bin", store).load() == {"states": 1}
+    assert store == {"u1": b"chat_geral"}
+
+
+def test_snapshot_periodico_sem_conferencia_do_banco_nao_e_carregado(temp_db, tmp_path):
+    store = {}
+    assert _snapshotter(tmp_path / "snap.bin", store, is_current=None).save()
+    assert _snapshotter(tmp_path / "snap.bin", store, is_current=None).load() == {}
+    assert store == {}
+
+
+def test_snapshot_periodico_descartado_apos_escrita_no_banco(temp_db, tmp_path):
+    store = {}
+    assert _snapshotter(tmp_path / "snap.bin", store).save()
+    time.sleep(0.01)
+    # Escrita feita depois do último snapshot periódico, antes da queda
+    database.save_conversation_state("u1", 0, "pesquisando")
+    assert _snapshotter(tmp_path / "snap.bin", store).load() == {}
+
+
+def test_snapshot_final_e_carregado(temp_db, tmp_path):
+    store = {}
+    assert _snapshotter(tmp_path / "snap.bin", store).save(final=True)
+    assert _snapshotter(tmp_path / "snap.bin", store).load() == {"states": 1}
+    assert store == {"u1": b"chat_geral"}
+
+
+def test_snapshot_descartado_apos_escrita_no_banco(temp_db, tmp_path):
+    store = {}
+    assert _snapshotter(tmp_path / "snap.bin", store).save(final=True)
+    time.sleep(0.01)
+    # Escrita de outro processo enquanto este estava parado
+    database.save_conversation_state("u1", 0, "pesquisando")
+    assert _snapshotter(tmp_path / "snap.bin", store).load() == {}
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+import database
+
+
+def test_rollback_executa_callbacks(temp_db):
+    evicted = []
+    with pytest.raises(RuntimeError):
+        with database.unit_of_work():
+            database.save_conversation_state("u1", 0, "chat_geral")
+            database.on_rollback(lambda: evicted.append("u1"))
+            raise RuntimeError("falha no update")
+
+    assert evicted == ["u1"]
+    assert database.get_conversation_state("u1", 0) is None
+
+
+def test_commit_com_erro_executa_callbacks(temp_db):
+    evicted, published = [], []
+
+    def failing(cursor):
+        raise sqlite3.OperationalError("disco cheio")
+
+    with database.unit_of_work() as unit:
+        unit.defer(failing)
+        database.on_rollback(lambda: evicted.append("u1"))
+        database.after_commit(lambda: published.append("u1"))
+
+    assert evicted == ["u1"]
+    assert published == []
+
+
+def test_commit_confirmado_nao_executa_callbacks_de_rollback(temp_db):
+    evicted = []
+    with database.unit_of_work():
+        database.save_conversation_state("u1", 0, "chat_geral")
+        database.on_rollback(lambda: evicted.append("u1"))
+
+    assert evicted == []
+    assert database.get_conversation_state("u1", 0) == "chat_geral"
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import database
+
+
+def test_claim_inicia_e_demais_chats_entram(temp_db):
+    assert database.research_claim("k", "q", 1, run_id="r1") == ("started", None)
+    assert database.research_claim("k", "q", 2, run_id="r2") == ("joined", None)
+    assert sorted(database.research_waiting_chats("k")) == [1, 2]
+
+
+def test_resultado_concluido_vem_do_cache(temp_db):
+    database.research_claim("k", "q", 1, run_id="r1")
+    database.research_claim("k", "q", 2, run_id="r2")
+
+    assert sorted(database.research_complete("k", {"text": "relatório"}, run_id="r1")) == [1, 2]
+    assert database.research_claim("k", "q", 3, run_id="r3") == ("cached", {"text": "relatório"})
+    assert database.research_waiting_chats("k") == []
+
+
+def test_pesquisa_travada_e_reiniciada(temp_db):
+    database.research_claim("k", "q", 1, run_id="r1")
+    assert database.research_claim("k", "q", 2, stale_after_seconds=0, run_id="r2") == ("started", None)
+
+
+def test_execucao_substituida_nao_libera_a_nova(temp_db):
+    database.research_claim("k", "q", 1, run_id="r1")
+    database.research_claim("k", "q", 2, stale_after_seconds=0, run_id="r2")
+
+    # O worker antigo termina (com falha) depois de ser substituído
+    assert database.research_complete("k", None, run_id="r1") == []
+    assert sorted(database.research_waiting_chats("k")) == [1, 2]
+    assert database.research_claim("k", "q", 3, run_id="r3") == ("joined", None)
+
+    assert sorted(database.research_complete("k", {"text": "relatório"}, run_id="r2")) == [1, 2, 3]
+    with sqlite3.connect(temp_db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM research_jobs").fetchone() == (0,)
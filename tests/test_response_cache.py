@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from response_cache import ResponseCache
+
+PERSONALITY = "Você é um assistente útil."
+
+
+def test_resposta_nao_passa_para_outro_usuario(temp_db):
+    cache = ResponseCache(near_duplicates=True)
+    history_a = [("user", "Estou planejando viajar para Lisboa"), ("assistant", "Ótimo! Quando?")]
+    history_b = [("user", "Preciso de receitas vegetarianas"), ("assistant", "Claro, posso ajudar.")]
+
+    prompt_a = cache.prepare("qual o melhor roteiro", PERSONALITY, history=history_a)
+    cache.put(prompt_a, "Roteiro de 3 dias em Lisboa...")
+
+    prompt_b = cache.prepare("qual o melhor roteiro", PERSONALITY, history=history_b)
+    assert prompt_b.key != prompt_a.key
+    assert cache.get(prompt_b) is None
+    # Nem como quase-duplicata
+    assert cache.get(cache.prepare("qual o melhor roteiro?!", PERSONALITY, history=history_b)) is None
+
+
+def test_continuacao_com_historico_diferente_nao_reaproveita(temp_db):
+    cache = ResponseCache(near_duplicates=True)
+    first = [("user", "capital da França"), ("assistant", "Paris.")]
+    cache.put(cache.prepare("e da Alemanha", PERSONALITY, history=first), "Berlim.")
+
+    later = first + [("user", "e da Alemanha"), ("assistant", "Berlim."),
+                     ("user", "população da Espanha"), ("assistant", "Cerca de 48 milhões.")]
+    assert cache.get(cache.prepare("e da Alemanha", PERSONALITY, history=later)) is None
+
+
+def test_mesmo_historico_reaproveita(temp_db):
+    cache = ResponseCache(near_duplicates=True)
+    cache.put(cache.prepare("oi", PERSONALITY), "Olá! Como posso ajudar?")
+
+    assert cache.get(cache.prepare("Oi!", PERSONALITY)) == "Olá! Como posso ajudar?"
+    assert cache.get(cache.prepare("oi", PERSONALITY, history=[("user", "bom dia")])) is None
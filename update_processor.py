@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Processamento Concorrente com Ordem por Chat
+============================================
+
+Update processor para o python-telegram-bot que distribui os updates em
+filas FIFO por chat. Um pool de workers assíncronos drena as filas: chats
+diferentes avançam em paralelo, enquanto os updates de um mesmo chat são
+processados estritamente em sequência.
+
+Funcionalidades:
+- Uma fila por chat (updates sem chat são processados diretamente)
+- Pool fixo de workers; chats com backlog voltam ao fim da fila de prontos
+  após cada update (rodízio justo entre chats)
+- Filas vazias são descartadas assim que o último update termina
+- Backlog por chat consultável e métricas de backlog/espera
+
+Características:
+- max_pending (semáforo do PTB) limita updates aceitos e ainda não
+  concluídos; os workers limitam quantos executam ao mesmo tempo
+- process_update só retorna quando o update termina, então
+  Application.stop continua aguardando os updates pendentes
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import Metrics, get_metrics
+
+logger = logging.getLogger('gemini_bot')
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Filas FIFO por chat drenadas por um pool de workers"""
+
+    def __init__(self, workers: int = 8, max_pending: int = 1024, metrics: Optional[Metrics] = None):
+        super().__init__(max_concurrent_updates=max_pending)
+        self.workers = workers
+        self.metrics = metrics or get_metrics()
+
+        # Invariante: um chat está em _queues enquanto está na fila de prontos
+        # ou sendo processado por um worker
+        self._queues: Dict[Hashable, Deque[Tuple[Awaitable[Any], asyncio.Future, float]]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._backlog = 0
+
+    @staticmethod
+    def chat_key(update: object) -> Optional[Hashable]:
+        """Chave de ordenação do update (chat, ou usuário na falta de chat)"""
+        chat = getattr(update, "effective_chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "effective_user", None)
+        if user is not None:
+            return ("user", user.id)
+        return None
+
+    def backlog(self) -> Dict[Hashable, int]:
+        """Updates aguardando por chat (inclui o que está em execução)"""
+        return {key: len(queue) for key, queue in self._queues.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        """Resumo do backlog"""
+        depths = [len(queue) for queue in self._queues.values()]
+        return {
+            "workers": self.workers,
+            "backlog": self._backlog,
+            "active_chats": len(depths),
+            "max_chat_backlog": max(depths, default=0),
+        }
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Enfileira o update no chat e aguarda sua conclusão"""
+        key = self.chat_key(update)
+        if key is None or self._ready is None:
+            await coroutine
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((coroutine, future, time.monotonic()))
+        self._backlog += 1
+        self._update_gauges()
+
+        await future
+
+    async def initialize(self) -> None:
+        """Inicia os workers"""
+        self._ready = asyncio.Queue()
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(), name=f"update-worker-{index}")
+            for index in range(self.workers)
+        ]
+        logger.info(f"Processamento de updates por chat iniciado ({self.workers} workers)")
+
+    async def shutdown(self) -> None:
+        """Encerra os workers, descartando updates que não chegaram a executar"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+        dropped = 0
+        for queue in self._queues.values():
+            for coroutine, future, _ in queue:
+                if hasattr(coroutine, "close"):
+                    coroutine.close()
+                if not future.done():
+                    future.cancel()
+                dropped += 1
+        if dropped:
+            logger.warning(f"{dropped} update(s) descartado(s) no encerramento")
+        self._queues.clear()
+        self._backlog = 0
+        self._ready = None
+        self._update_gauges()
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            coroutine, future, queued_at = queue[0]
+            self.metrics.observe("updates.queue_wait", time.monotonic() - queued_at)
+
+            try:
+                await coroutine
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                # Application.process_update já trata erros dos handlers
+                logger.error(f"Erro ao processar update do chat {key}: {e}")
+            finally:
+                queue.popleft()
+                self._backlog -= 1
+                if not future.done():
+                    future.set_result(None)
+
+                if queue:
+                    # Volta ao fim da fila de prontos: os demais chats não esperam este
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+                self._update_gauges()
+
+    def _update_gauges(self):
+        self.metrics.set_gauge("updates.backlog", self._backlog)
+        self.metrics.set_gauge("updates.active_chats", len(self._queues))
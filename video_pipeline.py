@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline de Análise de Vídeos
+=============================
+
+Analisa vídeos enviando ao modelo apenas alguns quadros-chave e a
+transcrição do áudio, em vez de todos os quadros.
+
+Funcionalidades:
+- Decodificação com OpenCV em processo separado (não disputa o GIL com o bot)
+- Amostragem em taxa fixa e detecção de mudança de cena por diferença de
+  histogramas de cor (NumPy)
+- Orçamento de quadros: com mais cenas que o orçamento, ficam as mudanças
+  mais fortes (o primeiro quadro sempre entra)
+- Quadros reduzidos e recodificados em JPEG
+- Faixa de áudio transcrita pelo AudioPipeline, em paralelo com os quadros
+- Resultado em cache no api_cache pelo sha256 do arquivo
+
+Características:
+- Custo e latência crescem com o número de cenas, não com a duração
+- Vídeos sem áudio são analisados só pelos quadros
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+import database
+from audio_pipeline import AudioDecodeError, AudioPipeline
+from media_store import MediaRef
+from metrics import Metrics, get_metrics
+from process_pool import create_process_pool
+
+logger = logging.getLogger('gemini_bot')
+
+_KEY_PREFIX = "video:"
+
+# Histograma de cor: 4 níveis por canal (64 cores) sobre quadro reduzido
+_HIST_LEVELS = 4
+_HIST_SIZE = (64, 36)
+
+ANALYZE_PROMPT = (
+    "Estes são quadros-chave de um vídeo, em ordem cronológica (instante em segundos "
+    "antes de cada um). Descreva em português o que acontece no vídeo, as cenas "
+    "principais e qualquer texto visível, em até 8 frases."
+)
+
+
+def color_histogram(frame: np.ndarray) -> np.ndarray:
+    """Histograma normalizado de cores quantizadas de um quadro BGR reduzido"""
+    quantized = (frame // (256 // _HIST_LEVELS)).astype(np.int32)
+    codes = (quantized[..., 0] * _HIST_LEVELS + quantized[..., 1]) * _HIST_LEVELS + quantized[..., 2]
+    hist = np.bincount(codes.ravel(), minlength=_HIST_LEVELS ** 3).astype(np.float32)
+    return hist / hist.sum()
+
+
+def histogram_distance(a: np.ndarray, b: np.ndarray) -> float:
+    """Distância de variação total entre histogramas (0 = iguais, 1 = disjuntos)"""
+    return float(np.abs(a - b).sum() / 2)
+
+
+def select_keyframes(scores: List[Tuple[float, float]], frame_budget: int) -> List[float]:
+    """Instantes das mudanças de cena mais fortes dentro do orçamento, em ordem"""
+    if len(scores) <= frame_budget:
+        return [timestamp for timestamp, _ in scores]
+    first, rest = scores[0], scores[1:]
+    strongest = sorted(rest, key=lambda item: -item[1])[:frame_budget - 1]
+    return sorted([first[0]] + [timestamp for timestamp, _ in strongest])
+
+
+def extract_keyframes(path: str, frame_budget: int = 8, sample_fps: float = 2.0,
+                      scene_threshold: float = 0.35, max_side: int = 768,
+                      jpeg_quality: int = 80) -> List[Tuple[float, bytes]]:
+    """Quadros-chave (instante, JPEG) do vídeo; roda no processo de trabalho"""
+    import cv2
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Não foi possível abrir o vídeo")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        step = max(1, int(round(fps / sample_fps)))
+
+        # Primeira passada: pontuação de mudança de cena nos quadros amostrados
+        scores: List[Tuple[float, float]] = []
+        previous = None
+        index = 0
+        while True:
+            if index % step:
+                # grab() avança sem converter o quadro
+                if not capture.grab():
+                    break
+                index += 1
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+            hist = color_histogram(cv2.resize(frame, _HIST_SIZE, interpolation=cv2.INTER_AREA))
+            if previous is None:
+                scores.append((index / fps, 1.0))
+            else:
+                distance = histogram_distance(previous, hist)
+                if distance >= scene_threshold:
+                    scores.append((index / fps, distance))
+            previous = hist
+            index += 1
+
+        # Segunda passada: apenas os quadros escolhidos, reduzidos
+        keyframes = []
+        for timestamp in select_keyframes(scores, frame_budget):
+            capture.set(cv2.CAP_PROP_POS_MSEC, timestamp * 1000)
+            ok, frame = capture.read()
+            if not ok:
+                continue
+            height, width = frame.shape[:2]
+            scale = min(1.0, max_side / max(height, width))
+            if scale < 1.0:
+                frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+            ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+            if ok:
+                keyframes.append((timestamp, encoded.tobytes()))
+        return keyframes
+    finally:
+        capture.release()
+
+
+class VideoPipeline:
+    """Análise de vídeo por quadros-chave e transcrição do áudio"""
+
+    def __init__(self, model_executor: Any, audio_pipeline: Optional[AudioPipeline] = None,
+                 frame_budget: int = 8, sample_fps: float = 2.0, scene_threshold: float = 0.35,
+                 max_side: int = 768, workers: int = 1, ttl_seconds: int = 30 * 24 * 3600,
+                 metrics: Optional[Metrics] = None):
+        self.model_executor = model_executor
+        self.audio_pipeline = audio_pipeline
+        self.frame_budget = frame_budget
+        self.sample_fps = sample_fps
+        self.scene_threshold = scene_threshold
+        self.max_side = max_side
+        self.workers = workers
+        self.ttl_seconds = ttl_seconds
+        self.metrics = metrics or get_metrics()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    async def analyze(self, media: MediaRef) -> Tuple[str, bool]:
+        """Análise do vídeo e se veio do cache ("" sem quadros nem fala, ou sem resposta do modelo)"""
+        cached = self._get_cached(media.sha256)
+        if cached is not None:
+            return cached, True
+
+        if self._pool is None:
+            self._pool = create_process_pool(self.workers)
+        loop = asyncio.get_running_loop()
+        frames_future = loop.run_in_executor(
+            self._pool, extract_keyframes, media.path, self.frame_budget,
+            self.sample_fps, self.scene_threshold, self.max_side,
+        )
+        transcript_task = asyncio.create_task(self._transcribe(media))
+        try:
+            keyframes = await frames_future
+        except BaseException:
+            transcript_task.cancel()
+            raise
+        transcript = await transcript_task
+        self.metrics.increment("video.keyframes", len(keyframes))
+
+        if not keyframes and not transcript:
+            # Nada para analisar: falha para o chamador, como a resposta vazia do modelo
+            self.metrics.increment("video.unreadable")
+            return "", False
+
+        prompt: List[Any] = [ANALYZE_PROMPT]
+        if transcript:
+            prompt.append(f"Transcrição do áudio: {transcript}")
+        for timestamp, jpeg in keyframes:
+            prompt.append(f"[{timestamp:.1f}s]")
+            prompt.append({"mime_type": "image/jpeg", "data": jpeg})
+
+        analysis = (await self.model_executor.generate_content(prompt) or "").strip()
+        if not analysis:
+            # Modelo sem resposta: o chamador trata como falha (nada vai para o cache)
+            self.metrics.increment("video.fallback")
+            return "", False
+        self.metrics.increment("video.analyzed")
+        self._put(media.sha256, analysis)
+        return analysis, False
+
+    async def _transcribe(self, media: MediaRef) -> str:
+        if not self.audio_pipeline:
+            return ""
+        try:
+            return await self.audio_pipeline.transcribe(media)
+        except AudioDecodeError:
+            # Vídeo sem faixa de áudio
+            return ""
+        except Exception as e:
+            logger.error(f"Erro ao transcrever áudio do vídeo: {e}")
+            return ""
+
+    def shutdown(self):
+        """Encerra o processo de decodificação"""
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _get_cached(self, sha256: str) -> Optional[str]:
+        try:
+            cached = database.cache_get(_KEY_PREFIX + sha256)
+            if cached is not None:
+                self.metrics.increment("video.cache_hits")
+                return cached.get("analysis")
+        except Exception as e:
+            logger.error(f"Erro ao consultar cache de vídeos: {e}")
+        return None
+
+    def _put(self, sha256: str, analysis: str):
+        try:
+            database.cache_set(_KEY_PREFIX + sha256, {"analysis": analysis}, ttl_seconds=self.ttl_seconds)
+        except Exception as e:
+            logger.error(f"Erro ao salvar análise de vídeo no cache: {e}")
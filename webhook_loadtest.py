@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Teste de Carga do Webhook
+=========================
+
+Cliente Telegram falso: envia updates de mensagens de texto para o webhook
+local e mede a latência da confirmação (não o tempo de resposta do bot).
+
+Uso:
+    python webhook_loadtest.py --url http://localhost:8443/telegram \\
+        --secret "$TELEGRAM_WEBHOOK_SECRET" --updates 2000 --concurrency 50
+
+Para rodar sem Telegram, inicie o bot com telegram.webhook.register = false.
+"""
+
+import time
+import random
+import asyncio
+import argparse
+from typing import Any, Dict, List
+
+import aiohttp
+
+from webhook_server import SECRET_TOKEN_HEADER
+
+
+def fake_update(update_id: int, user_id: int) -> Dict[str, Any]:
+    """Update de mensagem de texto no formato da Bot API"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"Teste {user_id}", "username": f"teste{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": random.choice(["oi", "qual a capital da França?", "me conte uma curiosidade"]),
+        },
+    }
+
+
+async def run_load_test(url: str, secret: str, updates: int, concurrency: int, users: int) -> Dict[str, Any]:
+    """Envia os updates e retorna contagem por status e percentis de latência"""
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    counter = iter(range(1, updates + 1))
+    headers = {SECRET_TOKEN_HEADER: secret} if secret else {}
+
+    async def worker(session: aiohttp.ClientSession):
+        for update_id in counter:
+            payload = fake_update(update_id, random.randint(1, users))
+            started = time.perf_counter()
+            async with session.post(url, json=payload, headers=headers) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def pct(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000 if latencies else 0.0
+
+    return {
+        "updates": updates,
+        "seconds": elapsed,
+        "rate": updates / elapsed if elapsed else 0.0,
+        "statuses": statuses,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do webhook do bot")
+    parser.add_argument("--url", default="http://localhost:8443/telegram")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load_test(args.url, args.secret, args.updates, args.concurrency, args.users))
+    print(f"{result['updates']} updates em {result['seconds']:.2f}s ({result['rate']:.0f}/s)")
+    print(f"Status: {result['statuses']}")
+    print(f"Latência da confirmação: p50={result['p50_ms']:.1f}ms "
+          f"p95={result['p95_ms']:.1f}ms p99={result['p99_ms']:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Servidor de Webhook
+===================
+
+Alternativa ao run_polling: um servidor aiohttp embutido recebe os updates
+do Telegram, confere o secret token, responde 200 imediatamente e entrega o
+update à fila de processamento da Application.
+
+Funcionalidades:
+- Verificação obrigatória do cabeçalho X-Telegram-Bot-Api-Secret-Token
+  (sem TELEGRAM_WEBHOOK_SECRET, um token aleatório é gerado e registrado)
+- Confirmação rápida (o processamento acontece depois, pela update_queue)
+- max_connections repassado ao setWebhook e aplicado no servidor como
+  limite de requisições atendidas ao mesmo tempo (as demais aguardam)
+- Endpoint /health para balanceadores e testes de carga
+- Hooks post_init/post_stop/post_shutdown da Application preservados
+
+Características:
+- Sem dependência do extra "webhooks" do python-telegram-bot
+- Para teste local sem Telegram, use webhook_loadtest.py com
+  register_webhook desativado
+"""
+
+import hmac
+import json
+import secrets
+import time
+import asyncio
+import logging
+import signal
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import Metrics, get_metrics
+
+logger = logging.getLogger('gemini_bot')
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Recebe updates do Telegram via HTTP e os enfileira na Application"""
+
+    def __init__(self, application: Application, secret_token: Optional[str], listen: str = "0.0.0.0",
+                 port: int = 8443, path: str = "/telegram", webhook_url: Optional[str] = None,
+                 max_connections: int = 40, drop_pending_updates: bool = False,
+                 register_webhook: bool = True, metrics: Optional[Metrics] = None):
+        if not secret_token:
+            if not register_webhook:
+                # Ninguém conheceria um token gerado: aceitaria updates forjados
+                raise ValueError("TELEGRAM_WEBHOOK_SECRET é obrigatório com o registro do webhook desativado")
+            secret_token = secrets.token_urlsafe(32)
+            logger.warning("TELEGRAM_WEBHOOK_SECRET não configurado: usando token aleatório gerado nesta execução")
+        self.application = application
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.webhook_url = webhook_url
+        self.max_connections = max_connections
+        self.drop_pending_updates = drop_pending_updates
+        self.register_webhook = register_webhook
+        self.metrics = metrics or get_metrics()
+        self._runner: Optional[web.AppRunner] = None
+        self._slots = asyncio.Semaphore(max_connections)
+
+    def create_app(self) -> web.Application:
+        """Aplicação aiohttp com as rotas do webhook"""
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Valida e enfileira um update, respondendo sem esperar o processamento"""
+        started = time.monotonic()
+        received = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(received, self.secret_token):
+            self.metrics.increment("webhook.forbidden")
+            return web.Response(status=403)
+
+        async with self._slots:
+            return await self._enqueue(request, started)
+
+    async def _enqueue(self, request: web.Request, started: float) -> web.Response:
+        try:
+            data = await request.json(loads=json.loads)
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            logger.warning(f"Update inválido recebido pelo webhook: {e}")
+            self.metrics.increment("webhook.invalid")
+            return web.Response(status=400)
+
+        await self.application.update_queue.put(update)
+        self.metrics.increment("webhook.received")
+        self.metrics.observe("webhook.ack", time.monotonic() - started)
+        return web.Response(status=200)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Estado do servidor e tamanho da fila de updates"""
+        return web.json_response({
+            "status": "ok",
+            "update_queue": self.application.update_queue.qsize(),
+        })
+
+    async def start(self):
+        """Inicia o servidor HTTP e registra o webhook no Telegram"""
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        logger.info(f"Webhook ouvindo em {self.listen}:{self.port}{self.path}")
+
+        if self.register_webhook:
+            if not self.webhook_url:
+                raise ValueError("URL pública do webhook não configurada")
+            await self.application.bot.set_webhook(
+                url=self.webhook_url,
+                secret_token=self.secret_token,
+                max_connections=self.max_connections,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=self.drop_pending_updates,
+            )
+            logger.info(f"Webhook registrado no Telegram: {self.webhook_url}")
+
+    async def stop(self):
+        """Encerra o servidor HTTP"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def serve(self):
+        """Executa Application + servidor até receber SIGINT/SIGTERM"""
+        application = self.application
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # Windows: KeyboardInterrupt interrompe o asyncio.run
+                pass
+
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        try:
+            await application.start()
+            try:
+                await self.start()
+                await stop_event.wait()
+            finally:
+                await self.stop()
+                if application.running:
+                    await application.stop()
+                if application.post_stop:
+                    await application.post_stop(application)
+        finally:
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+def create_webhook_server(application: Application, settings: Dict[str, Any],
+                          secret_token: Optional[str], webhook_url: Optional[str]) -> WebhookServer:
+    """Cria o servidor a partir da seção telegram.webhook da configuração"""
+    return WebhookServer(
+        application,
+        secret_token=secret_token,
+        listen=settings.get("listen", "0.0.0.0"),
+        port=int(settings.get("port", 8443)),
+        path=settings.get("path", "/telegram"),
+        webhook_url=webhook_url or settings.get("url"),
+        max_connections=int(settings.get("max_connections", 40)),
+        drop_pending_updates=settings.get("drop_pending_updates", False),
+        register_webhook=settings.get("register", True),
+    )